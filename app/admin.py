@@ -1,3 +1,38 @@
 from django.contrib import admin
+from .models import AnalysisJob, Channel, ChannelCheckpoint, RelatedEdge, Video, VideoStatistics
 
-# Register your models here.
+
+@admin.register(Channel)
+class ChannelAdmin(admin.ModelAdmin):
+    list_display = ('channel_id', 'title', 'fetched_at')
+    search_fields = ('channel_id', 'title')
+
+
+@admin.register(Video)
+class VideoAdmin(admin.ModelAdmin):
+    list_display = ('video_id', 'title', 'channel', 'published_at')
+    search_fields = ('video_id', 'title')
+
+
+@admin.register(VideoStatistics)
+class VideoStatisticsAdmin(admin.ModelAdmin):
+    list_display = ('video', 'fetched_at', 'view_count', 'like_count', 'comment_count')
+    list_select_related = ('video',)
+
+
+@admin.register(RelatedEdge)
+class RelatedEdgeAdmin(admin.ModelAdmin):
+    list_display = ('source', 'rank', 'video', 'channel', 'fetched_at')
+    list_select_related = ('source', 'video', 'channel')
+
+
+@admin.register(ChannelCheckpoint)
+class ChannelCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('channel', 'latest_video_id', 'page_token', 'covered_since', 'crawled_at')
+    list_select_related = ('channel',)
+
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'stage', 'progress', 'created_at')
+    list_filter = ('kind', 'status')
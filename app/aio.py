@@ -0,0 +1,113 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from googleapiclient.errors import HttpError
+from . import youtube
+import asyncio
+import weakref
+
+
+
+# ==================================【YouTube API(async)】=======================================
+# ASGIの async のビューから使う YouTube API の呼び出し
+# googleapiclient は同期なので、1回の呼び出しをスレッドで実行し(キャッシュ、クォータ、計測は youtube.call と同じ)、
+# 同時に実行する数をイベントループごとのセマフォ(YOUTUBE_MAX_CONCURRENCY)で制限する
+# DBは使わないので thread_sensitive=False(DBを使う処理はビューで sync_to_async にする)
+
+# {イベントループ: セマフォ}
+_semaphores = weakref.WeakKeyDictionary()
+
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(settings.YOUTUBE_MAX_CONCURRENCY)
+    return _semaphores[loop]
+
+
+
+# func(*args) をセマフォの範囲内でスレッドで実行する
+async def run(func, *args, **kwargs):
+    async with _semaphore():
+        return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+
+
+async def call(endpoint, **params):
+    return await run(youtube.call, endpoint, **params)
+
+
+
+# youtube.iter_search_pages の async 版
+async def iter_search_pages(limit, page_size=youtube.MAX_RESULTS_PER_PAGE, **params):
+    page_token = None
+    remaining = limit
+    while remaining > 0:
+        page_params = dict(params, maxResults=min(remaining, page_size, youtube.MAX_RESULTS_PER_PAGE))
+        if page_token:
+            page_params['pageToken'] = page_token
+        result = await call('search', **page_params)
+
+        items = result.get('items', [])[:remaining]
+        remaining -= len(items)
+        yield items
+
+        page_token = result.get('nextPageToken')
+        if not page_token or not items:
+            break
+
+
+
+# ページを1つ取り出す(最後まで読んだら None)
+async def next_page(pages):
+    try:
+        return await pages.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+
+# youtube.capture_failure の async 版
+async def capture_failure(endpoint, ids, awaitable, default):
+    try:
+        return await awaitable
+    except (HttpError, OSError) as e:
+        youtube.record_failure(endpoint, ids, e)
+        return default
+
+
+
+# youtube.fetch_by_ids の async 版(50件ずつのチャンクを asyncio.gather で同時に取得する)
+async def fetch_by_ids(endpoint, ids, part):
+    responses = await asyncio.gather(*[
+        capture_failure(endpoint, chunk, run(youtube.call_response, endpoint, part=part, id=','.join(chunk)), None)
+        for chunk in youtube.chunked(youtube.unique_ids(ids))
+    ])
+
+    items = youtube.FetchedItems()
+    for response in responses:
+        if response is not None:
+            items.add(response)
+    return items
+
+
+
+async def fetch_videos(video_ids):
+    return await fetch_by_ids('videos', video_ids, part='statistics')
+
+
+
+async def fetch_channels(channel_ids, part='snippet'):
+    return await fetch_by_ids('channels', channel_ids, part=part)
+
+
+
+# youtube.fetch_related の async 版
+async def fetch_related(video_ids, max_results):
+    related, missing = await sync_to_async(youtube.cached_related, thread_sensitive=False)(video_ids, max_results)
+    results = await asyncio.gather(*[
+        capture_failure('related', [videoid], run(youtube.search_related_or_skip, videoid, max_results), [])
+        for videoid in missing
+    ])
+    related.update(zip(missing, results))
+    return related
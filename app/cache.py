@@ -0,0 +1,390 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import zlib
+
+
+
+# ==================================【キャッシュのバックエンド】=======================================
+# プロセス内のLRUキャッシュ
+# あふれた時は再取得のクォータが安いエントリから捨てる(search：100、videos/channels：1)
+class LocMemBackend:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        # コストごとのLRU {cost: OrderedDict(key: (期限, 値))}
+        self._buckets = {}
+        # key: cost
+        self._costs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cost = self._costs.get(key)
+            if cost is None:
+                return None
+            bucket = self._buckets[cost]
+            expires_at, value = bucket[key]
+            if expires_at <= time.monotonic():
+                self._delete(key)
+                return None
+            bucket.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout, cost=1):
+        with self._lock:
+            self._delete(key)
+            self._buckets.setdefault(cost, OrderedDict())[key] = (time.monotonic() + timeout, value)
+            self._costs[key] = cost
+            if len(self._costs) > self.max_entries:
+                self._cull()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._costs.clear()
+
+    def _delete(self, key):
+        cost = self._costs.pop(key, None)
+        if cost is not None:
+            del self._buckets[cost][key]
+
+    def _cull(self):
+        # 期限切れのエントリを先に捨てる
+        now = time.monotonic()
+        for bucket in self._buckets.values():
+            for key in [key for key, (expires_at, _) in bucket.items() if expires_at <= now]:
+                self._delete(key)
+
+        # それでもあふれている場合は、コストの安いものから古い順に捨てる
+        for cost in sorted(self._buckets):
+            bucket = self._buckets[cost]
+            while bucket and len(self._costs) > self.max_entries:
+                self._delete(next(iter(bucket)))
+
+
+
+# ファイルのキャッシュ(LOCATION のディレクトリ。ワーカー間で共有し、再起動後も残る)
+# 1エントリ1ファイルで、先頭に (期限, コスト) を書き込む。使ったファイルは更新日時を新しくする(LRU)
+# あふれた時は期限切れのファイルを先に消し、それでもあふれている場合はコストの安いものから古い順に、
+# MAX_ENTRIES の9割まで消す(書き込みのたびに全ファイルを読まないように、まとめて消す)
+class FileBackend:
+    cache_suffix = '.rc'
+
+    def __init__(self, location, max_entries=1000):
+        self.location = str(location)
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.location, hashlib.md5(key.encode('utf-8')).hexdigest() + self.cache_suffix)
+
+    def _files(self):
+        try:
+            return [
+                os.path.join(self.location, name)
+                for name in os.listdir(self.location) if name.endswith(self.cache_suffix)
+            ]
+        except FileNotFoundError:
+            return []
+
+    # (期限, コスト)
+    @staticmethod
+    def _read_header(f):
+        try:
+            return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return 0, 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at, cost = self._read_header(f)
+                if expires_at > time.time():
+                    value = pickle.loads(zlib.decompress(f.read()))
+                else:
+                    value = None
+        except (FileNotFoundError, zlib.error):
+            return None
+        if value is None:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, key, value, timeout, cost=1):
+        os.makedirs(self.location, exist_ok=True)
+        # 一時ファイルに書き込んでから置き換える(読み込み中の他のワーカーに書きかけのファイルを見せない)
+        fd, tmp_path = tempfile.mkstemp(dir=self.location)
+        try:
+            with open(fd, 'wb') as f:
+                pickle.dump((time.time() + timeout, cost), f, pickle.HIGHEST_PROTOCOL)
+                f.write(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._cull()
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+
+    def _cull(self):
+        files = self._files()
+        if len(files) <= self.max_entries:
+            return
+
+        now = time.time()
+        entries = []
+        for path in files:
+            try:
+                with open(path, 'rb') as f:
+                    expires_at, cost = self._read_header(f)
+                used_at = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if expires_at <= now:
+                self._remove(path)
+            else:
+                entries.append((cost, used_at, path))
+
+        if len(entries) <= self.max_entries:
+            return
+        for cost, used_at, path in sorted(entries)[:len(entries) - int(self.max_entries * 0.9)]:
+            self._remove(path)
+
+
+
+# Djangoのキャッシュフレームワーク(CACHES の設定でファイル、DBなどを選ぶ)
+# cost は使わない(あふれた時に捨てるエントリは CACHES のバックエンドが決める)
+class DjangoCacheBackend:
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout, cost=1):
+        self.cache.set(key, value, timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+
+
+# ==================================【ワーカー間で共有するファイルキャッシュ】=======================================
+# CACHES の BACKEND に指定する(クォータの使用量の記録など、ワーカー間で add、incr するキャッシュ)
+# FileBasedCache の add、incr は読み込みと書き込みが別々なので、複数のプロセスから同時に呼ぶと増分が消える
+# ディレクトリのロックファイルを排他ロックしてから読み書きし、同じホストのワーカー間で不可分にする
+class LockedFileBasedCache(FileBasedCache):
+    @contextmanager
+    def _locked(self):
+        self._createdir()
+        # キャッシュのファイル(.djcache)ではないので、clear() や _cull() では消えない
+        with open(os.path.join(self._dir, 'lock'), 'ab') as f:
+            locks.lock(f, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(f)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            return super().add(key, value, timeout, version)
+
+    # (有効期限, 値)。ない場合と期限切れの場合は None
+    def _read(self, key, version):
+        try:
+            with open(self._key_to_file(key, version), 'rb') as f:
+                expiry = pickle.load(f)
+                value = pickle.loads(zlib.decompress(f.read()))
+        except (FileNotFoundError, EOFError):
+            return None
+        if expiry is not None and expiry < time.time():
+            return None
+        return expiry, value
+
+    # 有効期限はそのままにする(BaseCache.incr は set し直すので、デフォルトの TIMEOUT になってしまう)
+    def incr(self, key, delta=1, version=None):
+        with self._locked():
+            entry = self._read(key, version)
+            if entry is None:
+                raise ValueError("Key '%s' not found" % key)
+            expiry, value = entry
+            value += delta
+            self.set(key, value, None if expiry is None else expiry - time.time(), version)
+            return value
+
+    # ない場合は delta を timeout 秒保存し、ある場合は有効期限はそのままで delta 増やす(1回のロックで行う)
+    def incr_or_add(self, key, delta, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked():
+            entry = self._read(key, version)
+            if entry is None:
+                self.set(key, delta, timeout, version)
+                return delta
+            expiry, value = entry
+            value += delta
+            self.set(key, value, None if expiry is None else expiry - time.time(), version)
+            return value
+
+    # あふれた時は期限切れのファイルを先に消し、それでも MAX_ENTRIES 以上ある場合だけランダムに消す
+    def _cull(self):
+        filelist = self._list_cache_files()
+        if len(filelist) < self._max_entries:
+            return
+        for filename in filelist:
+            try:
+                # 期限切れのファイルは _is_expired が消す
+                with open(filename, 'rb') as f:
+                    self._is_expired(f)
+            except FileNotFoundError:
+                pass
+        super()._cull()
+
+
+
+# ==================================【APIレスポンスのキャッシュ】=======================================
+# 有効期限が切れた後も stale 秒は残しておき、クォータが足りない時の代わりに使う
+class ResponseCache:
+    def __init__(self, backend, ttl, stale=0):
+        self.backend = backend
+        # エンドポイントごとの有効期限(秒)
+        self.ttl = ttl
+        self.stale = stale
+        self.hits = Counter()
+        self.misses = Counter()
+        self.stale_hits = Counter()
+        self._lock = threading.Lock()
+
+    # キャッシュキー：(エンドポイント, 正規化したパラメータ)
+    @staticmethod
+    def make_key(endpoint, params):
+        normalized = {
+            name: str(value).strip()
+            for name, value in params.items()
+            if value is not None
+        }
+        digest = hashlib.sha1(
+            json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+        return 'youtube:%s:%s' % (endpoint, digest)
+
+    # (有効期限, レスポンス, 取得した日時)
+    # 取得した日時がない以前の形式のエントリは使わない
+    def _entry(self, endpoint, params):
+        if not self.ttl.get(endpoint):
+            return None
+        entry = self.backend.get(self.make_key(endpoint, params))
+        if entry is None or len(entry) != 3:
+            return None
+        return entry
+
+    # 有効期限内のレスポンス
+    def get(self, endpoint, params):
+        entry = self.get_entry(endpoint, params)
+        return None if entry is None else entry[0]
+
+    # 有効期限内の (レスポンス, APIから取得した日時(time.time()))
+    def get_entry(self, endpoint, params):
+        entry = self._entry(endpoint, params)
+        fresh = entry is not None and entry[0] > time.time()
+        with self._lock:
+            if fresh:
+                self.hits[endpoint] += 1
+            else:
+                self.misses[endpoint] += 1
+        return entry[1:] if fresh else None
+
+    # 有効期限が切れていても残っている (レスポンス, APIから取得した日時(time.time()))
+    def get_stale(self, endpoint, params):
+        entry = self._entry(endpoint, params)
+        if entry is None:
+            return None
+        with self._lock:
+            self.stale_hits[endpoint] += 1
+        return entry[1:]
+
+    def set(self, endpoint, params, value, cost=1):
+        timeout = self.ttl.get(endpoint)
+        if timeout:
+            now = time.time()
+            entry = (now + timeout, value, now)
+            self.backend.set(self.make_key(endpoint, params), entry, timeout + self.stale, cost)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+            self.stale_hits.clear()
+
+    # エンドポイントごとのヒット数、ミス数、期限切れのレスポンスを使った数
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'hits': self.hits[endpoint],
+                    'misses': self.misses[endpoint],
+                    'stale_hits': self.stale_hits[endpoint],
+                }
+                for endpoint in sorted(set(self.hits) | set(self.misses) | set(self.stale_hits))
+            }
+
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+
+# 設定(YOUTUBE_CACHE)からキャッシュを作成する
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                config = settings.YOUTUBE_CACHE
+                if config['BACKEND'] == 'django':
+                    backend = DjangoCacheBackend(config.get('ALIAS', 'default'))
+                elif config['BACKEND'] == 'locmem':
+                    backend = LocMemBackend(config.get('MAX_ENTRIES', 1000))
+                else:
+                    backend = FileBackend(config['LOCATION'], config.get('MAX_ENTRIES', 1000))
+                _response_cache = ResponseCache(backend, config.get('TTL', {}), config.get('STALE', 0))
+    return _response_cache
+
+
+
+# テストなどで設定が変わったら作り直す
+@receiver(setting_changed)
+def reset_response_cache(setting, **kwargs):
+    global _response_cache
+    if setting in ('YOUTUBE_CACHE', 'CACHES'):
+        _response_cache = None
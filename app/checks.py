@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+# add、incr がワーカー間で不可分なキャッシュのバックエンド
+# (LocMemCache はプロセス内だけで共有するので、ワーカーが1つの場合に使う)
+ATOMIC_CACHE_BACKENDS = (
+    'app.cache.LockedFileBasedCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.memcached.MemcachedCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+    'django_redis.cache.RedisCache',
+)
+
+
+
+# クォータの使用量を記録するキャッシュ(YOUTUBE_QUOTA['CACHE'])は、同時に増やしても増分が消えないもの
+@register()
+def check_quota_cache(app_configs, **kwargs):
+    alias = settings.YOUTUBE_QUOTA['CACHE']
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend in ATOMIC_CACHE_BACKENDS:
+        return []
+    return [Error(
+        "YOUTUBE_QUOTA['CACHE'] のキャッシュ '%s' (%s) は、複数のワーカーが同時に使用量を記録すると増分が消えます" % (alias, backend),
+        hint="CACHES['%s'] の BACKEND を %s のどれかにしてください" % (alias, '、'.join(ATOMIC_CACHE_BACKENDS)),
+        id='app.E001',
+    )]
+
+
+
+# YouTube APIのキーが設定されていること(テストを除く)
+@register()
+def check_api_key(app_configs, **kwargs):
+    if settings.YOUTUBE_API_KEY or settings.TESTING:
+        return []
+    return [Error(
+        'YOUTUBE_API_KEY が設定されていません',
+        hint='.env または環境変数で YOUTUBE_API_KEY を設定してください(migrate などAPIを使わないコマンドは --skip-checks でも実行できます)',
+        id='app.E002',
+    )]
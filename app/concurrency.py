@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+import contextvars
+
+
+
+# executor.submit() と同じ(呼び出し元のコンテキスト変数を引き継ぐ。tracing の計測など)
+def submit(executor, func, *args):
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+
+# func を items の各要素に並列で適用し、items と同じ順番で結果を返す
+def fan_out(func, items, max_workers=None):
+    items = list(items)
+    if max_workers is None:
+        max_workers = settings.YOUTUBE_MAX_CONCURRENCY
+
+    # 1件だけ、または並列数1の場合はスレッドを使わない
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [submit(executor, func, item) for item in items]
+        return [future.result() for future in futures]
+
+
+
+# 並列で実行し、結果のリストを順番通りに連結して返す
+def fan_out_flat(func, items, max_workers=None):
+    results = []
+    for result in fan_out(func, items, max_workers):
+        results.extend(result)
+    return results
@@ -0,0 +1,158 @@
+from django.http import StreamingHttpResponse
+from typing import get_type_hints
+import csv
+import importlib.util
+import io
+import itertools
+import json
+
+
+
+# 形式：(Content-Type, 拡張子)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson; charset=utf-8', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+# 形式ごとに必要なパッケージ(requirements.txt に入っているが、入れていない環境ではその形式は使えない)
+REQUIRED_PACKAGES = {
+    'parquet': ('pyarrow',),
+    'xlsx': ('pandas', 'openpyxl'),
+}
+
+# Parquet の1回に書き込む行数(行グループ)
+PARQUET_ROW_GROUP_SIZE = 1000
+
+
+
+# 必要なパッケージが入っているかどうか
+def is_available(export_format):
+    return all(importlib.util.find_spec(package) is not None for package in REQUIRED_PACKAGES.get(export_format, ()))
+
+
+
+# ==================================【CSV、NDJSON】=======================================
+# csv.writer の書き込み先(書き込んだ1行をそのまま返す)
+class _Echo:
+    def write(self, value):
+        return value
+
+
+
+# Excelで文字化けしないようにBOMを付ける
+def iter_csv(rows, row_type):
+    writer = csv.writer(_Echo())
+    yield '\ufeff' + writer.writerow(row_type._fields)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+
+def iter_ndjson(rows, row_type):
+    for row in rows:
+        yield json.dumps(row._asdict(), ensure_ascii=False) + '\n'
+
+
+
+# ==================================【Parquet】=======================================
+# ParquetWriter の書き込み先(書き込まれたバイト列をためておき、drain() で取り出す)
+class _StreamSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+
+# PARQUET_ROW_GROUP_SIZE 行ずつ列に分けて書き込み、書き込んだ分から返す
+def iter_parquet(rows, row_type):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # 列の型は行データの型ヒントから決める(int 以外は文字列)
+    schema = pa.schema([
+        (name, pa.int64() if hint is int else pa.string())
+        for name, hint in get_type_hints(row_type).items()
+    ])
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, PARQUET_ROW_GROUP_SIZE))
+        if not chunk:
+            break
+        columns = zip(*chunk)
+        writer.write_table(pa.Table.from_arrays([
+            pa.array(column, type=field.type) for column, field in zip(columns, schema)
+        ], schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+
+    writer.close()
+    yield sink.drain()
+
+
+
+# ==================================【pandas(Excel)】=======================================
+# 行データのリストをデータフレームにする(pandas は使う時だけ読み込む)
+# 列の型は行データの型ヒントから決める(int は欠損値を入れられる Int64、それ以外は文字列)
+def to_dataframe(rows, row_type):
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(list(rows), columns=row_type._fields)
+    return df.astype({
+        name: 'Int64' if hint is int else 'string'
+        for name, hint in get_type_hints(row_type).items()
+    })
+
+
+
+# Excelのファイルは最後にまとめて書き込むので、全件を書き込んでから返す
+def iter_xlsx(rows, row_type):
+    buffer = io.BytesIO()
+    to_dataframe(rows, row_type).to_excel(buffer, index=False, engine='openpyxl')
+    yield buffer.getvalue()
+
+
+
+WRITERS = {
+    'csv': iter_csv,
+    'ndjson': iter_ndjson,
+    'parquet': iter_parquet,
+    'xlsx': iter_xlsx,
+}
+
+
+
+# 行データ(row_type の NamedTuple)を export_format の形式で少しずつ返すレスポンス
+def streaming_response(rows, row_type, export_format, filename):
+    content_type, extension = FORMATS[export_format]
+    response = StreamingHttpResponse(WRITERS[export_format](rows, row_type), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, extension)
+    return response
@@ -1,6 +1,10 @@
 from django import forms
+from django.conf import settings
 
 
+# 一括検索で一度に検索できるキーワードの数
+BATCH_MAX_KEYWORDS = 50
+
 ORDER_CHOICES = {
     'viewCount': '再生回数の多い順',
     'date': '作成日の新しい順',
@@ -11,7 +15,8 @@ ORDER_CHOICES = {
 
 class KeywordForm(forms.Form):
     keyword = forms.CharField(max_length=100, label='キーワード')
-    items_count = forms.IntegerField(label='検索数')
+    # 検索結果は YOUTUBE_SEARCH_MAX_RESULTS 件までしか読み込まない
+    items_count = forms.IntegerField(label='検索数', min_value=1, max_value=settings.YOUTUBE_SEARCH_MAX_RESULTS)
     viewcount = forms.IntegerField(label='再生回数')
     order = forms.ChoiceField(
         label='並び順', widget=forms.Select, choices=list(ORDER_CHOICES.items()))
@@ -22,6 +27,29 @@ class KeywordForm(forms.Form):
 
 
 
+# 複数のキーワードをまとめて検索する(1行に1キーワード)
+class BatchKeywordForm(KeywordForm):
+    keyword = None
+    keywords = forms.CharField(widget=forms.Textarea(attrs={'rows': 5}), label='キーワード(1行に1つ)')
+
+    field_order = ['keywords']
+
+    # 空行と重複を除いたキーワードのリスト
+    def clean_keywords(self):
+        keywords = list(dict.fromkeys(
+            keyword.strip() for keyword in self.cleaned_data['keywords'].splitlines() if keyword.strip()
+        ))
+        if not keywords:
+            raise forms.ValidationError('キーワードを入力してください')
+        if len(keywords) > BATCH_MAX_KEYWORDS:
+            raise forms.ValidationError('キーワードは%d個までです' % BATCH_MAX_KEYWORDS)
+        for keyword in keywords:
+            if len(keyword) > 100:
+                raise forms.ValidationError('キーワードは100文字以内にしてください')
+        return keywords
+
+
+
 class RelatedForm(forms.Form):
     my_channel_id = forms.CharField(max_length=100, label='自分のチャンネルID')
     rival_channel_id = forms.CharField(max_length=1000, label='相手のチャンネルID')
@@ -30,3 +58,26 @@ class RelatedForm(forms.Form):
     rival_search_start = forms.DateField(widget=forms.DateInput(attrs={"type":'date'}), label='相手の検索開始日')
     rival_search_end = forms.DateField(widget=forms.DateInput(attrs={"type":'date'}), label='相手の検索終了日')
     related_items_count = forms.IntegerField(label='関連の検索数')
+
+
+
+# 保存した検索結果の並べ替え(- は多い順、新しい順)
+SORT_CHOICES = {
+    '': '検索結果の順',
+    '-viewcount': '再生回数の多い順',
+    'viewcount': '再生回数の少ない順',
+    '-likeCount': '高評価数の多い順',
+    '-commentCount': 'コメント数の多い順',
+    '-publishtime': '公開日の新しい順',
+    'publishtime': '公開日の古い順',
+}
+
+
+# 保存した検索結果の並べ替え、絞り込み(GETのパラメータ。空の項目は使わない)
+class ResultFilterForm(forms.Form):
+    sort = forms.ChoiceField(label='並べ替え', choices=list(SORT_CHOICES.items()), required=False)
+    min_viewcount = forms.IntegerField(label='再生回数', min_value=0, required=False)
+    min_likes = forms.IntegerField(label='高評価数', min_value=0, required=False)
+    min_comments = forms.IntegerField(label='コメント数', min_value=0, required=False)
+    published_after = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}), label='公開日(から)', required=False)
+    published_before = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}), label='公開日(まで)', required=False)
@@ -0,0 +1,187 @@
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from .models import VideoStatistics
+from .rows import ChannelGrowthRow, VideoGrowthRow
+
+
+# 統計データの列
+COLUMNS = [
+    'video_id',
+    'title',
+    'channel_id',
+    'channeltitle',
+    'published_at',
+    'fetched_at',
+    'view_count',
+    'like_count',
+    'comment_count',
+]
+
+
+
+# ==================================【再生回数の推移の分析】=======================================
+# 保存済みの統計データ(day までの window_days 日分)から、動画ごと・チャンネルごとの伸びを計算する
+# 動画ごとにループせず、pandas の groupby と列の計算でまとめて計算する
+# 戻り値：(VideoGrowthRow のリスト(1日あたりの再生回数の多い順), ChannelGrowthRow のリスト)
+def compute_growth(day, window_days):
+    import numpy as np
+    import pandas as pd
+
+    tz = timezone.get_current_timezone()
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), tz)
+    snapshots = (
+        VideoStatistics.objects
+        .filter(fetched_at__gte=end - timedelta(days=window_days), fetched_at__lt=end)
+        .values_list(
+            'video_id', 'video__title', 'video__channel_id', 'video__channel__title', 'video__published_at',
+            'fetched_at', 'view_count', 'like_count', 'comment_count',
+        )
+    )
+    df = pd.DataFrame.from_records(list(snapshots), columns=COLUMNS)
+    if df.empty:
+        return [], []
+
+    # 取得日時を日数(浮動小数点)にし、動画ごとに取得日時の順に並べる
+    df['days'] = (pd.to_datetime(df['fetched_at'], utc=True) - pd.Timestamp(end)).dt.total_seconds() / 86400
+    df = df.sort_values(['video_id', 'days'], kind='mergesort').reset_index(drop=True)
+
+    # 同じ数値が続く統計データは最初のものだけ使う
+    # (以前はキャッシュや期限切れのキャッシュから返した数値も後の日時で保存していたので、伸びが小さく計算される)
+    counts = df[['view_count', 'like_count', 'comment_count']].fillna(-1)
+    repeated = (counts == counts.groupby(df['video_id']).shift(1)).all(axis=1)
+    df = df[~repeated].reset_index(drop=True)
+    for column in ('view_count', 'like_count', 'comment_count'):
+        df[column] = df[column].astype('float64')
+
+    # 前回の取得からの1日あたりの再生回数と、その変化(加速度：1日あたりの再生回数の1日あたりの増減)
+    videos = df.groupby('video_id', sort=False)
+    elapsed = videos['days'].diff()
+    df['rate'] = (videos['view_count'].diff() / elapsed).where(elapsed > 0)
+    previous_elapsed = elapsed.groupby(df['video_id']).shift(1)
+    df['acceleration'] = (
+        df['rate'].groupby(df['video_id']).diff() / ((elapsed + previous_elapsed) / 2)
+    ).where(elapsed > 0)
+
+    first = videos.head(1).set_index('video_id')
+    last = videos.tail(1).set_index('video_id')
+
+    # 期間内の1日あたりの再生回数(統計データが1件だけの動画は公開日からの平均)
+    span = last['days'] - first['days']
+    age = (pd.Timestamp(day) - pd.to_datetime(last['published_at'])).dt.days.clip(lower=1)
+    views_per_day = ((last['view_count'] - first['view_count']) / span).where(span > 0, last['view_count'] / age)
+
+    views = last['view_count'].where(last['view_count'] > 0)
+    result = pd.DataFrame({
+        'title': last['title'],
+        'channel_id': last['channel_id'],
+        'channeltitle': last['channeltitle'],
+        'published_at': last['published_at'],
+        'view_count': last['view_count'],
+        'views_per_day': views_per_day,
+        'like_ratio': last['like_count'] / views,
+        'comment_ratio': last['comment_count'] / views,
+        'acceleration': last['acceleration'],
+        'snapshots': videos.size(),
+    })
+
+    # チャンネルごと(高評価率、コメント率は公開している動画の合計から)
+    public = result['like_ratio'].notna()
+    result['public_views'] = result['view_count'].where(public, 0)
+    result['like_count'] = last['like_count'].where(public, 0)
+    result['comment_count'] = last['comment_count'].where(public, 0)
+    channels = result.groupby('channel_id', sort=False).agg(
+        channeltitle=('channeltitle', 'first'),
+        videos=('title', 'size'),
+        view_count=('view_count', 'sum'),
+        views_per_day=('views_per_day', 'sum'),
+        public_views=('public_views', 'sum'),
+        like_count=('like_count', 'sum'),
+        comment_count=('comment_count', 'sum'),
+        acceleration=('acceleration', 'mean'),
+    )
+    public_views = channels['public_views'].where(channels['public_views'] > 0)
+    channels['like_ratio'] = channels['like_count'] / public_views
+    channels['comment_ratio'] = channels['comment_count'] / public_views
+
+    result = result.sort_values('views_per_day', ascending=False, kind='mergesort')
+    channels = channels.sort_values('views_per_day', ascending=False, kind='mergesort')
+
+    # NaN を None にして行データにする
+    result = result.replace({np.nan: None})
+    channels = channels.replace({np.nan: None})
+    video_rows = [
+        VideoGrowthRow(
+            video_id=videoid,
+            url='https://www.youtube.com/embed/' + videoid,
+            title=row.title,
+            channel_id=row.channel_id,
+            channeltitle=row.channeltitle,
+            published_at=row.published_at,
+            view_count=_int(row.view_count),
+            views_per_day=_round(row.views_per_day, 1),
+            like_ratio=_round(row.like_ratio, 4),
+            comment_ratio=_round(row.comment_ratio, 4),
+            acceleration=_round(row.acceleration, 2),
+            snapshots=int(row.snapshots),
+        )
+        for videoid, row in zip(result.index, result.itertuples(index=False))
+    ]
+    channel_rows = [
+        ChannelGrowthRow(
+            channel_id=channelid,
+            channeltitle=row.channeltitle,
+            videos=int(row.videos),
+            view_count=_int(row.view_count),
+            views_per_day=_round(row.views_per_day, 1),
+            like_ratio=_round(row.like_ratio, 4),
+            comment_ratio=_round(row.comment_ratio, 4),
+            acceleration=_round(row.acceleration, 2),
+        )
+        for channelid, row in zip(channels.index, channels.itertuples(index=False))
+    ]
+    return video_rows, channel_rows
+
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+
+def _round(value, digits):
+    return None if value is None else round(float(value), digits)
+
+
+
+# ==================================【日ごとのキャッシュ】=======================================
+def _cache():
+    return caches[settings.GROWTH_ANALYTICS['CACHE']]
+
+
+
+def _key(day, window_days):
+    return 'growth:%s:%d' % (day.isoformat(), window_days)
+
+
+
+# その日の計算結果(なければ計算してキャッシュする)
+def get_growth(day=None, window_days=None):
+    day = day or timezone.localdate()
+    window_days = window_days or settings.GROWTH_ANALYTICS['WINDOW_DAYS']
+    result = _cache().get(_key(day, window_days))
+    if result is None:
+        result = refresh_growth(day, window_days)
+    return result
+
+
+
+# 計算し直してキャッシュする(track_channels の巡回の後など、統計データが増えた時)
+def refresh_growth(day=None, window_days=None):
+    day = day or timezone.localdate()
+    window_days = window_days or settings.GROWTH_ANALYTICS['WINDOW_DAYS']
+    result = compute_growth(day, window_days)
+    # 翌日には新しい日のキーで計算し直すので、2日分残す
+    _cache().set(_key(day, window_days), result, 60 * 60 * 48)
+    return result
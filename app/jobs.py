@@ -0,0 +1,209 @@
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from datetime import timedelta
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .models import AnalysisJob
+from . import tracing, youtube
+import asyncio
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# 一部のデータを取得できなかった段階のリスト(results に保存する)
+PARTIAL_STAGES = 'partial_stages'
+
+# 止まったジョブ(fail_stale_jobs)のエラー
+STALE_ERROR = '一定時間進まなかったので中断しました(サーバーの再起動などで止まった可能性があります)'
+
+# Webプロセス内のワーカー(ANALYSIS_JOB_BACKEND = 'thread' の場合)
+_executor = None
+_executor_lock = threading.Lock()
+
+# イベントループで実行中のジョブ(submit_async。終わるまで参照を持っておかないと、途中で破棄されることがある)
+_tasks = set()
+
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.ANALYSIS_JOB_WORKERS,
+                    thread_name_prefix='analysis-job',
+                )
+    return _executor
+
+
+
+# ジョブを実行する
+# stages：[(段階名, 表示名, 関数(params, results))] のリスト
+# 結果は段階ごとに保存し、保存済みの段階は飛ばす(失敗したジョブをやり直す時は失敗した段階から)
+# 段階ごとの処理時間は stage.<段階名> として計測する
+# 一部のデータを取得できなかった段階(youtube.collect_failures)は、完了にした上で PARTIAL_STAGES に記録する
+def run_job(job_id, stages):
+    job = AnalysisJob.objects.get(pk=job_id)
+    with tracing.trace('job.' + job.kind, job_id=str(job.pk)) as job_trace:
+        _run_stages(job, stages)
+        job_trace.fields['status'] = job.status
+    return job
+
+
+
+def _run_stages(job, stages):
+    job.status = AnalysisJob.RUNNING
+    job.error = ''
+    job.save(update_fields=['status', 'error', 'updated_at'])
+
+    try:
+        for index, (stage, label, func) in enumerate(stages):
+            if stage not in job.results:
+                job.stage = stage
+                job.save(update_fields=['stage', 'updated_at'])
+                with tracing.span('stage.' + stage), youtube.collect_failures() as failures:
+                    job.results[stage] = func(job.params, job.results)
+                if failures:
+                    job.results.setdefault(PARTIAL_STAGES, []).append(stage)
+            job.progress = (index + 1) * 100 // len(stages)
+            job.save(update_fields=['results', 'progress', 'updated_at'])
+    except Exception as e:
+        logger.exception('analysis job %s failed at %s', job.pk, job.stage)
+        job.status = AnalysisJob.FAILED
+        job.error = '%s: %s' % (type(e).__name__, e)
+    else:
+        job.status = AnalysisJob.DONE
+        job.stage = ''
+    job.save(update_fields=['status', 'stage', 'error', 'updated_at'])
+
+
+
+# run_job の async 版(ASGIの async のビューからイベントループ内で実行する)
+# stages の関数は async の関数(params, results)。DBの読み書きは sync_to_async で行う
+async def run_job_async(job_id, stages):
+    job = await sync_to_async(AnalysisJob.objects.get)(pk=job_id)
+    with tracing.trace('job.' + job.kind, job_id=str(job.pk)) as job_trace:
+        await _run_stages_async(job, stages)
+        job_trace.fields['status'] = job.status
+    return job
+
+
+
+async def _run_stages_async(job, stages):
+    save = sync_to_async(job.save)
+    job.status = AnalysisJob.RUNNING
+    job.error = ''
+    await save(update_fields=['status', 'error', 'updated_at'])
+
+    try:
+        for index, (stage, label, func) in enumerate(stages):
+            if stage not in job.results:
+                job.stage = stage
+                await save(update_fields=['stage', 'updated_at'])
+                with tracing.span('stage.' + stage), youtube.collect_failures() as failures:
+                    job.results[stage] = await func(job.params, job.results)
+                if failures:
+                    job.results.setdefault(PARTIAL_STAGES, []).append(stage)
+            job.progress = (index + 1) * 100 // len(stages)
+            await save(update_fields=['results', 'progress', 'updated_at'])
+    except Exception as e:
+        logger.exception('analysis job %s failed at %s', job.pk, job.stage)
+        job.status = AnalysisJob.FAILED
+        job.error = '%s: %s' % (type(e).__name__, e)
+    else:
+        job.status = AnalysisJob.DONE
+        job.stage = ''
+    await save(update_fields=['status', 'stage', 'error', 'updated_at'])
+
+
+
+# 一部のデータを取得できなかった段階があるかどうか
+def is_partial(job):
+    return bool(job.results.get(PARTIAL_STAGES))
+
+
+
+# やり直す前に、一部のデータを取得できなかった段階とその後の段階の結果を消す(それより前の段階の結果は使う)
+def discard_partial_stages(job, stages):
+    partial = job.results.pop(PARTIAL_STAGES, [])
+    names = [stage for stage, label, func in stages]
+    if partial:
+        for stage in names[min(names.index(stage) for stage in partial):]:
+            job.results.pop(stage, None)
+
+
+
+# スレッドで実行する時は、終わったらそのスレッドのDB接続を閉じる
+def _run_in_worker(job_id, stages):
+    close_old_connections()
+    try:
+        run_job(job_id, stages)
+    finally:
+        close_old_connections()
+
+
+
+# ジョブを実行待ちにする
+# 'inline'：その場で実行、'thread'：Webプロセス内のスレッドで実行、'db'：run_jobs コマンドのワーカーが実行
+def submit(job, stages):
+    backend = settings.ANALYSIS_JOB_BACKEND
+    if backend == 'inline':
+        run_job(job.pk, stages)
+    elif backend == 'thread':
+        # 保存がコミットされてからワーカーに渡す
+        transaction.on_commit(lambda: get_executor().submit(_run_in_worker, job.pk, stages))
+
+
+
+# submit の async 版(async のビューから呼ぶ。stages の関数は async の関数)
+# 'inline'：その場で実行、'thread'：イベントループのタスクで実行(レスポンスは終わるのを待たない)、'db'：run_jobs コマンドのワーカーが実行
+async def submit_async(job, stages):
+    backend = settings.ANALYSIS_JOB_BACKEND
+    if backend == 'inline':
+        await run_job_async(job.pk, stages)
+    elif backend == 'thread':
+        task = asyncio.ensure_future(run_job_async(job.pk, stages))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+
+# ANALYSIS_JOB_TIMEOUT 秒以上更新されていないジョブを失敗にする(やり直せるようにする)
+# 実行中のジョブ：ワーカーが止まった、Webプロセスを再起動した(段階ごとに更新するので、動いていれば更新される)
+# 待機中のジョブ：'db' 以外ではWebプロセス内で待っているだけなので、再起動すると実行されないまま残る
+# ('db' の待機中のジョブは、run_jobs のワーカーが動けば実行される)
+# 戻り値：失敗にしたジョブの数
+def fail_stale_jobs(queryset=None):
+    statuses = [AnalysisJob.RUNNING]
+    if settings.ANALYSIS_JOB_BACKEND != 'db':
+        statuses.append(AnalysisJob.QUEUED)
+    if queryset is None:
+        queryset = AnalysisJob.objects.all()
+    now = timezone.now()
+    return queryset.filter(
+        status__in=statuses, updated_at__lt=now - timedelta(seconds=settings.ANALYSIS_JOB_TIMEOUT),
+    ).update(status=AnalysisJob.FAILED, error=STALE_ERROR, updated_at=now)
+
+
+
+# job が止まっていれば失敗にする(進捗ページ、ポーリングから)
+def fail_if_stale(job):
+    if fail_stale_jobs(AnalysisJob.objects.filter(pk=job.pk)):
+        job.refresh_from_db()
+    return job
+
+
+
+# 待機中のジョブを1件取り出して実行中にする(他のワーカーと取り合わないように状態を条件に更新する)
+def claim_next_job(kinds):
+    while True:
+        job = AnalysisJob.objects.filter(status=AnalysisJob.QUEUED, kind__in=kinds).first()
+        if job is None:
+            return None
+        claimed = AnalysisJob.objects.filter(pk=job.pk, status=AnalysisJob.QUEUED).update(status=AnalysisJob.RUNNING)
+        if claimed:
+            return job
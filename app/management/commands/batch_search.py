@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from app import export, quota
+from app.forms import BatchKeywordForm, ORDER_CHOICES
+from app.quota import QuotaExceeded
+from app.rows import BatchKeywordRow
+from app.views import estimate_batch_units, get_channel, make_batch_df, search_keywords
+import sys
+
+
+
+# キーワード一括検索を実行し、結果をキーワード付きの1つの表として出力する
+class Command(BaseCommand):
+    help = '複数のキーワードをまとめて検索し、キーワードごとの動画をCSVなどで出力します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('keywords', nargs='*', help='検索キーワード')
+        parser.add_argument('--file', help='キーワードのファイル(1行に1つ)')
+        parser.add_argument('--items-count', type=int, default=12, help='キーワードごとの検索数')
+        parser.add_argument('--viewcount', type=int, default=0, help='この再生回数以上の動画だけにする')
+        parser.add_argument('--order', choices=list(ORDER_CHOICES), default='viewCount', help='並び順')
+        parser.add_argument('--start', type=date.fromisoformat, default=None, help='検索開始日(デフォルト：30日前)')
+        parser.add_argument('--end', type=date.fromisoformat, default=None, help='検索終了日(デフォルト：今日)')
+        parser.add_argument('--format', choices=list(export.FORMATS), default='csv', help='出力形式')
+        parser.add_argument('--output', help='出力先のファイル(デフォルト：標準出力)')
+
+    def handle(self, *args, **options):
+        keywords = list(options['keywords'])
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                keywords.extend(f.read().splitlines())
+
+        # フォームと同じ検証(空行と重複を除き、件数を確認)
+        end = options['end'] or date.today()
+        form = BatchKeywordForm({
+            'keywords': '\n'.join(keywords),
+            'items_count': options['items_count'],
+            'viewcount': options['viewcount'],
+            'order': options['order'],
+            'search_start': options['start'] or end - timedelta(days=30),
+            'search_end': end,
+        })
+        if not form.is_valid():
+            raise CommandError(' '.join(error for errors in form.errors.values() for error in errors))
+        if not export.is_available(options['format']):
+            raise CommandError('%s形式で出力するには %s をインストールしてください' % (
+                options['format'], '、'.join(export.REQUIRED_PACKAGES[options['format']])))
+
+        data = form.cleaned_data
+        try:
+            quota.ensure_available(estimate_batch_units(
+                data['keywords'], data['items_count'], data['viewcount'], data['order'], data['search_start'], data['search_end'],
+            ))
+            search_lists, count_list = search_keywords(
+                data['keywords'], data['items_count'], data['viewcount'], data['order'], data['search_start'], data['search_end'],
+            )
+        except QuotaExceeded as e:
+            raise CommandError(str(e))
+        videoid_list = {item[0]: item[1] for search_list in search_lists.values() for item in search_list}
+        youtube_data = make_batch_df(search_lists, get_channel(videoid_list), count_list, data['viewcount'])
+
+        chunks = export.WRITERS[options['format']](youtube_data, BatchKeywordRow)
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            self.stderr.write('%d件の動画を %s に出力しました' % (len(youtube_data), options['output']))
+        else:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    self.stdout.write(chunk, ending='')
+                else:
+                    sys.stdout.buffer.write(chunk)
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app import store
+
+
+
+# 保存済みの動画のうち、統計データが古いものだけ取り直す
+class Command(BaseCommand):
+    help = '統計データが古くなった保存済みの動画だけ、再生回数などを取り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=None,
+            help='この秒数より古い統計データを取り直す(デフォルト：YOUTUBE_STATISTICS_MAX_AGE)',
+        )
+
+    def handle(self, *args, **options):
+        max_age = options['max_age']
+        if max_age is None:
+            max_age = settings.YOUTUBE_STATISTICS_MAX_AGE
+        snapshots = store.refresh_statistics(max_age)
+        self.stdout.write('%d件の動画の統計データを更新しました' % len(snapshots))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from app import jobs
+from app.views import RELATED_STAGES
+import time
+
+
+# ジョブの種類ごとの段階
+JOB_STAGES = {
+    'related': RELATED_STAGES,
+}
+
+
+
+# ANALYSIS_JOB_BACKEND = 'db' の時に、待機中のジョブを実行するワーカー
+class Command(BaseCommand):
+    help = '待機中の分析ジョブ(関連動画検索など)を順番に実行します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='待機中のジョブがなくなったら終了する')
+        parser.add_argument('--interval', type=float, default=2.0, help='待機中のジョブがない時に待つ秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            # 前のワーカーが実行中に止まったジョブは失敗にする(やり直せるようにする)
+            stale = jobs.fail_stale_jobs()
+            if stale:
+                self.stderr.write('%d件の止まったジョブを失敗にしました' % stale)
+
+            job = jobs.claim_next_job(list(JOB_STAGES))
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            job = jobs.run_job(job.pk, JOB_STAGES[job.kind])
+            self.stdout.write('%s %s' % (job.pk, job.get_status_display()))
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from app import tracking
+import time
+
+
+
+# 設定したチャンネル(YOUTUBE_TRACKING)の新しいアップロード動画と統計データを定期的に保存する
+class Command(BaseCommand):
+    help = '自分とライバルのチャンネルを巡回し、新しい動画と再生回数などを保存します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_ids', nargs='*', help='巡回するチャンネルID(デフォルト：YOUTUBE_TRACKING の設定)')
+        parser.add_argument('--once', action='store_true', help='1回だけ巡回して終了する')
+        parser.add_argument('--interval', type=float, default=None, help='巡回の間隔(秒、デフォルト：YOUTUBE_TRACKING の INTERVAL)')
+        parser.add_argument('--max-videos', type=int, default=None, help='1チャンネルあたりの動画数')
+        parser.add_argument('--max-age', type=int, default=None, help='この秒数より古い統計データを取り直す')
+        parser.add_argument('--concurrency', type=int, default=None, help='同時に巡回するチャンネル数')
+
+    def handle(self, *args, **options):
+        channel_ids = options['channel_ids'] or tracking.tracked_channel_ids()
+        if not channel_ids:
+            raise CommandError('巡回するチャンネルがありません(YOUTUBE_TRACKING を設定してください)')
+        interval = options['interval']
+        if interval is None:
+            interval = settings.YOUTUBE_TRACKING['INTERVAL']
+
+        while True:
+            count = tracking.track_channels(
+                channel_ids,
+                max_videos=options['max_videos'],
+                max_age=options['max_age'],
+                concurrency=options['concurrency'],
+            )
+            self.stdout.write('%dチャンネルを巡回し、%d件の動画の統計データを保存しました' % (len(channel_ids), count))
+            if options['once']:
+                break
+            time.sleep(interval)
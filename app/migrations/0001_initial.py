@@ -0,0 +1,53 @@
+# Generated by Django 3.1.3 on 2026-10-18 20:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Channel',
+            fields=[
+                ('channel_id', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='チャンネルID')),
+                ('title', models.CharField(blank=True, max_length=255, verbose_name='チャンネル名')),
+                ('thumbnail_url', models.URLField(blank=True, max_length=500, verbose_name='プロフィール画像')),
+                ('fetched_at', models.DateTimeField(blank=True, null=True, verbose_name='取得日時')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Video',
+            fields=[
+                ('video_id', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='動画ID')),
+                ('title', models.CharField(max_length=255, verbose_name='動画タイトル')),
+                ('published_at', models.DateField(verbose_name='動画公開日')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='videos', to='app.channel', verbose_name='チャンネル')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VideoStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='取得日時')),
+                ('view_count', models.BigIntegerField(verbose_name='再生回数')),
+                ('like_count', models.BigIntegerField(blank=True, null=True, verbose_name='高評価数')),
+                ('favorite_count', models.BigIntegerField(blank=True, null=True, verbose_name='お気に入り数')),
+                ('comment_count', models.BigIntegerField(blank=True, null=True, verbose_name='コメント数')),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='app.video', verbose_name='動画')),
+            ],
+            options={
+                'get_latest_by': 'fetched_at',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='videostatistics',
+            index=models.Index(fields=['video', '-fetched_at'], name='app_videost_video_i_dfddf5_idx'),
+        ),
+    ]
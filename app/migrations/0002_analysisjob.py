@@ -0,0 +1,32 @@
+# Generated by Django 3.1.3 on 2026-10-18 20:49
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(max_length=50, verbose_name='種類')),
+                ('status', models.CharField(choices=[('queued', '待機中'), ('running', '実行中'), ('done', '完了'), ('failed', '失敗')], db_index=True, default='queued', max_length=20, verbose_name='状態')),
+                ('stage', models.CharField(blank=True, max_length=50, verbose_name='段階')),
+                ('progress', models.PositiveSmallIntegerField(default=0, verbose_name='進捗')),
+                ('params', models.JSONField(default=dict, verbose_name='パラメータ')),
+                ('results', models.JSONField(default=dict, verbose_name='結果')),
+                ('error', models.TextField(blank=True, verbose_name='エラー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
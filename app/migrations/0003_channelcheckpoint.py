@@ -0,0 +1,28 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelCheckpoint',
+            fields=[
+                ('channel', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='checkpoint', serialize=False, to='app.channel', verbose_name='チャンネル')),
+                ('uploads_playlist_id', models.CharField(blank=True, max_length=100, verbose_name='アップロード再生リストID')),
+                ('latest_video_id', models.CharField(blank=True, max_length=100, verbose_name='最新の動画ID')),
+                ('pending_video_id', models.CharField(blank=True, max_length=100, verbose_name='巡回中の最新の動画ID')),
+                ('page_token', models.CharField(blank=True, max_length=100, verbose_name='次のページ')),
+                ('pending_count', models.PositiveIntegerField(default=0, verbose_name='巡回中の動画数')),
+                ('covered_since', models.DateField(blank=True, null=True, verbose_name='保存済みの期間')),
+                ('crawled_at', models.DateTimeField(blank=True, null=True, verbose_name='巡回日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+        ),
+    ]
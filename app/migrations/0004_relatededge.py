@@ -0,0 +1,34 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_channelcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedEdge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='順位')),
+                ('fetched_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='取得日時')),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_edges', to='app.channel', verbose_name='関連動画のチャンネル')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_edges', to='app.video', verbose_name='元の動画')),
+                ('video', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_from', to='app.video', verbose_name='関連動画')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='relatededge',
+            index=models.Index(fields=['channel', 'source'], name='app_related_channel_1be4e1_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='relatededge',
+            constraint=models.UniqueConstraint(fields=('source', 'rank'), name='unique_related_rank'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_relatededge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SingleFlightLock',
+            fields=[
+                ('key', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='キー')),
+                ('expires_at', models.DateTimeField(verbose_name='期限')),
+            ],
+        ),
+    ]
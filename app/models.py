@@ -1,3 +1,145 @@
 from django.db import models
+from django.utils import timezone
+import uuid
 
-# Create your models here.
+
+
+# チャンネル
+class Channel(models.Model):
+    channel_id = models.CharField('チャンネルID', max_length=100, primary_key=True)
+    title = models.CharField('チャンネル名', max_length=255, blank=True)
+    thumbnail_url = models.URLField('プロフィール画像', max_length=500, blank=True)
+    # プロフィール画像を取得した日時
+    fetched_at = models.DateTimeField('取得日時', null=True, blank=True)
+
+    def __str__(self):
+        return self.title or self.channel_id
+
+
+
+# 動画
+class Video(models.Model):
+    video_id = models.CharField('動画ID', max_length=100, primary_key=True)
+    channel = models.ForeignKey(Channel, verbose_name='チャンネル', on_delete=models.CASCADE, related_name='videos')
+    title = models.CharField('動画タイトル', max_length=255)
+    published_at = models.DateField('動画公開日')
+
+    def __str__(self):
+        return self.title
+
+
+
+# 動画の統計データ(取得するたびに1件追加し、再生回数の推移を残す)
+class VideoStatistics(models.Model):
+    video = models.ForeignKey(Video, verbose_name='動画', on_delete=models.CASCADE, related_name='statistics')
+    fetched_at = models.DateTimeField('取得日時', default=timezone.now)
+    view_count = models.BigIntegerField('再生回数')
+    # 非公開の場合はNULL
+    like_count = models.BigIntegerField('高評価数', null=True, blank=True)
+    favorite_count = models.BigIntegerField('お気に入り数', null=True, blank=True)
+    comment_count = models.BigIntegerField('コメント数', null=True, blank=True)
+
+    class Meta:
+        get_latest_by = 'fetched_at'
+        indexes = [
+            models.Index(fields=['video', '-fetched_at']),
+        ]
+
+    def __str__(self):
+        return '%s (%s)' % (self.video_id, self.fetched_at)
+
+
+
+# 関連動画の一覧(元の動画 → 関連動画と順位)
+# 関連動画検索で取得した一覧は、自分のチャンネル以外の動画も全て残す(overlap で集計する)
+class RelatedEdge(models.Model):
+    source = models.ForeignKey(Video, verbose_name='元の動画', on_delete=models.CASCADE, related_name='related_edges')
+    video = models.ForeignKey(Video, verbose_name='関連動画', on_delete=models.CASCADE, related_name='related_from')
+    # 関連動画のチャンネル(集計で使うので、動画のチャンネルをここにも持っておく)
+    channel = models.ForeignKey(Channel, verbose_name='関連動画のチャンネル', on_delete=models.CASCADE, related_name='related_edges')
+    rank = models.PositiveSmallIntegerField('順位')
+    fetched_at = models.DateTimeField('取得日時', default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'rank'], name='unique_related_rank'),
+        ]
+        indexes = [
+            models.Index(fields=['channel', 'source']),
+        ]
+
+    def __str__(self):
+        return '%s -> %s (%d)' % (self.source_id, self.video_id, self.rank)
+
+
+
+# track_channels コマンドのチャンネルごとの巡回状況(中断してもここから再開する)
+class ChannelCheckpoint(models.Model):
+    channel = models.OneToOneField(Channel, verbose_name='チャンネル', on_delete=models.CASCADE, primary_key=True, related_name='checkpoint')
+    # アップロード動画の再生リスト
+    uploads_playlist_id = models.CharField('アップロード再生リストID', max_length=100, blank=True)
+    # 前回の巡回で見つけた一番新しい動画(次の巡回はここまで読み込む)
+    latest_video_id = models.CharField('最新の動画ID', max_length=100, blank=True)
+    # 巡回中の一番新しい動画、次に読み込むページ、読み込んだ動画数(巡回が終わったら空にする)
+    pending_video_id = models.CharField('巡回中の最新の動画ID', max_length=100, blank=True)
+    page_token = models.CharField('次のページ', max_length=100, blank=True)
+    pending_count = models.PositiveIntegerField('巡回中の動画数', default=0)
+    # この日以降の動画は全て保存済み(NULLは全ての動画)
+    covered_since = models.DateField('保存済みの期間', null=True, blank=True)
+    # 最後に巡回が終わった日時
+    crawled_at = models.DateTimeField('巡回日時', null=True, blank=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+    def __str__(self):
+        return str(self.channel)
+
+
+
+# 同じ検索の同時実行をまとめるための、ワーカー間のロック(singleflight)
+# キーは主キーなので、同じキーの行は1つのワーカーしか作成できない
+class SingleFlightLock(models.Model):
+    key = models.CharField('キー', max_length=255, primary_key=True)
+    # 実行中に止まったワーカーのロックは、この日時を過ぎたら他のワーカーが取り直す
+    expires_at = models.DateTimeField('期限')
+
+    def __str__(self):
+        return self.key
+
+
+
+# 関連動画検索などの時間のかかる分析(バックグラウンドで実行する)
+class AnalysisJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, '待機中'),
+        (RUNNING, '実行中'),
+        (DONE, '完了'),
+        (FAILED, '失敗'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField('種類', max_length=50)
+    status = models.CharField('状態', max_length=20, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    # 実行中の段階と進捗(%)
+    stage = models.CharField('段階', max_length=50, blank=True)
+    progress = models.PositiveSmallIntegerField('進捗', default=0)
+    # フォームの入力値
+    params = models.JSONField('パラメータ', default=dict)
+    # 段階ごとの結果(完了した段階はやり直さない)
+    results = models.JSONField('結果', default=dict)
+    error = models.TextField('エラー', blank=True)
+    created_at = models.DateTimeField('作成日時', auto_now_add=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.kind, self.id, self.status)
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
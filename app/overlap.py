@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Avg, Count, Max, Min
+from .models import RelatedEdge
+from .rows import CompetitorRow, MyVideoOverlapRow, RivalOverlapRow
+import hashlib
+
+
+
+# ==================================【関連動画の重なりの集計】=======================================
+# 保存済みの関連動画の一覧(RelatedEdge)から、自分の動画がどのライバルの動画の関連動画に出ているかを集計する
+# (元の動画が自分のチャンネルの一覧は除く)
+# 戻り値：(RivalOverlapRow のリスト(ヒット率の高い順), CompetitorRow のリスト(多い順、top_channels 件まで),
+#          MyVideoOverlapRow のリスト(ヒット数の多い順))
+def compute_overlap(my_channel_id, top_channels):
+    edges = RelatedEdge.objects.exclude(source__channel_id=my_channel_id)
+    mine = edges.filter(channel_id=my_channel_id)
+
+    # ライバルチャンネルごとの、一覧を取得したライバル動画の数と、自分の動画が出たライバル動画の数
+    sources = (
+        edges.values('source__channel_id', 'source__channel__title')
+        .annotate(sources=Count('source', distinct=True))
+        .order_by()
+    )
+    hits = {
+        row['source__channel_id']: row
+        for row in mine.values('source__channel_id')
+        .annotate(hits=Count('source', distinct=True), average_rank=Avg('rank'), best_rank=Min('rank'))
+        .order_by()
+    }
+    rival_rows = []
+    for row in sources:
+        hit = hits.get(row['source__channel_id'], {})
+        rival_rows.append(RivalOverlapRow(
+            channel_id=row['source__channel_id'],
+            channeltitle=row['source__channel__title'],
+            sources=row['sources'],
+            hits=hit.get('hits', 0),
+            hit_rate=round(hit.get('hits', 0) / row['sources'], 4),
+            average_rank=_round(hit.get('average_rank'), 1),
+            best_rank=hit.get('best_rank'),
+        ))
+    rival_rows.sort(key=lambda row: (-row.hit_rate, -row.sources, row.channel_id))
+
+    # 自分の動画が出た一覧に、一緒に出たチャンネル
+    hit_sources = sum(row.hits for row in rival_rows)
+    competitor_rows = [
+        CompetitorRow(
+            channel_id=row['channel_id'],
+            channeltitle=row['channel__title'],
+            sources=row['sources'],
+            share=round(row['sources'] / hit_sources, 4),
+            average_rank=_round(row['average_rank'], 1),
+        )
+        for row in edges.filter(source__in=mine.values('source')).exclude(channel_id=my_channel_id)
+        .values('channel_id', 'channel__title')
+        .annotate(sources=Count('source', distinct=True), average_rank=Avg('rank'))
+        .order_by('-sources', 'average_rank', 'channel_id')[:top_channels]
+    ]
+
+    # 自分の動画ごと、ライバルチャンネルごと
+    video_rows = [
+        MyVideoOverlapRow(
+            video_id=row['video_id'],
+            url='https://www.youtube.com/embed/' + row['video_id'],
+            title=row['video__title'],
+            rival_channel_id=row['source__channel_id'],
+            rival_channeltitle=row['source__channel__title'],
+            hits=row['hits'],
+            average_rank=_round(row['average_rank'], 1),
+            best_rank=row['best_rank'],
+        )
+        for row in mine.values('video_id', 'video__title', 'source__channel_id', 'source__channel__title')
+        .annotate(hits=Count('source', distinct=True), average_rank=Avg('rank'), best_rank=Min('rank'))
+        .order_by('-hits', 'average_rank', 'video_id', 'source__channel_id')
+    ]
+    return rival_rows, competitor_rows, video_rows
+
+
+
+def _round(value, digits):
+    return None if value is None else round(float(value), digits)
+
+
+
+# ==================================【集計結果のキャッシュ】=======================================
+# 関連動画の一覧が保存されるたびに新しいキーになる(一番新しい取得日時をキーに含める)
+def _cache():
+    return caches[settings.RELATED_OVERLAP['CACHE']]
+
+
+
+def _key(my_channel_id):
+    latest = RelatedEdge.objects.aggregate(latest=Max('fetched_at'))['latest']
+    return 'overlap:%s:%s' % (
+        hashlib.sha1(my_channel_id.encode('utf-8')).hexdigest(),
+        latest.timestamp() if latest else 0,
+    )
+
+
+
+# 自分のチャンネルの集計結果(なければ集計してキャッシュする)
+def get_overlap(my_channel_id):
+    key = _key(my_channel_id)
+    result = _cache().get(key)
+    if result is None:
+        result = compute_overlap(my_channel_id, settings.RELATED_OVERLAP['TOP_CHANNELS'])
+        _cache().set(key, result, settings.RELATED_OVERLAP['TIMEOUT'])
+    return result
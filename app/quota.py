@@ -0,0 +1,255 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from googleapiclient.errors import HttpError
+import json
+import logging
+import pytz
+import random
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# 1回の呼び出しで消費するクォータ(ユニット)
+QUOTA_COST = {
+    'search': 100,
+    'videos': 1,
+    'channels': 1,
+    'playlistItems': 1,
+}
+
+# クォータは太平洋時間の0時にリセットされる
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+
+# 記録する項目
+FIELDS = ('calls', 'units', 'errors', 'latency_ms')
+
+# 待てば回復するエラー(レート制限)と、その日はもう使えないエラー(クォータ切れ)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+QUOTA_EXCEEDED_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+
+
+
+# 1日の予算を超えるので呼び出さなかった(またはAPIがクォータ切れを返した)
+class QuotaExceeded(Exception):
+    pass
+
+
+
+# ==================================【使用量の記録】=======================================
+# ワーカー間で共有するため、YOUTUBE_QUOTA['CACHE'] のキャッシュに日ごとに記録する
+# (add、incr が不可分なキャッシュでないと、同時に記録した増分が消える。app.checks で確認する)
+# APIレスポンスと同じキャッシュにすると、あふれた時に使用量も消されるので、使用量だけのキャッシュにする
+def _cache():
+    return caches[settings.YOUTUBE_QUOTA['CACHE']]
+
+
+
+def quota_day():
+    return datetime.now(QUOTA_TIMEZONE).date()
+
+
+
+def _key(day, endpoint, field):
+    return 'youtube:quota:%s:%s:%s' % (day.isoformat(), endpoint, field)
+
+
+
+def _incr(key, delta):
+    cache = _cache()
+    # 2日分残す
+    timeout = 60 * 60 * 48
+    # LockedFileBasedCache は1回のロックで追加と加算を行う
+    if hasattr(cache, 'incr_or_add'):
+        cache.incr_or_add(key, delta, timeout)
+        return
+    # それ以外は add と incr を、どちらかが成功するまでくり返す(set は他のワーカーの増分を上書きするので使わない)
+    while not cache.add(key, delta, timeout):
+        try:
+            cache.incr(key, delta)
+            return
+        except ValueError: # add の後に消えた場合
+            pass
+
+
+
+def record(endpoint, latency, units, error=False):
+    day = quota_day()
+    _incr(_key(day, endpoint, 'calls'), 1)
+    _incr(_key(day, endpoint, 'units'), units)
+    _incr(_key(day, endpoint, 'latency_ms'), int(latency * 1000))
+    if error:
+        _incr(_key(day, endpoint, 'errors'), 1)
+
+
+
+# エンドポイントごとの使用量 {endpoint: {calls, units, errors, latency_ms, avg_latency_ms}}
+def usage(day=None):
+    day = day or quota_day()
+    keys = [_key(day, endpoint, field) for endpoint in QUOTA_COST for field in FIELDS]
+    values = _cache().get_many(keys)
+
+    result = {}
+    for endpoint in QUOTA_COST:
+        counts = {field: values.get(_key(day, endpoint, field), 0) for field in FIELDS}
+        counts['avg_latency_ms'] = counts['latency_ms'] / counts['calls'] if counts['calls'] else 0
+        result[endpoint] = counts
+    return result
+
+
+
+# その日に使ったクォータの合計
+def used_units(day=None):
+    day = day or quota_day()
+    values = _cache().get_many([_key(day, endpoint, 'units') for endpoint in QUOTA_COST])
+    return sum(values.values())
+
+
+
+# 1日の予算の残り(予備分を除く)
+def remaining_units():
+    config = settings.YOUTUBE_QUOTA
+    if _cache().get(_key(quota_day(), 'all', 'exhausted')):
+        return 0
+    return max(0, config['DAILY_BUDGET'] - config['RESERVE'] - used_units())
+
+
+
+# units 分のクォータが残っていなければ QuotaExceeded
+def ensure_available(units):
+    if units > remaining_units():
+        raise QuotaExceeded('YouTube APIの1日のクォータが足りません(必要：%d、残り：%d)' % (units, remaining_units()))
+
+
+
+# ==================================【レート制限】=======================================
+# トークンバケット(プロセス内)
+# レート制限のエラーが返ってきたら rate を半分にし、成功するたびに少しずつ元に戻す
+class TokenBucket:
+    def __init__(self, rate, burst, min_rate=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # トークンが1つ取れるまで待つ
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+
+def get_bucket():
+    global _bucket
+    if _bucket is None:
+        with _bucket_lock:
+            if _bucket is None:
+                config = settings.YOUTUBE_QUOTA
+                _bucket = TokenBucket(config['RATE'], config['BURST'])
+    return _bucket
+
+
+
+@receiver(setting_changed)
+def reset_bucket(setting, **kwargs):
+    global _bucket
+    if setting == 'YOUTUBE_QUOTA':
+        _bucket = None
+
+
+
+# ==================================【呼び出し】=======================================
+# HttpError の理由(errors[0].reason)
+def error_reason(error):
+    try:
+        return json.loads(error.content.decode('utf-8'))['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ''
+
+
+
+# サーバーの一時的なエラー(やり直せば成功する可能性がある)
+def is_transient(error):
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500
+    # 接続できない、タイムアウト(socket.timeout、requests の ConnectionError / Timeout)
+    return isinstance(error, OSError)
+
+
+
+# 予算を確認し、レート制限をかけて request() を実行し、使用量を記録する
+# レート制限(429、403 rateLimitExceeded)とサーバーの一時的なエラー(5xx、接続エラー、タイムアウト)の場合は
+# 間隔をあけてやり直す(BACKOFF 秒から1回ごとに2倍、ばらつきを付ける)
+def execute(endpoint, request):
+    config = settings.YOUTUBE_QUOTA
+    units = QUOTA_COST.get(endpoint, 1)
+    bucket = get_bucket()
+
+    for attempt in range(config['MAX_RETRIES'] + 1):
+        ensure_available(units)
+        bucket.acquire()
+
+        started = time.monotonic()
+        try:
+            result = request()
+        except HttpError as e:
+            # エラーでもクォータは消費される
+            record(endpoint, time.monotonic() - started, units, error=True)
+
+            reason = error_reason(e)
+            if e.resp.status == 403 and reason in QUOTA_EXCEEDED_REASONS:
+                # その日はもう呼び出さない
+                _cache().set(_key(quota_day(), 'all', 'exhausted'), True, 60 * 60 * 24)
+                raise QuotaExceeded('YouTube APIの1日のクォータを使い切りました') from e
+
+            rate_limited = e.resp.status == 429 or (e.resp.status == 403 and reason in RATE_LIMIT_REASONS)
+            if not (rate_limited or is_transient(e)) or attempt == config['MAX_RETRIES']:
+                raise
+            if rate_limited:
+                bucket.slow_down()
+            error = reason or e.resp.status
+        except OSError as e:
+            # レスポンスがないのでクォータは数えない
+            record(endpoint, time.monotonic() - started, 0, error=True)
+            if attempt == config['MAX_RETRIES']:
+                raise
+            error = type(e).__name__
+        else:
+            record(endpoint, time.monotonic() - started, units)
+            bucket.speed_up()
+            return result
+
+        wait = config['BACKOFF'] * (2 ** attempt) * random.uniform(0.5, 1.5)
+        logger.warning('YouTube API %s failed (%s), retrying in %.1fs', endpoint, error, wait)
+        time.sleep(wait)
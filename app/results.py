@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.cache import caches
+
+
+
+# ==================================【検索結果の保存】=======================================
+# 検索結果の表(table.ResultTable)を結果ID(検索条件のキー)で保存しておく
+# 並べ替え、絞り込み、ページ分けは保存した表から行うので、APIを呼び出さない
+def _cache():
+    return caches[settings.RESULT_SETS['CACHE']]
+
+
+
+def _key(result_id):
+    return 'results:' + result_id
+
+
+
+# kind：'keyword'(キーワード動画検索) または 'batch'(キーワード一括検索)
+# context：表示に使う検索条件など、partial：一部のデータを取得できなかったかどうか
+def save(result_id, kind, table, context, partial=False):
+    _cache().set(_key(result_id), {
+        'kind': kind,
+        'table': table,
+        'context': context,
+        'partial': partial,
+    }, settings.RESULT_SETS['TIMEOUT'])
+
+
+
+# 保存した検索結果(期限切れなら None)
+def load(result_id):
+    return _cache().get(_key(result_id))
+
+
+
+def exists(result_id):
+    return _key(result_id) in _cache()
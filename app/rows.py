@@ -0,0 +1,118 @@
+from datetime import date
+from typing import NamedTuple, Optional
+
+
+
+# テンプレートに渡す1行分のデータ
+# 行ごとに Series や辞書を作らず、表示する列だけを持つ軽いタプルにする
+
+# キーワード動画検索
+class KeywordRow(NamedTuple):
+    publishtime: str # 動画公開日
+    title: str # 動画タイトル
+    channeltitle: str # チャンネル名
+    url: str # 動画URL
+    profileImg: Optional[str] # プロフィール画像
+    viewcount: str # 再生回数
+    likeCount: str # 高評価数
+    favoriteCount: str # お気に入り数
+    commentCount: str # コメント数
+
+
+
+# キーワード一括検索(キーワード動画検索の行にキーワードを付けたもの)
+class BatchKeywordRow(NamedTuple):
+    keyword: str # 検索キーワード
+    publishtime: str # 動画公開日
+    title: str # 動画タイトル
+    channeltitle: str # チャンネル名
+    url: str # 動画URL
+    profileImg: Optional[str] # プロフィール画像
+    viewcount: str # 再生回数
+    likeCount: str # 高評価数
+    favoriteCount: str # お気に入り数
+    commentCount: str # コメント数
+
+
+
+# 関連動画検索
+class RelatedRow(NamedTuple):
+    ranking: int # ランキング
+    url: str # 動画URL
+    profileImg: Optional[str] # プロフィール画像
+    title: str # 動画タイトル
+    channeltitle: str # チャンネル名
+    viewcount: str # 再生回数
+    publishtime: str # 動画公開日
+    likeCount: str # 高評価数
+    favoriteCount: str # お気に入り数
+    commentCount: str # コメント数
+    rivalurl: str # ライバル動画URL
+    rivaltitle: str # ライバル動画タイトル
+    rivalchanneltitle: str # ライバルチャンネル名
+    rivalpublishtime: str # ライバル動画公開日
+
+
+
+# 再生回数の推移(動画ごと)
+class VideoGrowthRow(NamedTuple):
+    video_id: str # 動画ID
+    url: str # 動画URL
+    title: str # 動画タイトル
+    channel_id: str # チャンネルID
+    channeltitle: str # チャンネル名
+    published_at: date # 動画公開日
+    view_count: int # 再生回数(最新)
+    views_per_day: Optional[float] # 1日あたりの再生回数
+    like_ratio: Optional[float] # 高評価数 / 再生回数
+    comment_ratio: Optional[float] # コメント数 / 再生回数
+    acceleration: Optional[float] # 1日あたりの再生回数の1日あたりの増減
+    snapshots: int # 期間内の統計データの数
+
+
+
+# 再生回数の推移(チャンネルごと)
+class ChannelGrowthRow(NamedTuple):
+    channel_id: str # チャンネルID
+    channeltitle: str # チャンネル名
+    videos: int # 動画数
+    view_count: int # 再生回数の合計
+    views_per_day: Optional[float] # 1日あたりの再生回数の合計
+    like_ratio: Optional[float] # 高評価数 / 再生回数
+    comment_ratio: Optional[float] # コメント数 / 再生回数
+    acceleration: Optional[float] # 加速度の平均
+
+
+
+# 関連動画の重なり(ライバルチャンネルごと)
+class RivalOverlapRow(NamedTuple):
+    channel_id: str # ライバルチャンネルID
+    channeltitle: str # ライバルチャンネル名
+    sources: int # 関連動画の一覧を取得したライバル動画の数
+    hits: int # 自分の動画が関連動画に出たライバル動画の数
+    hit_rate: float # hits / sources
+    average_rank: Optional[float] # 自分の動画の平均順位
+    best_rank: Optional[int] # 自分の動画の最高順位
+
+
+
+# 関連動画の重なり(自分の動画と一緒に関連動画に出るチャンネル)
+class CompetitorRow(NamedTuple):
+    channel_id: str # チャンネルID
+    channeltitle: str # チャンネル名
+    sources: int # 自分の動画と一緒に出たライバル動画の数
+    share: float # sources / 自分の動画が出たライバル動画の数
+    average_rank: float # 平均順位
+
+
+
+# 関連動画の重なり(自分の動画とライバルチャンネルの組み合わせごと)
+class MyVideoOverlapRow(NamedTuple):
+    video_id: str # 動画ID
+    url: str # 動画URL
+    title: str # 動画タイトル
+    rival_channel_id: str # ライバルチャンネルID
+    rival_channeltitle: str # ライバルチャンネル名
+    hits: int # 関連動画に出たライバル動画の数
+    average_rank: float # 平均順位
+    best_rank: int # 最高順位
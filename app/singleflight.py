@@ -0,0 +1,174 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from datetime import timedelta
+from .models import SingleFlightLock
+import asyncio
+import threading
+import time
+
+
+# キャッシュに結果がない時の値(None も結果として扱う)
+_MISSING = object()
+
+
+
+# ==================================【同じ処理の同時実行をまとめる】=======================================
+# 同じキー(検索条件)の処理が実行中なら、新しく実行せずにその結果を待って使う
+# プロセス内はスレッド(またはイベントループ)の間で結果を共有し、
+# ワーカー間はDBのロック(SingleFlightLock)と、SINGLE_FLIGHT['CACHE'] に置いた結果で共有する
+# (ロックは主キーの一意制約で取るので、ファイルキャッシュなど add が不可分でないキャッシュでも2つのワーカーが同時に取ることはない)
+# 失敗した場合は、待っていたプロセス内の呼び出しにも同じ例外を出す(他のワーカーは自分で実行し直す)
+# share(結果) が False の結果(一部のデータを取得できなかった結果など)は、他のワーカーには渡さない
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+
+# {キー: 実行中の _Call}
+_calls = {}
+_calls_lock = threading.Lock()
+
+# {(イベントループ, キー): 実行中のタスク}
+_tasks = {}
+
+
+
+def run(key, func, share=None):
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _run_shared(key, func, share)
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        call.done.set()
+
+
+
+# run の async 版(func は async の関数。同じイベントループの中で1つのタスクを共有する)
+async def run_async(key, func, share=None):
+    loop = asyncio.get_running_loop()
+    task = _tasks.get((loop, key))
+    if task is None:
+        task = _tasks[(loop, key)] = asyncio.ensure_future(_run_shared_async(key, func, share))
+        task.add_done_callback(lambda task: _tasks.pop((loop, key), None))
+    # 待っている1つのリクエストが切断されても、共有しているタスクは止めない
+    return await asyncio.shield(task)
+
+
+
+# ==================================【ワーカー間の共有】=======================================
+def _cache():
+    return caches[settings.SINGLE_FLIGHT['CACHE']]
+
+
+
+def _result_key(key):
+    return 'singleflight:result:' + key
+
+
+
+# ロックの行を作成する(同じキーの行があれば IntegrityError で取れない)
+# 期限切れのロック(実行中に止まったワーカーのもの)は消してから取る
+def _lock(key):
+    now = timezone.now()
+    SingleFlightLock.objects.filter(key=key, expires_at__lt=now).delete()
+    try:
+        # 呼び出し元のトランザクションを壊さないように、セーブポイントの中で作成する
+        with transaction.atomic():
+            SingleFlightLock.objects.create(key=key, expires_at=now + timedelta(seconds=settings.SINGLE_FLIGHT['LOCK_TIMEOUT']))
+    except IntegrityError:
+        return False
+    return True
+
+
+
+# 他のワーカーの結果があれば (False, 結果)
+# なければロックを取り、取れたら (True, _MISSING)、他のワーカーが実行中なら (False, _MISSING)
+def _try_acquire(key):
+    cache = _cache()
+    result_key = _result_key(key)
+    result = cache.get(result_key, _MISSING)
+    if result is not _MISSING:
+        return False, result
+    if not _lock(key):
+        return False, _MISSING
+
+    # 結果を置いてロックを外した直後だった場合
+    result = cache.get(result_key, _MISSING)
+    if result is not _MISSING:
+        SingleFlightLock.objects.filter(key=key).delete()
+        return False, result
+    return True, _MISSING
+
+
+
+# 結果を他のワーカーに渡し、ロックを外す(失敗した場合は result=_MISSING)
+def _release(key, acquired, result=_MISSING):
+    if result is not _MISSING:
+        _cache().set(_result_key(key), result, settings.SINGLE_FLIGHT['RESULT_TIMEOUT'])
+    if acquired:
+        SingleFlightLock.objects.filter(key=key).delete()
+
+
+
+# 他のワーカーが実行中なら、結果が置かれるかロックが外れるまで待つ(LOCK_TIMEOUT 秒まで)
+def _run_shared(key, func, share):
+    config = settings.SINGLE_FLIGHT
+    deadline = time.monotonic() + config['LOCK_TIMEOUT']
+    while True:
+        acquired, result = _try_acquire(key)
+        if result is not _MISSING:
+            return result
+        if acquired or time.monotonic() > deadline:
+            break
+        time.sleep(config['POLL_INTERVAL'])
+
+    try:
+        result = func()
+    except BaseException:
+        _release(key, acquired)
+        raise
+    _release(key, acquired, result if share is None or share(result) else _MISSING)
+    return result
+
+
+
+async def _run_shared_async(key, func, share):
+    config = settings.SINGLE_FLIGHT
+    deadline = time.monotonic() + config['LOCK_TIMEOUT']
+    while True:
+        acquired, result = await sync_to_async(_try_acquire)(key)
+        if result is not _MISSING:
+            return result
+        if acquired or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(config['POLL_INTERVAL'])
+
+    try:
+        result = await func()
+    except BaseException:
+        await sync_to_async(_release)(key, acquired)
+        raise
+    await sync_to_async(_release)(key, acquired, result if share is None or share(result) else _MISSING)
+    return result
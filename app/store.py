@@ -0,0 +1,232 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery
+from django.utils import timezone
+from .models import Channel, ChannelCheckpoint, RelatedEdge, Video, VideoStatistics
+from . import youtube
+
+
+
+# 主キーで既存の行を判定し、新しい行は追加、既存の行は fields が変わったものだけ更新する
+def bulk_upsert(model, objects, fields):
+    objects = {obj.pk: obj for obj in objects}
+    if not objects:
+        return
+    model_fields = [model._meta.get_field(name) for name in fields]
+    existing = {
+        row[0]: row[1:]
+        for row in model.objects.filter(pk__in=list(objects)).values_list('pk', *[field.attname for field in model_fields])
+    }
+    model.objects.bulk_create(
+        [obj for pk, obj in objects.items() if pk not in existing],
+        batch_size=500,
+        # 同時に別のリクエストが追加した行は無視する
+        ignore_conflicts=True,
+    )
+    model.objects.bulk_update(
+        [
+            obj for pk, obj in objects.items()
+            if pk in existing and existing[pk] != tuple(
+                field.to_python(getattr(obj, field.attname)) for field in model_fields
+            )
+        ],
+        fields,
+        batch_size=500,
+    )
+
+
+
+# max_age秒より後の日時
+def _since(max_age):
+    return timezone.now() - timedelta(seconds=max_age)
+
+
+
+# ==================================【動画・チャンネル】=======================================
+# 検索した動画とそのチャンネルを保存する
+# videos：[動画ID, チャンネルID, チャンネル名, 動画タイトル, 動画公開日(YYYY-MM-DD)] のリスト
+def save_videos(videos):
+    videos = list(videos)
+    bulk_upsert(Channel, [
+        Channel(channel_id=channelid, title=channeltitle[:255])
+        for videoid, channelid, channeltitle, title, published_at in videos
+    ], ['title'])
+    bulk_upsert(Video, [
+        Video(video_id=videoid, channel_id=channelid, title=title[:255], published_at=published_at)
+        for videoid, channelid, channeltitle, title, published_at in videos
+    ], ['channel', 'title', 'published_at'])
+
+
+
+# channels().list の結果を保存する
+def save_channels(items):
+    now = timezone.now()
+    bulk_upsert(Channel, [
+        Channel(
+            channel_id=item['id'],
+            title=item['snippet'].get('title', '')[:255],
+            thumbnail_url=item['snippet']['thumbnails']['default']['url'],
+            fetched_at=now,
+        )
+        for item in items
+    ], ['title', 'thumbnail_url', 'fetched_at'])
+
+
+
+# 保存済みのプロフィール画像のうち、max_age秒以内に取得したもの {チャンネルID: URL}
+def channel_thumbnails(channel_ids, max_age=None):
+    if max_age is None:
+        max_age = settings.YOUTUBE_CHANNEL_MAX_AGE
+    return dict(
+        Channel.objects
+        .filter(pk__in=set(channel_ids), fetched_at__gte=_since(max_age))
+        .exclude(thumbnail_url='')
+        .values_list('channel_id', 'thumbnail_url')
+    )
+
+
+
+# track_channels で巡回済みのチャンネルの動画を、search().list(channelId=...) の代わりに返す
+# [動画ID, チャンネルID, チャンネル名, 動画タイトル, 動画公開日] のリスト(limit 件まで)
+# max_age秒以内に巡回していない、期間が巡回した範囲より前、並び順が日付・再生回数以外の場合は None
+def tracked_videos(channel_id, order, published_after, published_before, limit, max_age=None):
+    if max_age is None:
+        max_age = settings.YOUTUBE_TRACKING['MAX_AGE']
+    if order not in ('date', 'viewCount'):
+        return None
+    checkpoint = ChannelCheckpoint.objects.filter(channel_id=channel_id, crawled_at__gte=_since(max_age)).first()
+    if checkpoint is None or (checkpoint.covered_since and published_after < checkpoint.covered_since):
+        return None
+
+    videos = Video.objects.filter(
+        channel_id=channel_id, published_at__gte=published_after, published_at__lt=published_before,
+    ).select_related('channel')
+    if order == 'date':
+        videos = videos.order_by('-published_at', 'pk')
+    else:
+        # 最新の統計データの再生回数順
+        latest_view_count = VideoStatistics.objects.filter(video=OuterRef('pk')).order_by('-fetched_at').values('view_count')[:1]
+        videos = videos.annotate(view_count=Subquery(latest_view_count)).order_by(F('view_count').desc(nulls_last=True), 'pk')
+
+    return [
+        [video.video_id, video.channel_id, video.channel.title, video.title, video.published_at.isoformat()]
+        for video in videos[:limit]
+    ]
+
+
+
+# ==================================【関連動画の一覧】=======================================
+# 関連動画の一覧 {元の動画ID: [[動画ID, チャンネルID, チャンネル名, 動画タイトル, 公開日時], ...]} を順位と一緒に保存する
+# (youtube.fetch_related の結果。一覧の位置が順位、削除された動画なども順位は数える)
+# max_age 秒以内に保存した元の動画と、取得できなかった空の一覧は保存し直さない
+# 元の動画は保存済みのもの(ライバル動画は検索した時に save_videos で保存している)
+# 戻り値：保存した元の動画IDのリスト
+def save_related(related, max_age=None):
+    if max_age is None:
+        max_age = settings.YOUTUBE_CACHE['TTL']['related']
+    sources = set(Video.objects.filter(pk__in=[videoid for videoid, items in related.items() if items]).values_list('pk', flat=True))
+    sources -= set(
+        RelatedEdge.objects.filter(source_id__in=sources, fetched_at__gte=_since(max_age)).values_list('source_id', flat=True)
+    )
+    if not sources:
+        return []
+
+    # 関連動画とそのチャンネルも保存する
+    videos = {}
+    for source in sources:
+        for videoid, channelid, channeltitle, title, published_at in related[source]:
+            if videoid and channelid:
+                videos.setdefault(videoid, [videoid, channelid, channeltitle or '', title or '', published_at[:10]])
+    save_videos(videos.values())
+
+    fetched_at = timezone.now()
+    with transaction.atomic():
+        RelatedEdge.objects.filter(source_id__in=sources).delete()
+        RelatedEdge.objects.bulk_create([
+            RelatedEdge(source_id=source, video_id=item[0], channel_id=item[1], rank=rank, fetched_at=fetched_at)
+            for source in sources
+            for rank, item in enumerate(related[source], 1)
+            if item[0] and item[1]
+        ], batch_size=500, ignore_conflicts=True)
+    return list(sources)
+
+
+
+# ==================================【統計データ】=======================================
+# APIの statistics を数値にする(再生回数, 高評価数, お気に入り数, コメント数)
+# 高評価数、お気に入り数、コメント数が公開されてない場合はNone
+def parse_statistics(statistics):
+    try:
+        like_count = int(statistics['likeCount'])
+        favorite_count = int(statistics['favoriteCount'])
+        comment_count = int(statistics['commentCount'])
+    except KeyError:
+        like_count = None
+        favorite_count = None
+        comment_count = None
+    return int(statistics['viewCount']), like_count, favorite_count, comment_count
+
+
+
+# videos().list の結果(youtube.fetch_videos の FetchedItems)を統計データとして追加する(保存済みの動画のみ)
+# 今回APIから取得した項目だけを、取得した日時で保存する
+# (キャッシュや期限切れのキャッシュから返した項目は、取得した時に保存済みか、古い数値なので保存しない)
+def save_statistics(videos):
+    fetched_at = {
+        videoid: datetime.fromtimestamp(timestamp, timezone.utc)
+        for videoid, timestamp in videos.fetched_at.items()
+    }
+    known = set(Video.objects.filter(pk__in=list(fetched_at)).values_list('pk', flat=True))
+    snapshots = []
+    for videoid, item in videos.items():
+        if videoid not in known:
+            continue
+        view_count, like_count, favorite_count, comment_count = parse_statistics(item['statistics'])
+        snapshots.append(VideoStatistics(
+            video_id=videoid,
+            fetched_at=fetched_at[videoid],
+            view_count=view_count,
+            like_count=like_count,
+            favorite_count=favorite_count,
+            comment_count=comment_count,
+        ))
+    VideoStatistics.objects.bulk_create(snapshots, batch_size=500)
+    return snapshots
+
+
+
+# max_age秒以内に取得した最新の統計データ {動画ID: VideoStatistics}
+def latest_statistics(video_ids, max_age=None):
+    if max_age is None:
+        max_age = settings.YOUTUBE_STATISTICS_MAX_AGE
+    snapshots = {}
+    queryset = (
+        VideoStatistics.objects
+        .filter(video_id__in=set(video_ids), fetched_at__gte=_since(max_age))
+        .order_by('fetched_at')
+    )
+    for snapshot in queryset:
+        # 新しいもので上書きする
+        snapshots[snapshot.video_id] = snapshot
+    return snapshots
+
+
+
+# 最新の統計データが max_age秒より古い(またはまだない)動画のID
+def stale_video_ids(max_age=None, video_ids=None):
+    if max_age is None:
+        max_age = settings.YOUTUBE_STATISTICS_MAX_AGE
+    videos = Video.objects.annotate(last_fetched=Max('statistics__fetched_at')).filter(
+        Q(last_fetched__lt=_since(max_age)) | Q(last_fetched__isnull=True)
+    )
+    if video_ids is not None:
+        videos = videos.filter(pk__in=set(video_ids))
+    return list(videos.values_list('pk', flat=True))
+
+
+
+# 古くなった動画の統計データだけ取り直す
+def refresh_statistics(max_age=None, video_ids=None):
+    video_ids = stale_video_ids(max_age, video_ids)
+    return save_statistics(youtube.fetch_videos(video_ids))
@@ -0,0 +1,283 @@
+from typing import get_type_hints
+import numpy as np
+
+
+# 統計データを取得できなかった項目
+UNAVAILABLE = '?'
+
+# 高評価数、お気に入り数、コメント数が公開されていない項目
+HIDDEN = '-'
+
+# 統計データの列(再生回数, 高評価数, お気に入り数, コメント数)
+STATISTICS = ('viewcount', 'likeCount', 'favoriteCount', 'commentCount')
+
+# 行データのURLの項目と、その動画IDの列
+URL_COLUMNS = {
+    'url': 'video_id',
+    'rivalurl': 'rivalvideo_id',
+}
+
+EMBED_URL = 'https://www.youtube.com/embed/'
+
+
+
+# ==================================【列】=======================================
+# 列は次のどれか
+# ・IntColumn：int64 の配列と、値のない要素の mask(True)
+# ・CategoryColumn：同じ値の多い文字列(チャンネルID、チャンネル名など)を、値の一覧の番号にしたもの
+# ・datetime64[D] の配列(日付)
+# ・object の配列(動画タイトルなど、ほとんど重複しない文字列)
+class IntColumn:
+    def __init__(self, values, mask):
+        self.values = values
+        self.mask = mask
+
+    # None は値なし(保存済みのジョブの結果などの文字列は、数字以外('-'、'?')を値なしにする)
+    @classmethod
+    def from_values(cls, values):
+        values = [_to_int(value) for value in values]
+        return cls(
+            np.fromiter((0 if value is None else value for value in values), np.int64, len(values)),
+            np.fromiter((value is None for value in values), bool, len(values)),
+        )
+
+    @classmethod
+    def concat(cls, columns):
+        return cls(np.concatenate([c.values for c in columns]), np.concatenate([c.mask for c in columns]))
+
+    def __len__(self):
+        return len(self.values)
+
+    def take(self, index):
+        return IntColumn(self.values[index], self.mask[index])
+
+    # 並べ替えのキー(値のない要素は最後)
+    def sort_key(self, descending):
+        values = -self.values if descending else self.values
+        return np.where(self.mask, np.iinfo(np.int64).max, values)
+
+    def to_list(self, null=None):
+        values = self.values.astype(object)
+        values[self.mask] = null
+        return values.tolist()
+
+
+
+def _to_int(value):
+    if isinstance(value, str):
+        return int(value) if value.isdigit() else None
+    return value
+
+
+
+class CategoryColumn:
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    # None は -1
+    @classmethod
+    def from_values(cls, values):
+        index = {}
+        codes = [-1 if value is None else index.setdefault(value, len(index)) for value in values]
+        return cls(np.array(codes, dtype=np.int32), _object_array(index))
+
+    # 全ての値が同じ列
+    @classmethod
+    def repeat(cls, value, length):
+        return cls(np.zeros(length, dtype=np.int32), _object_array([value]))
+
+    # 値の一覧をまとめ、番号を付け直してつなげる
+    @classmethod
+    def concat(cls, columns):
+        index = {}
+        codes = []
+        for column in columns:
+            mapping = np.array([index.setdefault(value, len(index)) for value in column.categories] + [-1], dtype=np.int32)
+            codes.append(mapping[column.codes])
+        return cls(np.concatenate(codes), _object_array(index))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def take(self, index):
+        return CategoryColumn(self.codes[index], self.categories)
+
+    def sort_key(self, descending):
+        order = np.argsort(self.categories.astype(str), kind='stable')
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        values = ranks[self.codes] if len(order) else np.zeros(len(self.codes), dtype=np.int64)
+        # None は最後
+        return np.where(self.codes < 0, len(order), -values if descending else values)
+
+    def to_list(self, null=None):
+        return np.append(self.categories, _object_array([null]))[self.codes].tolist()
+
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = list(values)
+    return array
+
+
+
+# 'YYYY-MM-DD' の文字列のリストを日付の列にする
+def date_column(values):
+    return np.array(list(values), dtype='datetime64[D]')
+
+
+
+def string_column(values):
+    return _object_array(list(values))
+
+
+
+def _take(column, index):
+    return column[index] if isinstance(column, np.ndarray) else column.take(index)
+
+
+
+def _concat(columns):
+    if isinstance(columns[0], np.ndarray):
+        return np.concatenate(columns)
+    return type(columns[0]).concat(columns)
+
+
+
+# 統計データのリスト([動画ID, 再生回数, 高評価数, お気に入り数, コメント数])を統計データの列にする
+def statistics_columns(count_list):
+    return {
+        name: IntColumn.from_values([item[position] for item in count_list])
+        for position, name in enumerate(STATISTICS, start=1)
+    }
+
+
+
+# ==================================【検索結果の表】=======================================
+# 検索結果を行ごとのタプルではなく、列ごとの配列で持つ
+# 絞り込み、並べ替え、集計は配列の計算でまとめて行い、行データ(row_type の NamedTuple)は表示する時に作る
+# (行データの項目は列名と同じ。url、rivalurl は動画IDの列から作る)
+class ResultTable:
+    def __init__(self, row_type, columns):
+        self.row_type = row_type
+        self.columns = columns
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    # 番号なら行データ、スライスや配列なら表
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            raise KeyError(key)
+        if isinstance(key, (int, np.integer)):
+            return self.rows(np.array([key]))[0]
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+        return self.take(key)
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __eq__(self, other):
+        if not isinstance(other, ResultTable):
+            return NotImplemented
+        return self.row_type is other.row_type and self.rows() == other.rows()
+
+    def take(self, index):
+        return ResultTable(self.row_type, {name: _take(column, index) for name, column in self.columns.items()})
+
+    # mask が True の行だけにする
+    def filter(self, mask):
+        return self.take(np.flatnonzero(mask))
+
+    # name の列の値が low 以上、high 以下の行だけにする(None の条件は使わない)
+    # 条件を使う場合、値のない行(統計データを取得できなかった動画など)は除く
+    def between(self, name, low=None, high=None):
+        if low is None and high is None:
+            return self
+        column = self.columns[name]
+        if isinstance(column, IntColumn):
+            values, mask = column.values, ~column.mask
+        else:
+            # 日付の列(low、high は date)
+            values, mask = column, ~np.isnat(column)
+            low = None if low is None else np.datetime64(low, 'D')
+            high = None if high is None else np.datetime64(high, 'D')
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return self.filter(mask)
+
+    # name の列の順に並べる(同じ値は今の順番のまま。値のない行は最後)
+    def sort(self, name, descending=False):
+        column = self.columns[name]
+        if isinstance(column, np.ndarray):
+            if column.dtype == object:
+                key = np.unique(column.astype(str), return_inverse=True)[1]
+            else:
+                key = column.astype(np.int64)
+            key = -key if descending else key
+        else:
+            key = column.sort_key(descending)
+        return self.take(np.argsort(key, kind='stable'))
+
+    # 列を追加した(置き換えた)表
+    def assign(self, row_type=None, **columns):
+        return ResultTable(row_type or self.row_type, dict(self.columns, **columns))
+
+    @classmethod
+    def concat(cls, row_type, tables):
+        tables = [table for table in tables if table.columns]
+        if not tables:
+            return cls(row_type, {})
+        return cls(row_type, {
+            name: _concat([table.columns[name] for table in tables]) for name in tables[0].columns
+        })
+
+    # by(CategoryColumn)の値ごとの [(値, 行数, name(IntColumn)の合計)](値のない要素は合計に含めない)
+    def sum_by(self, by, name):
+        if not self.columns:
+            return []
+        group = self.columns[by]
+        column = self.columns[name]
+        counts = np.bincount(group.codes[group.codes >= 0], minlength=len(group.categories))
+        totals = np.zeros(len(group.categories), dtype=np.int64)
+        valid = ~column.mask & (group.codes >= 0)
+        np.add.at(totals, group.codes[valid], column.values[valid])
+        return list(zip(group.categories.tolist(), counts.tolist(), totals.tolist()))
+
+    # 行データのリスト(index：行番号の配列。省略したら全ての行)
+    def rows(self, index=None):
+        table = self if index is None else self.take(index)
+        if not table.columns:
+            return []
+        hints = get_type_hints(self.row_type)
+        return [self.row_type._make(values) for values in zip(*[
+            table._field(name, hints[name]) for name in self.row_type._fields
+        ])]
+
+    # 行データの1項目分の値のリスト
+    def _field(self, name, hint):
+        if name in URL_COLUMNS:
+            return [EMBED_URL + videoid for videoid in self._field(URL_COLUMNS[name], str)]
+        column = self.columns[name]
+        if isinstance(column, IntColumn):
+            if hint is int:
+                return column.to_list()
+            values = column.values.astype(str).astype(object)
+            if name in STATISTICS:
+                # 再生回数がない行は取得できなかった行、再生回数だけある行は非公開
+                unavailable = self.columns['viewcount'].mask
+                values[column.mask] = HIDDEN
+                values[unavailable] = UNAVAILABLE
+            else:
+                values[column.mask] = None
+            return values.tolist()
+        if isinstance(column, CategoryColumn):
+            return column.to_list()
+        if column.dtype.kind == 'M':
+            return np.datetime_as_string(column, unit='D').tolist()
+        return column.tolist()
@@ -0,0 +1,357 @@
+from collections import Counter
+from datetime import date, timedelta
+from googleapiclient.errors import HttpError
+from .cache import ResponseCache
+import copy
+import httplib2
+import json
+import re
+import threading
+import time
+import zlib
+
+
+
+# ==================================【YouTube APIの代わり(テスト、ベンチマーク用)】=======================================
+# get_client() の代わりに使うクライアント
+# 記録したレスポンス(responses)があればそれを返し、なければ検索条件から決まったデータを作って返す
+# latency：1回の呼び出しにかかる秒数
+# total_results：キーワード検索でヒットする件数、channel_videos：1チャンネルの動画数
+# related_results：関連動画の件数、my_channel_id は関連動画の3件に1件に出てくる
+# shared_results：キーワード検索の上位のうち、どのキーワードでもヒットする件数
+class FakeYouTube:
+    def __init__(self, latency=0.0, total_results=500, channel_videos=200, related_results=50,
+                 channel_count=20, my_channel_id='UCmychannel', shared_results=0, responses=None):
+        self.latency = latency
+        self.total_results = total_results
+        self.channel_videos = channel_videos
+        self.related_results = related_results
+        self.channel_count = channel_count
+        self.my_channel_id = my_channel_id
+        self.shared_results = shared_results
+        # {キャッシュキー: レスポンス}
+        self.responses = responses or {}
+        # エンドポイントごとの呼び出し回数と、呼び出したパラメータ
+        self.calls = Counter()
+        self.requests = []
+        # {エンドポイント: [次の呼び出しから順に出す例外]}(fail() で設定する)
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    # RecordingClient.save() で保存したファイルから作成する
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, encoding='utf-8') as f:
+            records = json.load(f)
+        responses = {
+            ResponseCache.make_key(record['endpoint'], record['params']): record['response']
+            for record in records
+        }
+        return cls(responses=responses, **kwargs)
+
+    def __getattr__(self, endpoint):
+        if endpoint.startswith('_'):
+            raise AttributeError(endpoint)
+        return lambda: _FakeResource(self, endpoint)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.requests.clear()
+            self.errors.clear()
+
+    # endpoint の次の呼び出しから順に errors の例外を出す
+    def fail(self, endpoint, *errors):
+        with self._lock:
+            self.errors.setdefault(endpoint, []).extend(errors)
+
+    def respond(self, endpoint, params):
+        with self._lock:
+            self.calls[endpoint] += 1
+            self.requests.append((endpoint, params))
+            error = self.errors[endpoint].pop(0) if self.errors.get(endpoint) else None
+        if self.latency:
+            time.sleep(self.latency)
+        if error is not None:
+            raise error
+
+        key = ResponseCache.make_key(endpoint, params)
+        if key in self.responses:
+            return copy.deepcopy(self.responses[key])
+        result = getattr(self, '_' + endpoint)(params)
+        # 本物のAPIと同じく、fields を指定したら その項目だけを返す
+        if params.get('fields'):
+            result = apply_fields(result, parse_fields(params['fields']))
+        return result
+
+    # ==================================【データの作成】=======================================
+    @staticmethod
+    def _number(text, modulo):
+        return zlib.crc32(text.encode('utf-8')) % modulo
+
+    def _search_item(self, videoid, channelid, params):
+        published = (params.get('publishedAfter') or '2023-01-01T00:00:00Z')[:10]
+        return {
+            'kind': 'youtube#searchResult',
+            'id': {'kind': 'youtube#video', 'videoId': videoid},
+            'snippet': {
+                'publishedAt': published + 'T00:00:00Z',
+                'channelId': channelid,
+                'title': 'Video %s' % videoid,
+                'description': 'Description of %s' % videoid,
+                'thumbnails': {'default': {'url': 'https://i.ytimg.com/vi/%s/default.jpg' % videoid}},
+                'channelTitle': 'Channel %s' % channelid,
+            },
+        }
+
+    def _search(self, params):
+        offset = int(params.get('pageToken') or 0)
+        size = int(params.get('maxResults', 5))
+
+        if 'relatedToVideoId' in params:
+            source = params['relatedToVideoId']
+            total = self.related_results
+
+            def make(index):
+                channelid = self.my_channel_id if index % 3 == 1 else 'UCchannel%d' % ((index + len(source)) % self.channel_count)
+                return self._search_item('%s-rel%d' % (source, index), channelid, params)
+        elif 'channelId' in params:
+            channelid = params['channelId']
+            total = self.channel_videos
+
+            def make(index):
+                return self._search_item('%s-v%d' % (channelid, index), channelid, params)
+        else:
+            prefix = 'k%d' % self._number(params.get('q', ''), 10000)
+            total = self.total_results
+
+            def make(index):
+                videoid = 'shared-%d' % index if index < self.shared_results else '%s-%d' % (prefix, index)
+                return self._search_item(videoid, 'UCchannel%d' % (index % self.channel_count), params)
+
+        end = min(total, offset + size)
+        result = {
+            'kind': 'youtube#searchListResponse',
+            'pageInfo': {'totalResults': total, 'resultsPerPage': size},
+            'items': [make(index) for index in range(offset, end)],
+        }
+        if end < total:
+            result['nextPageToken'] = str(end)
+        return result
+
+    def _videos(self, params):
+        items = []
+        for videoid in params['id'].split(','):
+            statistics = {'viewCount': str(self._number(videoid, 100000))}
+            # 10本に1本は高評価数などを非公開にする
+            if self._number(videoid, 10):
+                statistics.update({
+                    'likeCount': str(self._number(videoid + 'like', 1000)),
+                    'dislikeCount': '0',
+                    'favoriteCount': '0',
+                    'commentCount': str(self._number(videoid + 'comment', 100)),
+                })
+            items.append({'kind': 'youtube#video', 'id': videoid, 'statistics': statistics})
+        return {'kind': 'youtube#videoListResponse', 'items': items}
+
+    # アップロード動画の再生リスト(新しい順、動画IDは古い順に v0, v1, ...)
+    def _playlistItems(self, params):
+        channelid = 'UC' + params['playlistId'][2:]
+        offset = int(params.get('pageToken') or 0)
+        size = int(params.get('maxResults', 5))
+        total = self.channel_videos
+
+        items = []
+        for index in range(offset, min(total, offset + size)):
+            number = total - 1 - index
+            videoid = '%s-v%d' % (channelid, number)
+            items.append({
+                'kind': 'youtube#playlistItem',
+                'id': 'item-%s' % videoid,
+                'snippet': {
+                    'publishedAt': (date(2020, 1, 1) + timedelta(days=number)).isoformat() + 'T00:00:00Z',
+                    'channelId': channelid,
+                    'title': 'Video %s' % videoid,
+                    'channelTitle': 'Channel %s' % channelid,
+                    'playlistId': params['playlistId'],
+                    'position': index,
+                },
+                'contentDetails': {
+                    'videoId': videoid,
+                    'videoPublishedAt': (date(2020, 1, 1) + timedelta(days=number)).isoformat() + 'T00:00:00Z',
+                },
+            })
+
+        result = {
+            'kind': 'youtube#playlistItemListResponse',
+            'pageInfo': {'totalResults': total, 'resultsPerPage': size},
+            'items': items,
+        }
+        if offset + size < total:
+            result['nextPageToken'] = str(offset + size)
+        return result
+
+    def _channels(self, params):
+        items = []
+        for channelid in params['id'].split(','):
+            items.append({
+                'kind': 'youtube#channel',
+                'id': channelid,
+                'snippet': {
+                    'title': 'Channel %s' % channelid,
+                    'description': 'Description of %s' % channelid,
+                    'publishedAt': date(2020, 1, 1).isoformat() + 'T00:00:00Z',
+                    'thumbnails': {
+                        'default': {'url': 'https://yt3.ggpht.com/%s=s88' % channelid},
+                        'medium': {'url': 'https://yt3.ggpht.com/%s=s240' % channelid},
+                        'high': {'url': 'https://yt3.ggpht.com/%s=s800' % channelid},
+                    },
+                },
+                'contentDetails': {
+                    'relatedPlaylists': {'likes': '', 'uploads': 'UU' + channelid[2:]},
+                },
+            })
+        return {'kind': 'youtube#channelListResponse', 'items': items}
+
+
+
+# ==================================【fields パラメータ】=======================================
+_FIELD_NAME = re.compile(r'[A-Za-z0-9_]+')
+
+
+
+# fields パラメータ(例：'nextPageToken,items(id,snippet/title)')を {項目: 下の階層(全部なら None)} にする
+def parse_fields(text):
+    tree, position = _parse_selection(text, 0)
+    if position != len(text):
+        raise ValueError('invalid fields: %s' % text)
+    return tree
+
+
+
+# コンマ区切りの項目
+def _parse_selection(text, position):
+    tree = {}
+    while True:
+        name, subtree, position = _parse_field(text, position)
+        tree[name] = _merge_fields(tree[name], subtree) if name in tree else subtree
+        if position < len(text) and text[position] == ',':
+            position += 1
+        else:
+            return tree, position
+
+
+
+# 1つの項目(a、a/b、a(b,c))
+def _parse_field(text, position):
+    match = _FIELD_NAME.match(text, position)
+    if match is None:
+        raise ValueError('invalid fields: %s' % text)
+    position = match.end()
+    if text.startswith('/', position):
+        name, subtree, position = _parse_field(text, position + 1)
+        return match.group(), {name: subtree}, position
+    if text.startswith('(', position):
+        subtree, position = _parse_selection(text, position + 1)
+        if not text.startswith(')', position):
+            raise ValueError('invalid fields: %s' % text)
+        return match.group(), subtree, position + 1
+    return match.group(), None, position
+
+
+
+def _merge_fields(tree, other):
+    if tree is None or other is None:
+        return None
+    merged = dict(tree)
+    for name, subtree in other.items():
+        merged[name] = _merge_fields(merged[name], subtree) if name in merged else subtree
+    return merged
+
+
+
+# レスポンスを parse_fields() の項目だけにする(リストは要素ごとに)
+def apply_fields(data, tree):
+    if tree is None:
+        return data
+    if isinstance(data, list):
+        return [apply_fields(item, tree) for item in data]
+    if isinstance(data, dict):
+        return {name: apply_fields(data[name], subtree) for name, subtree in tree.items() if name in data}
+    return data
+
+
+
+# APIのエラーレスポンス(status：HTTPステータス、reason：errors[0].reason)
+def http_error(status, reason=''):
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+
+class _FakeResource:
+    def __init__(self, client, endpoint):
+        self.client = client
+        self.endpoint = endpoint
+
+    def list(self, **params):
+        return _FakeRequest(self.client, self.endpoint, params)
+
+
+
+class _FakeRequest:
+    def __init__(self, client, endpoint, params):
+        self.client = client
+        self.endpoint = endpoint
+        self.params = params
+
+    def execute(self, http=None, num_retries=0):
+        return self.client.respond(self.endpoint, self.params)
+
+
+
+# ==================================【レスポンスの記録】=======================================
+# 本物のクライアントを包み、呼び出しとレスポンスを記録する(FakeYouTube.load() で再生する)
+class RecordingClient:
+    def __init__(self, client):
+        self.client = client
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, endpoint):
+        resource = getattr(self.client, endpoint)
+        return lambda: _RecordingResource(self, endpoint, resource())
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=2)
+
+
+
+class _RecordingResource:
+    def __init__(self, recorder, endpoint, resource):
+        self.recorder = recorder
+        self.endpoint = endpoint
+        self.resource = resource
+
+    def list(self, **params):
+        return _RecordingRequest(self.recorder, self.endpoint, params, self.resource.list(**params))
+
+
+
+class _RecordingRequest:
+    def __init__(self, recorder, endpoint, params, request):
+        self.recorder = recorder
+        self.endpoint = endpoint
+        self.params = params
+        self.request = request
+
+    def execute(self, **kwargs):
+        response = self.request.execute(**kwargs)
+        with self.recorder._lock:
+            self.recorder.records.append({
+                'endpoint': self.endpoint,
+                'params': self.params,
+                'response': response,
+            })
+        return response
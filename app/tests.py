@@ -1,3 +1,1639 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from datetime import date, datetime, timedelta
+from googleapiclient.http import HttpRequest
+from googleapiclient.model import JsonModel
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
+import asyncio
+import gzip
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from .cache import FileBackend, LocMemBackend, LockedFileBasedCache, ResponseCache, get_response_cache
+from .concurrency import fan_out, fan_out_flat
+from .forms import RelatedForm
+from .models import AnalysisJob, Channel, ChannelCheckpoint, RelatedEdge, SingleFlightLock, Video, VideoStatistics
+from .quota import QUOTA_COST, QuotaExceeded
+from .rows import BatchKeywordRow, KeywordRow, RelatedRow
+from .table import CategoryColumn, ResultTable
+from .testing import FakeYouTube, http_error, parse_fields
+from .views import make_df
+from . import checks, export, growth, jobs, overlap, quota, results, singleflight, store, tracing, transport, urls, views, youtube
 
-# Create your tests here.
+
+LOCMEM = 'django.core.cache.backends.locmem.LocMemCache'
+
+TEST_CACHES = {
+    'default': {'BACKEND': LOCMEM, 'LOCATION': 'test-default'},
+    'template_fragments': {'BACKEND': LOCMEM, 'LOCATION': 'test-template-fragments'},
+    'youtube': {'BACKEND': LOCMEM, 'LOCATION': 'test-youtube'},
+    'quota': {'BACKEND': LOCMEM, 'LOCATION': 'test-quota'},
+}
+
+# APIレスポンスのキャッシュはプロセス内にする(ファイルのキャッシュは ResponseCacheTests で一時ディレクトリに作る)
+TEST_YOUTUBE_CACHE = dict(settings.YOUTUBE_CACHE, BACKEND='locmem')
+
+KEYWORD_FORM = {
+    'keyword': 'python',
+    'items_count': 12,
+    'viewcount': 0,
+    'order': 'viewCount',
+    'search_start': '2023-01-01',
+    'search_end': '2023-02-01',
+}
+
+RELATED_FORM = {
+    'my_channel_id': 'UCmychannel',
+    'rival_channel_id': 'UCrival1,UCrival2',
+    'rival_items_count': 3,
+    'rival_order': 'viewCount',
+    'rival_search_start': '2023-01-01',
+    'rival_search_end': '2023-02-01',
+    'related_items_count': 6,
+}
+
+
+
+# YouTube APIの代わりに FakeYouTube を使う
+@override_settings(CACHES=TEST_CACHES, YOUTUBE_CACHE=TEST_YOUTUBE_CACHE, ANALYSIS_JOB_BACKEND='inline')
+class YouTubeTestCase(TestCase):
+    def setUp(self):
+        for alias in TEST_CACHES:
+            caches[alias].clear()
+        get_response_cache().clear()
+
+        self.youtube = FakeYouTube()
+        client = youtube.use_client(self.youtube)
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+
+
+
+class KeywordSearchTests(YouTubeTestCase):
+    def test_search_renders_results(self):
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['youtube_data']), 12)
+        self.assertEqual(self.youtube.calls, {'search': 1, 'videos': 1, 'channels': 1})
+
+    def test_lookups_are_batched(self):
+        # 120件：検索は3ページ、統計データもページごとに1回、チャンネル(20件)は1回
+        response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=120))
+
+        self.assertEqual(len(response.context['youtube_data']), 120)
+        self.assertEqual(self.youtube.calls, {'search': 3, 'videos': 3, 'channels': 1})
+        self.assertEqual(VideoStatistics.objects.count(), 120)
+
+    def test_viewcount_filter(self):
+        response = self.client.post(reverse('index'), dict(KEYWORD_FORM, viewcount=50000))
+
+        youtube_data = response.context['youtube_data']
+        self.assertEqual(len(youtube_data), 12)
+        self.assertTrue(all(int(row.viewcount) >= 50000 for row in youtube_data))
+
+    def test_search_limit_is_clamped(self):
+        with self.settings(YOUTUBE_SEARCH_MAX_RESULTS=100):
+            self.assertEqual(views.keyword_search_limit(60, 0), 60)
+            self.assertEqual(views.keyword_search_limit(150, 0), 100)
+            self.assertEqual(views.keyword_search_limit(60, 1000), 100)
+            self.assertEqual(views.keyword_search_limit(150, 1000), 100)
+
+        # フォームでも最大件数を超える検索数は受け付けない
+        for items_count in (0, settings.YOUTUBE_SEARCH_MAX_RESULTS + 1):
+            response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=items_count))
+            self.assertRedirects(response, reverse('index'))
+        self.assertEqual(self.youtube.calls, {})
+
+    def test_duplicates_across_pages_are_counted_once(self):
+        # 2ページ目以降は前のページの最後の10件から始まる(ページの境目の動画が重複する)
+        search = self.youtube._search
+
+        def overlapping(params):
+            if params.get('pageToken'):
+                params = dict(params, pageToken=str(int(params['pageToken']) - 10))
+            return search(params)
+
+        self.youtube._search = overlapping
+        form = dict(KEYWORD_FORM, items_count=60, viewcount=1)
+
+        response = self.client.post(reverse('index'), form)
+        videoids = [row.url for row in response.context['youtube_data']]
+        self.assertEqual(len(videoids), 60)
+        self.assertEqual(len(set(videoids)), 60)
+
+        with override_settings(ROOT_URLCONF=AsyncUrls):
+            caches['template_fragments'].clear()
+            get_response_cache().clear()
+            response = self.client.post(reverse('index'), form)
+        self.assertEqual([row.url for row in response.context['youtube_data']], videoids)
+
+        response = self.client.post(reverse('batch'), dict(form, keywords='python\ndjango'))
+        totals = {keyword: count for keyword, count, views in response.context['keyword_totals']}
+        self.assertEqual(totals, {'python': 60, 'django': 60})
+
+    def test_repeated_search_uses_cache(self):
+        self.client.post(reverse('index'), KEYWORD_FORM)
+        caches['template_fragments'].clear()
+        self.youtube.reset()
+
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+
+        self.assertEqual(len(response.context['youtube_data']), 12)
+        self.assertEqual(sum(self.youtube.calls.values()), 0)
+
+    # 表示結果がキャッシュ済みなら表を絞り込まず、キャッシュが切れていれば保存済みの検索結果から描画する
+    # (キャッシュ済みかどうかを描画の前に決めないので、その間に期限が切れても空のページにならない)
+    def test_rendering_follows_fragment_cache(self):
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+        url = response.context['youtube_data'][0].url
+        self.youtube.reset()
+
+        with mock.patch('app.views.filter_results', wraps=views.filter_results) as filter_results:
+            response = self.client.post(reverse('index'), KEYWORD_FORM)
+        self.assertEqual(filter_results.call_count, 0)
+        self.assertContains(response, url)
+
+        # 描画の直前に期限が切れた場合
+        load, exists = results.load, results.exists
+
+        def expire(lookup):
+            def wrapper(result_key):
+                caches['template_fragments'].clear()
+                return lookup(result_key)
+            return wrapper
+
+        with mock.patch('app.results.load', side_effect=expire(load)), \
+                mock.patch('app.results.exists', side_effect=expire(exists)):
+            response = self.client.post(reverse('index'), KEYWORD_FORM)
+        self.assertContains(response, url)
+        self.assertEqual(sum(self.youtube.calls.values()), 0)
+
+    def test_quota_exceeded_redirects(self):
+        with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=50, RESERVE=0)):
+            response = self.client.post(reverse('index'), KEYWORD_FORM, follow=True)
+
+        self.assertRedirects(response, reverse('index'))
+        self.assertContains(response, 'クォータ')
+        self.assertEqual(sum(self.youtube.calls.values()), 0)
+
+    def test_quota_is_checked_before_the_first_page(self):
+        # 200件は4ページ(400ユニット)なので、350ユニットでは1ページも検索しない
+        with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=350, RESERVE=0)):
+            response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=200), follow=True)
+
+        self.assertRedirects(response, reverse('index'))
+        self.assertContains(response, '必要：400')
+        self.assertEqual(self.youtube.calls, {})
+        self.assertEqual(quota.used_units(), 0)
+
+        # キャッシュ済みのページは数えない(検索は残りの1ページだけ)
+        self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=150))
+        self.youtube.reset()
+        with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=quota.used_units() + 150, RESERVE=0)):
+            response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=200))
+        self.assertEqual(len(response.context['youtube_data']), 200)
+        self.assertEqual(self.youtube.calls['search'], 1)
+
+
+
+# 動画・チャンネルは50件ずつまとめて取得する
+class BatchLookupTests(YouTubeTestCase):
+    def test_videos_are_fetched_in_chunks_of_50(self):
+        videoids = ['v%d' % i for i in range(120)]
+        count_list = views.get_video(videoids + videoids[:10])
+
+        self.assertEqual(self.youtube.calls, {'videos': 3})
+        # チャンクは並列で取得するので、呼び出しの順番は決まらない
+        chunks = sorted((params['id'].split(',') for endpoint, params in self.youtube.requests), key=len, reverse=True)
+        self.assertEqual([len(chunk) for chunk in chunks], [50, 50, 20])
+        self.assertCountEqual(sum(chunks, []), videoids)
+        self.assertEqual([item[0] for item in count_list], videoids + videoids[:10])
+
+    def test_channels_are_fetched_once_per_channel(self):
+        videoid_list = {'v%d' % i: 'UCchannel%d' % (i % 3) for i in range(120)}
+        channel_list = views.get_channel(videoid_list)
+
+        self.assertEqual(self.youtube.calls, {'channels': 1})
+        self.assertEqual(self.youtube.requests[0][1]['id'], 'UCchannel0,UCchannel1,UCchannel2')
+        self.assertEqual(len(channel_list), 120)
+        self.assertEqual(channel_list[4], ['v4', 'https://yt3.ggpht.com/UCchannel1=s88'])
+
+        # 保存済みのプロフィール画像はAPIで取得しない
+        self.youtube.reset()
+        get_response_cache().clear()
+        self.assertEqual(views.get_channel(videoid_list), channel_list)
+        self.assertEqual(self.youtube.calls, {})
+
+
+
+# 50件を超える検索は nextPageToken をたどる
+class PaginationTests(YouTubeTestCase):
+    def search_params(self):
+        return [(params['maxResults'], params.get('pageToken')) for endpoint, params in self.youtube.requests]
+
+    def test_pages_follow_next_page_token(self):
+        pages = list(youtube.iter_search_pages(120, part='snippet', q='python'))
+
+        self.assertEqual([len(page) for page in pages], [50, 50, 20])
+        self.assertEqual(self.search_params(), [(50, None), (50, '50'), (20, '100')])
+        videoids = [item['id']['videoId'] for page in pages for item in page]
+        self.assertEqual(len(set(videoids)), 120)
+
+    def test_pages_stop_at_last_page(self):
+        self.youtube.total_results = 70
+        pages = list(youtube.iter_search_pages(120, page_size=30, part='snippet', q='python'))
+
+        self.assertEqual([len(page) for page in pages], [30, 30, 10])
+        self.assertEqual(self.search_params(), [(30, None), (30, '30'), (30, '60')])
+
+    # 再生回数の条件を満たす動画が集まったら、残りのページは検索しない
+    @override_settings(YOUTUBE_SEARCH_MAX_RESULTS=250)
+    def test_search_stops_once_enough_rows_pass(self):
+        search_list, count_list = views.search_video('python', 12, 50000, 'viewCount', date(2023, 1, 1), date(2023, 2, 1))
+        self.assertEqual(len([item for item in count_list if item[1] >= 50000]), 12)
+        # 1ページ(50件)に条件を満たす動画が12件以上ある
+        self.assertEqual(self.youtube.calls, {'search': 1, 'videos': 1})
+
+        self.youtube.reset()
+        search_list, count_list = views.search_video('django', 60, 50000, 'viewCount', date(2023, 1, 1), date(2023, 2, 1))
+        self.assertEqual(len([item for item in count_list if item[1] >= 50000]), 60)
+        # 最大250件(5ページ)のうち3ページ目で集まる(統計データはページごとに取得する)
+        self.assertEqual(self.youtube.calls, {'search': 3, 'videos': 3})
+
+    def test_rival_search_follows_pages(self):
+        rivalvideo_list = views.search_rivalvideo(['UCrival1', 'UCrival2'], 120, 'viewCount', date(2023, 1, 1), date(2023, 2, 1))
+
+        self.assertEqual(len(rivalvideo_list), 240)
+        self.assertEqual([item[1] for item in rivalvideo_list[119:121]], ['UCrival1', 'UCrival2'])
+        self.assertEqual(self.youtube.calls, {'search': 6})
+
+
+
+# 並列呼び出し(concurrency.fan_out)
+class FanOutTests(SimpleTestCase):
+    def test_results_keep_input_order(self):
+        # 後の要素ほど早く終わる
+        results = fan_out(lambda n: time.sleep((10 - n) / 1000) or n * 2, range(10), max_workers=4)
+        self.assertEqual(results, [n * 2 for n in range(10)])
+
+    def test_workers_are_bounded(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def work(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(n)
+
+        fan_out(work, range(12), max_workers=3)
+        self.assertEqual(max(peak), 3)
+
+        with self.settings(YOUTUBE_MAX_CONCURRENCY=2):
+            peak.clear()
+            fan_out(work, range(12))
+            self.assertEqual(max(peak), 2)
+
+    def test_single_worker_runs_in_caller_thread(self):
+        threads = fan_out(lambda n: threading.get_ident(), range(3), max_workers=1)
+        self.assertEqual(threads, [threading.get_ident()] * 3)
+
+    def test_context_is_passed_to_workers(self):
+        # 各スレッドの計測は呼び出し元のリクエストの計測に記録される
+        with tracing.trace('fan_out') as trace:
+            self.assertEqual(fan_out(lambda n: tracing.current(), range(4), max_workers=4), [trace] * 4)
+            fan_out(tracing.traced(lambda n: n), range(4), max_workers=4)
+        self.assertEqual(trace.summary()['<lambda>']['count'], 4)
+
+    def test_fan_out_flat(self):
+        self.assertEqual(fan_out_flat(lambda n: [n] * n, range(4), max_workers=4), [1, 2, 2, 3, 3, 3])
+
+
+
+class BatchSearchTests(YouTubeTestCase):
+    def test_overlapping_keywords_share_lookups(self):
+        self.youtube.shared_results = 6
+
+        response = self.client.post(reverse('batch'), dict(KEYWORD_FORM, keywords='python\ndjango\npython'))
+
+        youtube_data = response.context['youtube_data']
+        self.assertEqual([row.keyword for row in youtube_data], ['python'] * 12 + ['django'] * 12)
+        self.assertEqual(len({row.url for row in youtube_data}), 18)
+        # 検索はキーワードごと、統計データ(18件)とチャンネルは1回
+        self.assertEqual(self.youtube.calls, {'search': 2, 'videos': 1, 'channels': 1})
+
+    def test_command_writes_csv(self):
+        out = io.StringIO()
+        call_command('batch_search', 'python', 'django', '--items-count', '3', stdout=out)
+
+        lines = out.getvalue().lstrip('\ufeff').splitlines()
+        self.assertEqual(lines[0].split(',')[0], 'keyword')
+        self.assertEqual(len(lines), 7)
+
+
+
+class RelatedSearchTests(YouTubeTestCase):
+    # 関連動画の検索結果は、加工した一覧('related')だけをキャッシュする
+    def test_related_results_are_cached_once(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+
+        keys = [key.split(':')[1] for key in get_response_cache().backend._costs]
+        self.assertEqual(keys.count('related'), 6)
+        # ライバル動画の検索(2チャンネル)だけ
+        self.assertEqual(keys.count('search'), 2)
+
+    def test_ranking_does_not_depend_on_concurrency(self):
+        rival_list = views.search_rivalvideo(['UCrival1', 'UCrival2'], 10, 'viewCount', date(2023, 1, 1), date(2023, 2, 1))
+        related_list = views.search_relatedvideo(rival_list, 'UCmychannel', 6)
+
+        get_response_cache().clear()
+        with self.settings(YOUTUBE_MAX_CONCURRENCY=1):
+            self.assertEqual(views.search_rivalvideo(['UCrival1', 'UCrival2'], 10, 'viewCount', date(2023, 1, 1), date(2023, 2, 1)), rival_list)
+            self.assertEqual(views.search_relatedvideo(rival_list, 'UCmychannel', 6), related_list)
+        self.assertEqual(len(related_list), 40)
+        self.assertEqual(self.youtube.calls['search'], 2 * (2 + 20))
+
+    def test_related_job_renders_results(self):
+        response = self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.get()
+        self.assertRedirects(response, reverse('related_job', args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual(job.status, AnalysisJob.DONE)
+
+        response = self.client.get(reverse('related_job', args=[job.pk]))
+        youtube_data = response.context['youtube_data']
+        # 関連動画6件のうち、自分のチャンネルは2位と5位
+        self.assertEqual(len(youtube_data), 12)
+        self.assertEqual({row.ranking for row in youtube_data}, {2, 5})
+        # ライバル2チャンネルの検索 + ライバル動画6件の関連動画検索
+        self.assertEqual(self.youtube.calls, {'search': 8, 'videos': 1, 'channels': 1})
+
+    def test_related_lists_are_reused(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+        self.youtube.reset()
+
+        # 関連動画の件数を減らした場合と、重なるライバルを追加した場合は、新しいライバル動画だけを検索する
+        self.client.post(reverse('related'), dict(RELATED_FORM, related_items_count=4))
+        self.assertEqual(self.youtube.calls, {})
+        self.client.post(reverse('related'), dict(RELATED_FORM, rival_channel_id='UCrival2,UCrival3,UCrival2'))
+        self.assertEqual(self.youtube.calls, {'search': 4, 'videos': 1})
+
+    def test_quota_estimate_skips_cached_and_tracked_searches(self):
+        def estimate(**data):
+            form = RelatedForm(dict(RELATED_FORM, **data))
+            self.assertTrue(form.is_valid())
+            return views.estimate_related_units(views.related_params(form))
+
+        # ライバル2チャンネルの検索 + ライバル動画6件の関連動画検索
+        self.assertEqual(estimate(), 800)
+        self.client.post(reverse('related'), RELATED_FORM)
+        self.assertEqual(estimate(), 0)
+        # キャッシュ済みのチャンネルは数えず、新しいチャンネルの分だけ
+        self.assertEqual(estimate(rival_channel_id='UCrival2,UCrival3'), 400)
+        # 巡回済みのチャンネルはライバル動画を検索しない(関連動画の検索だけ)
+        call_command('track_channels', 'UCrival3', '--once', stdout=io.StringIO())
+        tracked = dict(rival_channel_id='UCrival3', rival_search_start='2020-01-01', rival_search_end='2020-02-01')
+        self.assertEqual(estimate(**tracked), 300)
+
+        # キャッシュ済みの検索のやり直しは、最大の見積もりより残りが少なくても実行する
+        self.youtube.reset()
+        with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=quota.used_units() + 100, RESERVE=0)):
+            response = self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.order_by('created_at').last()
+        self.assertRedirects(response, reverse('related_job', args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertEqual(self.youtube.calls, {})
+
+    def test_failed_job_resumes_from_failed_stage(self):
+        with mock.patch('app.youtube.fetch_videos', side_effect=RuntimeError('boom')):
+            self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.get()
+        self.assertEqual(job.status, AnalysisJob.FAILED)
+        self.assertEqual(job.stage, 'count_list')
+        self.youtube.reset()
+
+        self.client.post(reverse('related_job_retry', args=[job.pk]))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertEqual(self.youtube.calls, {'videos': 1})
+
+    def test_status_endpoint(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.get()
+
+        status = self.client.get(reverse('related_job_status', args=[job.pk])).json()
+
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['progress'], 100)
+        self.assertTrue(Video.objects.filter(channel_id='UCmychannel').exists())
+
+    # 段階ごとに、実行中の段階と、それまでの進捗を保存する
+    def test_stage_progress(self):
+        def stage(params, results):
+            job = AnalysisJob.objects.get()
+            return [job.status, job.stage, job.progress, sorted(results)]
+
+        job = AnalysisJob.objects.create(kind='test', params={})
+        stages = [(name, name, stage) for name in ('first', 'second', 'third', 'fourth')]
+        job = jobs.run_job(job.pk, stages)
+
+        self.assertEqual((job.status, job.stage, job.progress, job.error), (AnalysisJob.DONE, '', 100, ''))
+        self.assertEqual(job.results['first'], ['running', 'first', 0, []])
+        self.assertEqual(job.results['third'], ['running', 'third', 50, ['first', 'second']])
+        self.assertEqual(job.results['fourth'][2], 75)
+
+    # 'db' では run_jobs のワーカーが実行するまで待機中のまま
+    def test_db_backend_runs_in_worker(self):
+        with self.settings(ANALYSIS_JOB_BACKEND='db'):
+            response = self.client.post(reverse('related'), RELATED_FORM)
+            job = AnalysisJob.objects.get()
+            self.assertRedirects(response, reverse('related_job', args=[job.pk]), fetch_redirect_response=False)
+            self.assertEqual(job.status, AnalysisJob.QUEUED)
+            self.assertEqual(self.youtube.calls, {})
+
+            stdout = io.StringIO()
+            call_command('run_jobs', '--once', stdout=stdout, stderr=io.StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (AnalysisJob.DONE, 100))
+        self.assertEqual(stdout.getvalue(), '%s 完了\n' % job.pk)
+
+    # 待機中のジョブは1つのワーカーだけが取り出す(種類の違うジョブは取り出さない)
+    def test_job_is_claimed_once(self):
+        AnalysisJob.objects.create(kind='other', params={})
+        first, second = [AnalysisJob.objects.create(kind='related', params={}) for i in range(2)]
+
+        self.assertEqual(jobs.claim_next_job(['related']), first)
+        self.assertEqual(jobs.claim_next_job(['related']), second)
+        self.assertIsNone(jobs.claim_next_job(['related']))
+        self.assertEqual(AnalysisJob.objects.filter(status=AnalysisJob.RUNNING).count(), 2)
+
+        # 選んでから実行中にするまでの間に、他のワーカーが実行中にしたジョブは飛ばす
+        third, fourth = [AnalysisJob.objects.create(kind='related', params={}) for i in range(2)]
+        get = AnalysisJob.objects.filter
+
+        def taken_by_other_worker(**kwargs):
+            if kwargs.get('pk') == third.pk:
+                get(pk=third.pk).update(status=AnalysisJob.RUNNING)
+            return get(**kwargs)
+
+        with mock.patch.object(AnalysisJob.objects, 'filter', side_effect=taken_by_other_worker):
+            self.assertEqual(jobs.claim_next_job(['related']), fourth)
+
+    # 再起動などで止まったジョブは、一定時間たったら失敗にする(やり直せるようにする)
+    def test_stale_jobs_are_failed(self):
+        old = timezone.now() - timedelta(seconds=settings.ANALYSIS_JOB_TIMEOUT + 1)
+        running, queued, recent = [
+            AnalysisJob.objects.create(kind='related', status=status, params={})
+            for status in (AnalysisJob.RUNNING, AnalysisJob.QUEUED, AnalysisJob.RUNNING)
+        ]
+        AnalysisJob.objects.filter(pk__in=[running.pk, queued.pk]).update(updated_at=old)
+
+        status = self.client.get(reverse('related_job_status', args=[running.pk])).json()
+        self.assertEqual((status['status'], status['error']), ('failed', jobs.STALE_ERROR))
+
+        with self.settings(ANALYSIS_JOB_BACKEND='db'):
+            # 'db' の待機中のジョブは run_jobs のワーカーが実行するまで待つ
+            self.assertEqual(jobs.fail_stale_jobs(), 0)
+        with self.settings(ANALYSIS_JOB_BACKEND='thread'):
+            self.assertEqual(jobs.fail_stale_jobs(), 1)
+
+        self.assertEqual(
+            [job.status for job in AnalysisJob.objects.order_by('created_at')],
+            [AnalysisJob.FAILED, AnalysisJob.FAILED, AnalysisJob.RUNNING],
+        )
+
+    def test_run_jobs_fails_stale_running_jobs(self):
+        with self.settings(ANALYSIS_JOB_BACKEND='db'):
+            self.client.post(reverse('related'), RELATED_FORM)
+            stale = AnalysisJob.objects.create(kind='related', status=AnalysisJob.RUNNING, params={})
+            AnalysisJob.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(days=1))
+
+            call_command('run_jobs', '--once', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertEqual(AnalysisJob.objects.get(pk=stale.pk).status, AnalysisJob.FAILED)
+        self.assertEqual(AnalysisJob.objects.exclude(pk=stale.pk).get().status, AnalysisJob.DONE)
+
+
+
+class FieldMaskTests(YouTubeTestCase):
+    def test_requests_carry_fields(self):
+        self.client.post(reverse('index'), KEYWORD_FORM)
+        self.client.post(reverse('related'), RELATED_FORM)
+        call_command('track_channels', 'UCrival1', '--once', '--max-videos', '10', stdout=io.StringIO())
+
+        self.assertEqual(AnalysisJob.objects.get().status, AnalysisJob.DONE)
+        self.assertEqual({endpoint for endpoint, params in self.youtube.requests}, {'search', 'videos', 'channels', 'playlistItems'})
+        for endpoint, params in self.youtube.requests:
+            self.assertEqual(params['fields'], youtube.FIELDS[endpoint, params['part']])
+
+    def test_response_is_masked(self):
+        result = youtube.call('channels', part='snippet', id='UCrival1')
+
+        self.assertEqual(result, {'items': [{
+            'id': 'UCrival1',
+            'snippet': {'title': 'Channel UCrival1', 'thumbnails': {'default': {'url': 'https://yt3.ggpht.com/UCrival1=s88'}}},
+        }]})
+
+    def test_parse_fields(self):
+        self.assertEqual(
+            parse_fields('nextPageToken,items(id/videoId,snippet(title)),items/snippet/channelId'),
+            {'nextPageToken': None, 'items': {'id': {'videoId': None}, 'snippet': {'title': None, 'channelId': None}}},
+        )
+        with self.assertRaises(ValueError):
+            parse_fields('items(id')
+
+
+
+# APIのエラーはすぐにやり直す(1回まで)
+@override_settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, BACKOFF=0, MAX_RETRIES=1))
+class PartialFailureTests(YouTubeTestCase):
+    def test_transient_errors_are_retried(self):
+        self.youtube.fail('videos', http_error(503))
+
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+
+        self.assertEqual(len(response.context['youtube_data']), 12)
+        self.assertEqual(self.youtube.calls['videos'], 2)
+
+    def test_failed_chunk_is_marked_and_refetched(self):
+        # 1ページ目の統計データの取得だけ失敗する(やり直しも失敗)
+        self.youtube.fail('videos', http_error(500), OSError('timed out'))
+        form = dict(KEYWORD_FORM, items_count=60)
+
+        response = self.client.post(reverse('index'), form)
+
+        youtube_data = response.context['youtube_data']
+        self.assertEqual(len(youtube_data), 60)
+        self.assertEqual([row.viewcount for row in youtube_data].count(views.UNAVAILABLE), 50)
+        self.assertContains(response, views.PARTIAL_MESSAGE)
+
+        # もう一度検索すると、検索結果はキャッシュから、統計データは取得できなかった分だけ取り直す
+        self.youtube.reset()
+        response = self.client.post(reverse('index'), form)
+
+        self.assertNotIn(views.UNAVAILABLE, [row.viewcount for row in response.context['youtube_data']])
+        self.assertEqual(self.youtube.calls, {'videos': 1})
+
+    def test_related_job_keeps_results_and_retries_partial_stage(self):
+        self.youtube.fail('channels', http_error(503), http_error(503))
+        self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.get()
+        self.assertEqual((job.status, job.results['partial_stages']), (AnalysisJob.DONE, ['channel_list']))
+
+        response = self.client.get(reverse('related_job', args=[job.pk]))
+        self.assertEqual(len(response.context['youtube_data']), 12)
+        self.assertContains(response, reverse('related_job_retry', args=[job.pk]))
+        self.youtube.reset()
+
+        # 検索は保存済みの結果を使い、チャンネルデータから後だけ取り直す
+        self.client.post(reverse('related_job_retry', args=[job.pk]))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertNotIn('partial_stages', job.results)
+        self.assertEqual(self.youtube.calls, {'channels': 1})
+
+
+    # 元の動画が見つからない(404)など、やり直しても失敗する動画は関連動画なしにする(一部のデータの取得の失敗にしない)
+    def test_permanent_related_error_is_dropped(self):
+        search = self.youtube._search
+
+        def fail_deleted_video(params):
+            if params.get('relatedToVideoId') == 'UCrival1-v0':
+                raise http_error(404, 'videoNotFound')
+            return search(params)
+
+        self.youtube._search = fail_deleted_video
+        with self.assertLogs('app.youtube', 'WARNING') as logs:
+            self.client.post(reverse('related'), RELATED_FORM)
+
+        job = AnalysisJob.objects.get()
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertFalse(jobs.is_partial(job))
+        self.assertNotIn('UCrival1-v0', [row[6] for row in job.results['related_list']])
+        self.assertIn('UCrival1-v0', logs.output[0])
+
+        # 関連動画なしもキャッシュするので、次の検索では呼び出さない
+        self.youtube.reset()
+        self.client.post(reverse('related'), RELATED_FORM)
+        self.assertEqual(self.youtube.calls.get('search', 0), 0)
+
+    # プロフィール画像を取得できなかった行は画像を出さない
+    def test_missing_profile_image_is_not_rendered(self):
+        self.youtube.fail('channels', http_error(503), http_error(503))
+
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+
+        self.assertIsNone(response.context['youtube_data'][0].profileImg)
+        self.assertNotContains(response, 'src="None"')
+
+
+# キーワード動画検索、関連動画検索を async のビューにしたURL設定(settings.ASYNC_VIEWS = True と同じ)
+class AsyncUrls:
+    urlpatterns = [
+        path('', views.AsyncIndexView.as_view(), name='index'),
+        path('related/', views.AsyncRelatedView.as_view(), name='related'),
+    ] + [pattern for pattern in urls.urlpatterns if pattern.name not in ('index', 'related')]
+
+
+
+class AsyncViewTests(YouTubeTestCase):
+    def test_keyword_search_matches_sync_view(self):
+        expected = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=60)).context['youtube_data']
+        # 表示結果、ワーカー間で共有した検索結果、APIのレスポンスを消して検索し直す
+        caches['template_fragments'].clear()
+        caches['youtube'].clear()
+        get_response_cache().clear()
+        self.youtube.reset()
+
+        with override_settings(ROOT_URLCONF=AsyncUrls):
+            response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=60))
+
+        self.assertEqual(response.context['youtube_data'], expected)
+        # 統計データは保存済みのものを使う
+        self.assertEqual(self.youtube.calls, {'search': 2})
+
+    def test_related_search_matches_sync_view(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+        get_response_cache().clear()
+
+        with override_settings(ROOT_URLCONF=AsyncUrls):
+            response = self.client.post(reverse('related'), RELATED_FORM)
+            expected, job = AnalysisJob.objects.order_by('created_at')
+            self.assertRedirects(response, reverse('related_job', args=[job.pk]), fetch_redirect_response=False)
+
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertEqual(job.results, expected.results)
+        self.assertEqual(
+            self.client.get(reverse('related_job', args=[job.pk])).context['youtube_data'],
+            self.client.get(reverse('related_job', args=[expected.pk])).context['youtube_data'],
+        )
+
+    @override_settings(ANALYSIS_JOB_BACKEND='thread')
+    def test_related_search_returns_before_stages_finish(self):
+        request = RequestFactory().post('/related/', RELATED_FORM)
+
+        # ビューとジョブのタスクを同じイベントループで実行する
+        async def post():
+            response = await views.AsyncRelatedView.as_view()(request)
+            job = await sync_to_async(AnalysisJob.objects.get)()
+            await asyncio.gather(*jobs._tasks)
+            return response, job
+
+        response, job = async_to_sync(post)()
+
+        self.assertRedirects(response, reverse('related_job', args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual(job.status, AnalysisJob.QUEUED)
+        self.assertEqual(job.results, {})
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertIn('count_list', job.results)
+
+
+
+class ResultSetTests(YouTubeTestCase):
+    def test_sort_filter_and_paginate_without_api_calls(self):
+        response = self.client.post(reverse('index'), dict(KEYWORD_FORM, items_count=60))
+        self.assertEqual(len(response.context['page'].object_list), settings.RESULT_SETS['PAGE_SIZE'])
+        self.assertContains(response, 'loading="lazy"')
+        youtube_data = response.context['youtube_data']
+        views_sorted = sorted((int(row.viewcount) for row in youtube_data), reverse=True)
+        threshold = views_sorted[40]
+        self.youtube.reset()
+
+        url = reverse('results', args=[response.context['result_key']])
+        response = self.client.get(url, {'sort': '-viewcount', 'min_viewcount': threshold, 'page': 2})
+
+        page = response.context['page']
+        self.assertEqual(page.paginator.count, len([count for count in views_sorted if count >= threshold]))
+        self.assertEqual([int(row.viewcount) for row in page.object_list], views_sorted[24:page.paginator.count])
+        self.assertEqual(self.youtube.calls, {})
+
+    # テンプレートには表示する列だけの行データ(NamedTuple)を渡し、表示結果は検索結果ごとにキャッシュする
+    def test_pages_render_row_records(self):
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+        rows = response.context['page'].object_list
+        self.assertEqual(len(rows), 12)
+        self.assertTrue(all(type(row) is KeywordRow for row in rows))
+        for row in rows:
+            self.assertContains(response, row.url)
+            self.assertContains(response, row.title)
+
+        other = self.client.post(reverse('index'), dict(KEYWORD_FORM, keyword='django'))
+        self.assertNotEqual(other.context['result_key'], response.context['result_key'])
+        self.assertNotContains(other, rows[0].url)
+
+        response = self.client.post(reverse('related'), RELATED_FORM)
+        response = self.client.get(response['Location'])
+        rows = response.context['page'].object_list
+        self.assertTrue(all(type(row) is RelatedRow for row in rows))
+        self.assertContains(response, rows[0].rivalurl)
+
+    def test_batch_totals_follow_filter(self):
+        self.youtube.shared_results = 6
+        response = self.client.post(reverse('batch'), dict(KEYWORD_FORM, keywords='python\ndjango'))
+
+        response = self.client.get(reverse('results', args=[response.context['result_key']]), {'published_after': '2100-01-01'})
+
+        self.assertEqual(response.context['keyword_totals'], [('python', 0, 0), ('django', 0, 0)])
+        self.assertContains(response, '検索にヒットした動画はありません')
+
+    def test_related_job_is_sorted_by_date(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+        job = AnalysisJob.objects.get()
+
+        response = self.client.get(reverse('related_job', args=[job.pk]), {'sort': 'publishtime'})
+
+        dates = [row.publishtime for row in response.context['page'].object_list]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_expired_result_redirects(self):
+        response = self.client.get(reverse('results', args=['missing']), follow=True)
+
+        self.assertRedirects(response, reverse('index'))
+        self.assertContains(response, views.RESULT_EXPIRED_MESSAGE)
+
+
+
+class OverlapTests(YouTubeTestCase):
+    def test_related_graph_is_stored_and_aggregated(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+
+        # ライバル動画6件 × 関連動画6件(自分のチャンネルは2位と5位)
+        self.assertEqual(RelatedEdge.objects.count(), 36)
+        rival_rows, competitor_rows, video_rows = overlap.get_overlap('UCmychannel')
+        self.assertEqual(
+            [(row.channel_id, row.sources, row.hits, row.hit_rate, row.average_rank, row.best_rank) for row in rival_rows],
+            [('UCrival1', 3, 3, 1.0, 3.5, 2), ('UCrival2', 3, 3, 1.0, 3.5, 2)],
+        )
+        self.assertNotIn('UCmychannel', [row.channel_id for row in competitor_rows])
+        self.assertEqual(sum(row.sources for row in competitor_rows), 24)
+        self.assertEqual(len(video_rows), 12)
+
+        # 自分の動画が出ていないチャンネルはヒット率0
+        self.assertEqual([row.hit_rate for row in overlap.get_overlap('UCnobody')[0]], [0.0, 0.0])
+
+    def test_lists_are_not_stored_again_and_result_is_cached(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+        fetched_at = set(RelatedEdge.objects.values_list('fetched_at', flat=True))
+        overlap.get_overlap('UCmychannel')
+
+        self.client.post(reverse('related'), dict(RELATED_FORM, related_items_count=4))
+
+        self.assertEqual(set(RelatedEdge.objects.values_list('fetched_at', flat=True)), fetched_at)
+        # 関連動画の一覧が変わっていなければ、取得日時の確認だけ
+        with self.assertNumQueries(1):
+            overlap.get_overlap('UCmychannel')
+
+    def test_overlap_page(self):
+        self.client.post(reverse('related'), RELATED_FORM)
+
+        response = self.client.get(reverse('overlap'), {'channel': 'UCmychannel'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['rival_rows']), 2)
+        self.assertContains(response, 'Channel UCrival1')
+
+
+
+class TrackingTests(YouTubeTestCase):
+    def track(self, *channel_ids):
+        call_command('track_channels', *channel_ids, '--once', '--concurrency', '1', '--max-videos', '100', stdout=io.StringIO())
+
+    def test_crawls_only_new_uploads(self):
+        self.youtube.channel_videos = 120
+        self.track('UCrival1')
+
+        checkpoint = ChannelCheckpoint.objects.get()
+        self.assertEqual(checkpoint.latest_video_id, 'UCrival1-v119')
+        self.assertEqual(checkpoint.covered_since, date(2020, 1, 21))
+        self.assertEqual(self.youtube.calls, {'channels': 1, 'playlistItems': 2, 'videos': 2})
+
+        # 新しい動画3本だけ読み込み、統計データもその3本だけ取得する
+        self.youtube.reset()
+        self.youtube.channel_videos = 123
+        self.track('UCrival1')
+
+        self.assertEqual(Video.objects.count(), 103)
+        self.assertEqual(self.youtube.calls, {'playlistItems': 1, 'videos': 1})
+
+    def test_resumes_after_interruption(self):
+        # 2ページ目の保存中に中断する
+        save_videos = store.save_videos
+        pages = iter([save_videos, mock.Mock(side_effect=RuntimeError('interrupted'))])
+        with mock.patch('app.store.save_videos', side_effect=lambda videos: next(pages)(videos)):
+            self.track('UCrival1')
+        self.assertEqual(ChannelCheckpoint.objects.get().page_token, '50')
+        self.youtube.reset()
+
+        self.track('UCrival1')
+
+        checkpoint = ChannelCheckpoint.objects.get()
+        self.assertEqual((checkpoint.page_token, checkpoint.latest_video_id), ('', 'UCrival1-v199'))
+        self.assertEqual([params['pageToken'] for endpoint, params in self.youtube.requests if endpoint == 'playlistItems'], ['50'])
+        self.assertEqual(Video.objects.count(), 100)
+
+    def test_rival_search_uses_tracked_videos(self):
+        self.youtube.channel_videos = 60
+        self.track('UCrival1', 'UCrival2')
+        self.youtube.reset()
+
+        self.client.post(reverse('related'), dict(RELATED_FORM, rival_search_start='2020-01-01', rival_search_end='2020-02-01'))
+
+        job = AnalysisJob.objects.get()
+        self.assertEqual(job.status, AnalysisJob.DONE)
+        self.assertEqual(len(job.results['rivalvideo_list']), 6)
+        # ライバル動画の検索はせず、関連動画の検索だけ
+        self.assertEqual(self.youtube.calls['search'], 6)
+
+
+
+class StatisticsTests(YouTubeTestCase):
+    def setUp(self):
+        super().setUp()
+        channel = Channel.objects.create(channel_id='UCrival1', title='rival')
+        self.video_ids = ['v%d' % i for i in range(3)]
+        for videoid in self.video_ids:
+            Video.objects.create(video_id=videoid, channel=channel, title=videoid, published_at=date(2023, 1, 1))
+
+    # APIから取得した時だけ、取得した日時で保存する(キャッシュ、期限切れのキャッシュから返した時は保存しない)
+    def test_only_fresh_statistics_are_saved(self):
+        fetched = timezone.now()
+        snapshots = store.save_statistics(youtube.fetch_videos(self.video_ids))
+        self.assertEqual(len(snapshots), 3)
+        self.assertLess(abs(snapshots[0].fetched_at - fetched), timedelta(seconds=5))
+
+        videos = youtube.fetch_videos(self.video_ids)
+        self.assertEqual(len(videos), 3)
+        self.assertEqual(store.save_statistics(videos), [])
+
+        later = time.time() + settings.YOUTUBE_CACHE['TTL']['videos'] + 1
+        with mock.patch('time.time', return_value=later):
+            with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=0, RESERVE=0)):
+                videos = youtube.fetch_videos(self.video_ids)
+                self.assertEqual(len(videos), 3)
+                self.assertEqual(store.save_statistics(videos), [])
+
+        self.assertEqual(self.youtube.calls['videos'], 1)
+        self.assertEqual(VideoStatistics.objects.count(), 3)
+
+    # 新しい行は追加し、既存の行は変わったものだけ更新する
+    def test_bulk_upsert_updates_only_changed_rows(self):
+        videos = [[videoid, 'UCrival1', 'rival', videoid, '2023-01-01'] for videoid in self.video_ids]
+        with CaptureQueriesContext(connection) as queries:
+            store.save_videos(videos)
+        self.assertFalse([query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))])
+
+        videos[1][3] = 'renamed'
+        videos.append(['v3', 'UCrival2', 'rival 2', 'new', '2023-01-02'])
+        with CaptureQueriesContext(connection) as queries:
+            store.save_videos(videos)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn("'v1'", updates[0])
+        self.assertNotIn("'v0'", updates[0])
+
+        self.assertEqual(Video.objects.get(pk='v1').title, 'renamed')
+        self.assertEqual(Video.objects.get(pk='v3').channel.title, 'rival 2')
+        self.assertEqual(Video.objects.count(), 4)
+
+    def test_only_stale_statistics_are_refetched(self):
+        self.assertEqual(len(store.refresh_statistics(video_ids=self.video_ids)), 3)
+        VideoStatistics.objects.filter(video_id='v0').update(
+            fetched_at=timezone.now() - timedelta(seconds=settings.YOUTUBE_STATISTICS_MAX_AGE + 1)
+        )
+        get_response_cache().clear()
+        self.youtube.reset()
+
+        self.assertEqual(store.stale_video_ids(video_ids=self.video_ids), ['v0'])
+        self.assertEqual([snapshot.video_id for snapshot in store.refresh_statistics(video_ids=self.video_ids)], ['v0'])
+        self.assertEqual(self.youtube.requests, [('videos', mock.ANY)])
+        self.assertEqual(self.youtube.requests[0][1]['id'], 'v0')
+        self.assertEqual(store.stale_video_ids(video_ids=self.video_ids), [])
+        self.assertEqual(set(store.latest_statistics(self.video_ids)), set(self.video_ids))
+
+    def test_max_age_matches_response_ttl(self):
+        self.assertEqual(settings.YOUTUBE_STATISTICS_MAX_AGE, settings.YOUTUBE_CACHE['TTL']['videos'])
+
+
+
+class ExportTests(YouTubeTestCase):
+    def download(self, name, form, export_format):
+        response = self.client.get(reverse(name), dict(form, format=export_format))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_keyword_csv(self):
+        lines = self.download('keyword_export', dict(KEYWORD_FORM, items_count=120), 'csv').decode('utf-8-sig').splitlines()
+
+        self.assertEqual(lines[0].split(','), list(KeywordRow._fields))
+        self.assertEqual(len(lines), 121)
+        self.assertEqual(self.youtube.calls, {'search': 3, 'videos': 3, 'channels': 1})
+
+    def test_related_ndjson(self):
+        lines = self.download('related_export', RELATED_FORM, 'ndjson').decode('utf-8').splitlines()
+        rows = [json.loads(line) for line in lines]
+
+        self.assertEqual(len(rows), 12)
+        self.assertEqual({row['ranking'] for row in rows}, {2, 5})
+
+    @skipUnless(export.is_available('parquet'), 'pyarrow is not installed')
+    def test_keyword_parquet(self):
+        import pyarrow.parquet as pq
+
+        with mock.patch('app.export.PARQUET_ROW_GROUP_SIZE', 50):
+            content = self.download('keyword_export', dict(KEYWORD_FORM, items_count=120), 'parquet')
+        parquet = pq.ParquetFile(io.BytesIO(content))
+
+        self.assertEqual(parquet.metadata.num_rows, 120)
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+        self.assertEqual(parquet.schema_arrow.names, list(KeywordRow._fields))
+
+    # pandas は Excel の出力だけで使う(列の型は行データの型ヒントから)
+    def test_to_dataframe(self):
+        form = RelatedForm(RELATED_FORM)
+        self.assertTrue(form.is_valid())
+        rows = views.fetch_rows(views.iter_related_rows(views.related_params(form)))
+        df = export.to_dataframe(rows, RelatedRow)
+
+        self.assertEqual(list(df.columns), list(RelatedRow._fields))
+        self.assertEqual(len(df), 12)
+        self.assertEqual(str(df['ranking'].dtype), 'Int64')
+        self.assertEqual(str(df['title'].dtype), 'string')
+        self.assertEqual(df['ranking'].tolist(), [row.ranking for row in rows])
+
+    @skipUnless(export.is_available('xlsx'), 'pandas or openpyxl is not installed')
+    def test_keyword_xlsx(self):
+        import pandas as pd
+
+        content = self.download('keyword_export', dict(KEYWORD_FORM, items_count=120), 'xlsx')
+        df = pd.read_excel(io.BytesIO(content))
+
+        self.assertEqual(list(df.columns), list(KeywordRow._fields))
+        self.assertEqual(len(df), 120)
+
+    def test_parquet_button_needs_pyarrow(self):
+        with mock.patch('app.export.is_available', return_value=False):
+            response = self.client.post(reverse('index'), KEYWORD_FORM)
+        self.assertNotContains(response, 'format=parquet')
+        self.assertContains(response, 'format=csv')
+
+        caches['template_fragments'].clear()
+        with mock.patch('app.export.is_available', return_value=True):
+            response = self.client.post(reverse('index'), KEYWORD_FORM)
+        self.assertContains(response, 'format=parquet')
+
+    def test_quota_exceeded_redirects(self):
+        with self.settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=50, RESERVE=0)):
+            response = self.client.get(reverse('keyword_export'), dict(KEYWORD_FORM, format='csv'))
+
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+
+    # ASGIではレスポンスの中身をイベントループで読み出すので、API呼び出しとDBへの保存はその前に済ませる
+    def test_keyword_csv_under_asgi(self):
+        async def download():
+            # Django 3.1 の AsyncClient は get() の data をクエリ文字列にしないので、URLに付ける
+            query = urlencode(dict(KEYWORD_FORM, items_count=120, format='csv'))
+            response = await AsyncClient().get('%s?%s' % (reverse('keyword_export'), query))
+            return response.status_code, b''.join(response.streaming_content)
+
+        status_code, content = async_to_sync(download)()
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(content.decode('utf-8-sig').splitlines()), 121)
+        self.assertEqual(self.youtube.calls['search'], 3)
+        self.assertEqual(Video.objects.count(), 120)
+
+
+
+class TracingTests(YouTubeTestCase):
+    def setUp(self):
+        super().setUp()
+        tracing.get_stats().clear()
+
+    def test_server_timing_header(self):
+        response = self.client.post(reverse('index'), KEYWORD_FORM)
+
+        metrics = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        for name in ('search_video', 'api.search', 'api.videos', 'get_channel', 'make_df', 'total'):
+            self.assertIn(name, metrics)
+
+    def test_related_stages_are_aggregated(self):
+        response = self.client.post(reverse('related'), RELATED_FORM)
+        self.client.get(response['Location'])
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        stages = self.client.get(reverse('timings')).json()['stages']
+        for name in ('job.related', 'stage.related_list', 'search_relatedvideo', 'make_related_df'):
+            self.assertIn(name, stages)
+        self.assertEqual(stages['api.search']['count'], 8)
+        self.assertLessEqual(stages['api.search']['p50_ms'], stages['api.search']['p95_ms'])
+
+    def test_reports_are_staff_only(self):
+        for name in ('timings', 'quota'):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response['Location'].startswith(reverse('admin:login')))
+
+        self.client.force_login(User.objects.create_user('user'))
+        self.assertEqual(self.client.get(reverse('quota')).status_code, 302)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(reverse('quota')).status_code, 200)
+
+    def test_sampled_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(TRACING=dict(settings.TRACING, PROFILE_RATE=1.0, PROFILE_DIR=directory)):
+                self.client.post(reverse('index'), KEYWORD_FORM)
+                profiles = os.listdir(directory)
+
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].endswith('.prof'))
+
+
+
+@override_settings(CACHES=TEST_CACHES)
+class GrowthTests(TestCase):
+    day = date(2023, 1, 10)
+
+    def setUp(self):
+        caches['youtube'].clear()
+        channel = Channel.objects.create(channel_id='UCrival1', title='rival')
+        first = Video.objects.create(video_id='v1', channel=channel, title='first', published_at=date(2023, 1, 1))
+        second = Video.objects.create(video_id='v2', channel=channel, title='second', published_at=date(2023, 1, 5))
+        # v1：1日100回 → 1日300回、v2：統計データ1件だけ(非公開の高評価数)
+        for days, view_count in [(0, 1000), (1, 1100), (2, 1400)]:
+            fetched_at = timezone.make_aware(datetime(2023, 1, 7 + days, 12))
+            VideoStatistics.objects.create(video=first, fetched_at=fetched_at, view_count=view_count, like_count=view_count // 10, comment_count=10)
+        VideoStatistics.objects.create(video=second, fetched_at=timezone.make_aware(datetime(2023, 1, 9, 12)), view_count=500)
+
+    def test_growth_per_video_and_channel(self):
+        video_rows, channel_rows = growth.get_growth(self.day, 30)
+
+        self.assertEqual([row.video_id for row in video_rows], ['v1', 'v2'])
+        first, second = video_rows
+        self.assertEqual((first.view_count, first.views_per_day, first.acceleration, first.snapshots), (1400, 200.0, 200.0, 3))
+        self.assertEqual((first.like_ratio, first.comment_ratio), (0.1, 0.0071))
+        # 統計データ1件だけの動画は公開日からの平均
+        self.assertEqual((second.views_per_day, second.like_ratio, second.acceleration), (100.0, None, None))
+
+        channel = channel_rows[0]
+        self.assertEqual((channel.videos, channel.view_count, channel.views_per_day), (2, 1900, 300.0))
+        self.assertEqual(channel.like_ratio, 0.1)
+
+    # キャッシュから返した古い数値を後の日時で保存したもの(同じ数値が続く統計データ)は使わない
+    def test_repeated_snapshots_are_ignored(self):
+        first = Video.objects.get(pk='v1')
+        for hour in (18, 22):
+            VideoStatistics.objects.create(
+                video=first, fetched_at=timezone.make_aware(datetime(2023, 1, 8, hour)),
+                view_count=1100, like_count=110, comment_count=10,
+            )
+
+        video_rows, channel_rows = growth.get_growth(self.day, 30)
+
+        first = video_rows[0]
+        self.assertEqual((first.view_count, first.views_per_day, first.acceleration, first.snapshots), (1400, 200.0, 200.0, 3))
+
+    def test_growth_page(self):
+        with mock.patch('django.utils.timezone.localdate', return_value=self.day):
+            response = self.client.get(reverse('growth'), {'channel': 'UCrival1'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['video_rows']), 2)
+        self.assertContains(response, 'second')
+
+    def test_growth_is_cached_per_day(self):
+        growth.get_growth(self.day, 30)
+        with self.assertNumQueries(0):
+            growth.get_growth(self.day, 30)
+
+        # 期間外の統計データは使わない
+        self.assertEqual(growth.get_growth(date(2023, 1, 7), 30)[0][0].snapshots, 1)
+
+
+
+@override_settings(CACHES=TEST_CACHES, SINGLE_FLIGHT=dict(settings.SINGLE_FLIGHT, POLL_INTERVAL=0.01))
+# ロックはDBに作成するので、スレッド(他のワーカーの代わり)からも見えるように TransactionTestCase にする
+class SingleFlightTests(TransactionTestCase):
+    def setUp(self):
+        caches['youtube'].clear()
+
+    def test_concurrent_calls_share_one_run(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def search():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return ['row']
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(singleflight.run('key', search)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(singleflight.run('key', search))) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [['row']] * 4)
+
+    def test_waits_for_other_worker(self):
+        # 他のワーカーがロックを取って実行中
+        SingleFlightLock.objects.create(key='key', expires_at=timezone.now() + timedelta(minutes=1))
+        timer = threading.Timer(0.05, lambda: caches['youtube'].set('singleflight:result:key', ['other']))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(singleflight.run('key', mock.Mock(side_effect=AssertionError)), ['other'])
+
+    def test_failure_releases_lock(self):
+        with self.assertRaises(QuotaExceeded):
+            singleflight.run('key', mock.Mock(side_effect=QuotaExceeded('quota')))
+
+        self.assertEqual(singleflight.run('key', lambda: ['retry']), ['retry'])
+
+    def test_lock_is_taken_once(self):
+        self.assertTrue(singleflight._lock('key'))
+        self.assertFalse(singleflight._lock('key'))
+
+        # 期限切れのロック(止まったワーカーのもの)は取り直す
+        SingleFlightLock.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(singleflight._lock('key'))
+        singleflight._release('key', True)
+        self.assertFalse(SingleFlightLock.objects.exists())
+
+    def test_async_calls_share_one_task(self):
+        calls = []
+
+        async def search():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ['row']
+
+        async def main():
+            return await asyncio.gather(*[singleflight.run_async('key', search) for i in range(3)])
+
+        self.assertEqual(asyncio.run(main()), [['row']] * 3)
+        self.assertEqual(calls, [1])
+
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = directory.name
+
+    # デフォルトはファイルのキャッシュ(ワーカー間で共有し、再起動後も残る)
+    def test_default_backend_is_shared_files(self):
+        with self.settings(YOUTUBE_CACHE=dict(settings.YOUTUBE_CACHE, LOCATION=self.location)):
+            cache = get_response_cache()
+            self.assertIsInstance(cache.backend, FileBackend)
+            cache.set('videos', {'id': '1'}, ['video 1'])
+
+            # 別のワーカー(または再起動後)のキャッシュからも読める
+            other = ResponseCache(FileBackend(self.location), settings.YOUTUBE_CACHE['TTL'])
+            self.assertEqual(other.get('videos', {'id': '1'}), ['video 1'])
+            self.assertIsNone(other.get('videos', {'id': '2'}))
+
+    def test_entries_expire_after_ttl(self):
+        cache = ResponseCache(LocMemBackend(10), {'search': 60, 'videos': 0}, stale=600)
+        cache.set('search', {'q': 'a'}, ['search a'])
+        # 有効期限のないエンドポイントはキャッシュしない
+        cache.set('videos', {'id': '1'}, ['video 1'])
+        self.assertEqual(cache.get('search', {'q': 'a'}), ['search a'])
+        self.assertIsNone(cache.get('videos', {'id': '1'}))
+
+        # 有効期限が切れたら get() では返さず、STALE 秒までは get_stale() で返す
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('search', {'q': 'a'}))
+            self.assertEqual(cache.get_stale('search', {'q': 'a'})[0], ['search a'])
+        # (LocMemBackend は time.monotonic() で期限を判定する)
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61 + 600):
+            self.assertIsNone(cache.get_stale('search', {'q': 'a'}))
+
+    def test_keys_are_normalized(self):
+        key = ResponseCache.make_key('search', {'q': 'python', 'maxResults': 50, 'pageToken': None})
+        self.assertEqual(ResponseCache.make_key('search', {'maxResults': '50', 'q': ' python '}), key)
+        self.assertNotEqual(ResponseCache.make_key('search', {'q': 'django', 'maxResults': 50}), key)
+        self.assertNotEqual(ResponseCache.make_key('videos', {'q': 'python', 'maxResults': 50}), key)
+
+    def test_hits_and_misses_are_counted(self):
+        cache = ResponseCache(LocMemBackend(10), settings.YOUTUBE_CACHE['TTL'])
+        cache.get('search', {'q': 'a'})
+        cache.set('search', {'q': 'a'}, ['search a'])
+        cache.get('search', {'q': 'a'})
+        cache.get('search', {'q': 'a'})
+        cache.get_stale('videos', {'id': '1'})
+        cache.set('videos', {'id': '1'}, ['video 1'])
+        cache.get_stale('videos', {'id': '1'})
+
+        self.assertEqual(cache.stats(), {
+            'search': {'hits': 2, 'misses': 1, 'stale_hits': 0},
+            'videos': {'hits': 0, 'misses': 0, 'stale_hits': 1},
+        })
+
+    def test_evicts_cheap_entries_first(self):
+        for backend in (LocMemBackend(3), FileBackend(self.location, 3)):
+            cache = ResponseCache(backend, settings.YOUTUBE_CACHE['TTL'])
+            cache.set('search', {'q': 'a'}, ['search a'], QUOTA_COST['search'])
+            cache.set('videos', {'id': '1'}, ['video 1'], QUOTA_COST['videos'])
+            cache.set('search', {'q': 'b'}, ['search b'], QUOTA_COST['search'])
+            # ファイルの更新日時(使った順)が同じにならないように進める
+            with mock.patch('time.time', return_value=time.time() + 1):
+                cache.set('videos', {'id': '2'}, ['video 2'], QUOTA_COST['videos'])
+
+            # あふれた分は、一番古い search ではなく videos(再取得のクォータが安い)から捨てる
+            self.assertIsNone(cache.get('videos', {'id': '1'}))
+            self.assertEqual(cache.get('search', {'q': 'a'}), ['search a'])
+            self.assertEqual(cache.get('search', {'q': 'b'}), ['search b'])
+
+    def test_file_backend_drops_expired_entries(self):
+        backend = FileBackend(self.location, 2)
+        backend.set('old', 'old', -1)
+        backend.set('new', 'new', 60)
+        backend.set('newer', 'newer', 60)
+
+        self.assertIsNone(backend.get('old'))
+        self.assertEqual((backend.get('new'), backend.get('newer')), ('new', 'newer'))
+
+
+
+# クォータの記録とレート制限(リトライは待たない)
+@override_settings(YOUTUBE_QUOTA=dict(settings.YOUTUBE_QUOTA, BACKOFF=0))
+class QuotaTests(YouTubeTestCase):
+    def search(self, q='python'):
+        return youtube.call('search', part='snippet', q=q, maxResults=5)
+
+    def test_usage_is_recorded_per_endpoint(self):
+        self.youtube.latency = 0.01
+        self.client.post(reverse('index'), KEYWORD_FORM)
+
+        usage = quota.usage()
+        self.assertEqual({endpoint: (counts['calls'], counts['units']) for endpoint, counts in usage.items()}, {
+            'search': (1, 100), 'videos': (1, 1), 'channels': (1, 1), 'playlistItems': (0, 0),
+        })
+        self.assertGreaterEqual(usage['search']['avg_latency_ms'], 10)
+        self.assertEqual(quota.used_units(), 102)
+        budget = settings.YOUTUBE_QUOTA['DAILY_BUDGET'] - settings.YOUTUBE_QUOTA['RESERVE']
+        self.assertEqual(quota.remaining_units(), budget - 102)
+
+        # キャッシュから返した呼び出しは数えない
+        caches['template_fragments'].clear()
+        self.client.post(reverse('index'), KEYWORD_FORM)
+        self.assertEqual(quota.used_units(), 102)
+
+    # レート制限のエラーは間隔をあけてやり直し、呼び出しの間隔も広げる
+    def test_rate_limit_backs_off(self):
+        self.youtube.fail('search', http_error(429), http_error(403, 'rateLimitExceeded'))
+        bucket = quota.get_bucket()
+
+        with mock.patch('app.quota.time.sleep') as sleep:
+            self.assertEqual(len(self.search()['items']), 5)
+
+        self.assertEqual(self.youtube.calls['search'], 3)
+        self.assertEqual(sleep.call_count, 2)
+        # 2回半分にして、成功した時に少し戻す
+        self.assertEqual(bucket.rate, bucket.max_rate / 4 + bucket.max_rate / 20)
+        # エラーでもクォータは消費される
+        self.assertEqual((quota.usage()['search']['errors'], quota.used_units()), (2, 300))
+
+    def test_token_bucket_rate_is_bounded(self):
+        bucket = quota.TokenBucket(rate=4, burst=1, min_rate=1)
+        for i in range(5):
+            bucket.slow_down()
+        self.assertEqual(bucket.rate, 1)
+        for i in range(100):
+            bucket.speed_up()
+        self.assertEqual(bucket.rate, 4)
+
+    # クォータ切れが返ってきたら、その日は呼び出さずに期限切れのキャッシュで代用する
+    def test_quota_exceeded_degrades_to_stale_cache(self):
+        cached = self.search()
+        self.youtube.fail('search', http_error(403, 'quotaExceeded'))
+
+        later = time.time() + settings.YOUTUBE_CACHE['TTL']['search'] + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.search(), cached)
+            self.assertEqual(quota.remaining_units(), 0)
+            self.assertEqual(self.search(), cached)
+            with self.assertRaises(QuotaExceeded):
+                self.search('django')
+
+        # やり直さず、クォータ切れの後はAPIを呼び出さない
+        self.assertEqual(self.youtube.calls['search'], 2)
+        self.assertEqual(get_response_cache().stats()['search']['stale_hits'], 2)
+
+
+
+class QuotaCacheTests(SimpleTestCase):
+    def test_concurrent_increments_are_not_lost(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = LockedFileBasedCache(directory.name, {})
+        cache.add('count', 0, 60 * 60)
+
+        def increment():
+            for i in range(50):
+                cache.incr('count')
+
+        threads = [threading.Thread(target=increment) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache.get('count'), 400)
+        self.assertFalse(cache.add('count', 0))
+        # 有効期限は add した時のまま
+        with open(cache._key_to_file('count'), 'rb') as f:
+            self.assertGreater(pickle.load(f), time.time() + 60 * 50)
+        with self.assertRaises(ValueError):
+            cache.incr('missing')
+
+    def test_check_requires_atomic_cache(self):
+        self.assertEqual(checks.check_quota_cache(None), [])
+
+        quota_cache = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': tempfile.gettempdir()}
+        with self.settings(CACHES=dict(settings.CACHES, quota=quota_cache)):
+            errors = checks.check_quota_cache(None)
+        self.assertEqual([error.id for error in errors], ['app.E001'])
+
+    # 追加と加算を1回のロックで行うので、add と incr の間に消えても増分は消えない
+    def test_incr_or_add(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = LockedFileBasedCache(directory.name, {})
+
+        def increment():
+            for i in range(50):
+                cache.incr_or_add('count', 2, 60 * 60)
+
+        threads = [threading.Thread(target=increment) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache.get('count'), 800)
+        cache.set('expired', 10, -1)
+        self.assertEqual(cache.incr_or_add('expired', 3, 60), 3)
+
+    # あふれた時は期限切れのものから消す
+    def test_cull_removes_expired_entries_first(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = LockedFileBasedCache(directory.name, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_FREQUENCY': 1}})
+        for i in range(5):
+            cache.set('counter%d' % i, i, 60 * 60)
+        for i in range(5):
+            cache.set('expired%d' % i, i, 1)
+
+        with mock.patch('time.time', return_value=time.time() + 60):
+            cache.set('new', 1, 60 * 60)
+
+        self.assertEqual(cache.get_many(['counter%d' % i for i in range(5)] + ['new']), dict({'counter%d' % i: i for i in range(5)}, new=1))
+
+    @override_settings(CACHES=TEST_CACHES)
+    def test_usage_is_kept_apart_from_responses(self):
+        caches['quota'].clear()
+        quota.record('search', 0.1, 100)
+        caches['youtube'].clear()
+
+        self.assertEqual(quota.used_units(), 100)
+
+
+
+# クライアントは最初に使う時に、同梱のディスカバリードキュメントから1回だけ作る
+class ClientTests(SimpleTestCase):
+    def setUp(self):
+        # 他のテストで作ったクライアントを使わない
+        client = youtube.use_client(None)
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+
+        build = mock.patch('app.youtube.build_from_document', side_effect=lambda *args, **kwargs: object())
+        self.build = build.start()
+        self.addCleanup(build.stop)
+
+    def test_client_is_built_once_from_bundled_document(self):
+        with self.settings(YOUTUBE_API_KEY='key'):
+            clients = fan_out(lambda n: youtube.get_client(), range(8), max_workers=8)
+
+        self.assertEqual(self.build.call_count, 1)
+        self.assertEqual(len(set(map(id, clients))), 1)
+        document, = self.build.call_args.args
+        self.assertEqual(json.loads(document)['name'], 'youtube')
+        self.assertEqual(self.build.call_args.kwargs['developerKey'], 'key')
+
+    def test_client_is_rebuilt_when_api_key_changes(self):
+        with self.settings(YOUTUBE_API_KEY='key'):
+            client = youtube.get_client()
+        with self.settings(YOUTUBE_API_KEY='other'):
+            self.assertIsNot(youtube.get_client(), client)
+        self.assertEqual([call.kwargs['developerKey'] for call in self.build.call_args_list], ['key', 'other'])
+
+
+
+class ApiKeyCheckTests(SimpleTestCase):
+    # テスト以外では、APIキーがないと起動しない
+    def test_check_requires_api_key(self):
+        with self.settings(TESTING=False, YOUTUBE_API_KEY=''):
+            self.assertEqual([error.id for error in checks.check_api_key(None)], ['app.E002'])
+        with self.settings(TESTING=False, YOUTUBE_API_KEY='key'):
+            self.assertEqual(checks.check_api_key(None), [])
+
+
+
+# gzip で返すローカルのHTTPサーバー(接続の数を数える)
+class GzipHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def do_GET(self):
+        GzipHandler.connections.add(self.client_address)
+        body = gzip.compress(json.dumps({'path': self.path}).encode())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+class TransportTests(SimpleTestCase):
+    def setUp(self):
+        GzipHandler.connections.clear()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), GzipHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % server.server_port
+
+    def test_googleapiclient_request_reuses_connection(self):
+        http = transport.create_http()
+        self.addCleanup(http.close)
+        for i in range(3):
+            request = HttpRequest(http, JsonModel().response, '%s/videos?page=%d' % (self.url, i), headers={'accept-encoding': 'gzip'})
+            self.assertEqual(request.execute(), {'path': '/videos?page=%d' % i})
+
+        self.assertEqual(len(GzipHandler.connections), 1)
+
+    def test_sessions_are_per_thread(self):
+        http = transport.create_http()
+        self.addCleanup(http.close)
+        sessions = [http.session()]
+        thread = threading.Thread(target=lambda: sessions.append(http.session()))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertIs(sessions[0].get_adapter(self.url), sessions[1].get_adapter(self.url))
+
+
+
+class MakeDfTests(TestCase):
+    def test_join_dedupes_and_filters(self):
+        search_list = [
+            ['v1', 'c1', '2023-01-01', 'title1', 'channel1'],
+            ['v2', 'c1', '2023-01-02', 'title2', 'channel1'],
+            ['v1', 'c1', '2023-01-03', 'duplicate', 'channel1'],
+        ]
+        channel_list = [['v1', 'img1'], ['v2', 'img1']]
+        count_list = [['v1', '100', '1', '0', '2'], ['v2', '5', '-', '-', '-']]
+
+        youtube_data = make_df(search_list, channel_list, count_list, 10)
+
+        self.assertEqual(len(youtube_data), 1)
+        self.assertEqual(youtube_data[0].title, 'title1')
+        self.assertEqual(youtube_data[0].viewcount, '100')
+        self.assertEqual(youtube_data[0].url, 'https://www.youtube.com/embed/v1')
+
+    def test_typed_statistics(self):
+        search_list = [['v%d' % i, 'c%d' % (i % 2), '2023-01-0%d' % (i + 1), 'title%d' % i, 'channel%d' % (i % 2)] for i in range(3)]
+        channel_list = [['v0', 'img0'], ['v1', 'img1'], ['v2', 'img0']]
+        count_list = views.make_count_list(['v0', 'v1', 'v2'], {'v0': (300, 1, 0, 2), 'v1': (100, None, None, None)}, failed={'v2'})
+
+        youtube_data = make_df(search_list, channel_list, count_list, 200)
+
+        self.assertEqual(count_list[2], ['v2', None, None, None, None])
+        self.assertEqual(youtube_data.columns['viewcount'].values.dtype.name, 'int64')
+        self.assertEqual(youtube_data.columns['publishtime'].dtype.name, 'datetime64[D]')
+        self.assertEqual(youtube_data.columns['channel_id'].to_list(), ['c0', 'c0'])
+        # 取得できなかった v2 は残る
+        self.assertEqual([(row.viewcount, row.likeCount) for row in youtube_data], [('300', '1'), ('?', '?')])
+        self.assertEqual(make_df(search_list, channel_list, count_list, 0)[1].likeCount, '-')
+
+    # 以前の pandas の処理(merge、drop_duplicates、query)と同じ結果になる
+    def test_matches_pandas_pipeline(self):
+        import pandas as pd
+
+        search_list = [
+            ['v%d' % (i % 40), 'c%d' % (i % 7), '2023-01-%02d' % (i % 28 + 1), 'title%d' % i, 'channel%d' % (i % 7)]
+            for i in range(60)
+        ]
+        # (以前の処理はプロフィール画像のない動画の検索結果を落としていたので、全ての動画に画像がある場合で比べる)
+        channel_list = [['v%d' % i, 'img%d' % (i % 7)] for i in range(40)]
+        count_list = [['v%d' % i, i * 37 % 1000, i % 5, 0, i % 11] for i in reversed(range(40))]
+
+        youtube_data = pd.DataFrame(search_list, columns=['videoid', 'channelId', 'publishtime', 'title', 'channeltitle'])
+        youtube_data.drop_duplicates(subset='videoid', inplace=True)
+        youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
+        df_channel = pd.DataFrame(channel_list, columns=['videoid', 'profileImg'])
+        df_viewcount = pd.DataFrame(
+            [[str(value) for value in item] for item in count_list],
+            columns=['videoid', 'viewcount', 'likeCount', 'favoriteCount', 'commentCount'],
+        )
+        youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
+        youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
+        youtube_data['viewcount'] = youtube_data['viewcount'].astype(int)
+        youtube_data = youtube_data.query('viewcount>=' + str(300))
+        youtube_data = youtube_data[list(KeywordRow._fields)]
+        youtube_data['viewcount'] = youtube_data['viewcount'].astype(str)
+        expected = [KeywordRow(*row) for row in youtube_data.itertuples(index=False)]
+
+        self.assertEqual(make_df(search_list, channel_list, count_list, 300).rows(), expected)
+        self.assertGreater(len(expected), 20)
+
+    def test_related_matches_pandas_pipeline(self):
+        import pandas as pd
+
+        related_list = [
+            [i % 5 + 1, 'v%d' % (i % 30), 'UCmychannel', 'mine', 'title%d' % i, '2023-01-%02d' % (i % 28 + 1),
+             'r%d' % (i // 5), 'UCrival', 'rival', 'rival%d' % (i // 5), '2022-12-%02d' % (i // 5 + 1)]
+            for i in range(45)
+        ]
+        channel_list = [['v%d' % i, 'img'] for i in range(30)]
+        count_list = [['v%d' % i, i * 37 % 1000, i % 5, 0, i % 11] for i in range(30)]
+
+        youtube_data = pd.DataFrame(related_list, columns=[
+            'ranking', 'videoid', 'channelid', 'channeltitle', 'title', 'publishtime',
+            'rivalvideoid', 'rivalchannelid', 'rivalchanneltitle', 'rivaltitle', 'rivalpublishtime',
+        ])
+        youtube_data.drop_duplicates(subset='videoid', inplace=True)
+        youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
+        youtube_data['rivalurl'] = 'https://www.youtube.com/embed/' + youtube_data['rivalvideoid']
+        df_channel = pd.DataFrame(channel_list, columns=['videoid', 'profileImg'])
+        df_viewcount = pd.DataFrame(
+            [[str(value) for value in item] for item in count_list],
+            columns=['videoid', 'viewcount', 'likeCount', 'favoriteCount', 'commentCount'],
+        )
+        youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
+        youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
+        expected = [RelatedRow(*row) for row in youtube_data[list(RelatedRow._fields)].itertuples(index=False)]
+
+        self.assertEqual(views.make_related_df(related_list, channel_list, count_list).rows(), expected)
+        self.assertEqual(len(expected), 30)
+
+
+
+class ResultTableTests(SimpleTestCase):
+    def make_table(self, keyword, rows):
+        return make_df(
+            [[videoid, channelid, '2023-01-01', videoid, channelid] for videoid, channelid, viewcount in rows],
+            [],
+            [[videoid, viewcount, None, None, None] for videoid, channelid, viewcount in rows],
+            0,
+        ).assign(keyword=CategoryColumn.repeat(keyword, len(rows)))
+
+    def test_concat_sort_and_sum(self):
+        table = ResultTable.concat(BatchKeywordRow, [
+            self.make_table('python', [('v1', 'c1', 10), ('v2', 'c2', 30)]),
+            self.make_table('django', [('v3', 'c2', 20), ('v4', 'c3', None)]),
+        ])
+
+        self.assertEqual([row.keyword for row in table], ['python', 'python', 'django', 'django'])
+        self.assertEqual(list(table.columns['channel_id'].categories), ['c1', 'c2', 'c3'])
+        self.assertEqual([row.viewcount for row in table.sort('viewcount', descending=True)], ['30', '20', '10', '?'])
+        self.assertEqual([row.keyword for row in table.sort('keyword')], ['django', 'django', 'python', 'python'])
+        self.assertEqual(table.sum_by('keyword', 'viewcount'), [('python', 2, 40), ('django', 2, 20)])
+        self.assertEqual(len(table[1:3]), 2)
@@ -0,0 +1,246 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from pathlib import Path
+import asyncio
+import cProfile
+import functools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# 実行中のリクエスト(またはジョブ)の計測
+_current = ContextVar('trace', default=None)
+
+
+
+# ==================================【計測】=======================================
+# 1回のリクエスト(またはジョブ)の中の段階ごとの処理時間
+# 段階は並列のスレッドからも記録されるので、同じ名前の時間は合計する
+class Trace:
+    def __init__(self, name, **fields):
+        self.name = name
+        self.id = uuid.uuid4().hex[:12]
+        # ログに出力する項目(パス、ステータスなど)
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.finished = None
+        # {段階名: [回数, 合計秒数]}
+        self.spans = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            span = self.spans[name]
+            span[0] += 1
+            span[1] += seconds
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def duration(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    # {段階名: {'count': 回数, 'ms': 合計ミリ秒}}
+    def summary(self):
+        with self._lock:
+            return {
+                name: {'count': count, 'ms': round(seconds * 1000, 1)}
+                for name, (count, seconds) in self.spans.items()
+            }
+
+    # Server-Timing ヘッダーの値(段階名はそのまま metric 名にする)
+    def server_timing(self):
+        metrics = [
+            '%s;desc="%d";dur=%.1f' % (name, span['count'], span['ms'])
+            for name, span in self.summary().items()
+        ]
+        metrics.append('total;dur=%.1f' % (self.duration * 1000))
+        return ', '.join(metrics)
+
+
+
+def current():
+    return _current.get()
+
+
+
+# name の処理時間を計測し、実行中の計測と集計に記録する
+@contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        trace = _current.get()
+        if trace is not None:
+            trace.add(name, seconds)
+        get_stats().add(name, seconds)
+
+
+
+# 関数全体を計測するデコレーター(段階名は関数名。async の関数は終わるまでを計測する)
+def traced(func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(func.__name__):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+
+# 1回のリクエスト(またはジョブ)の計測を開始し、終わったら構造化ログ(JSON)を出力する
+@contextmanager
+def trace(name, **fields):
+    parent = _current.get()
+    trace = Trace(name, **fields)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.finish()
+        # リクエストの中で実行したジョブなどは、リクエストの段階としても記録する
+        if parent is not None:
+            parent.add(name, trace.duration)
+        get_stats().add(name, trace.duration)
+        logger.info(json.dumps(dict(
+            trace.fields,
+            trace=trace.name,
+            trace_id=trace.id,
+            duration_ms=round(trace.duration * 1000, 1),
+            spans=trace.summary(),
+        ), ensure_ascii=False))
+
+
+
+# ==================================【集計】=======================================
+# 段階ごとの直近 TRACING['SAMPLES'] 回の処理時間(プロセスごと)
+class StageStats:
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self._durations:
+                self._durations[name] = deque(maxlen=self.samples)
+            self._durations[name].append(seconds)
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+
+    @staticmethod
+    def percentile(durations, rate):
+        return durations[min(len(durations) - 1, int(len(durations) * rate))]
+
+    # {段階名: {'count', 'p50_ms', 'p95_ms', 'max_ms'}}
+    def summary(self):
+        with self._lock:
+            samples = {name: sorted(durations) for name, durations in self._durations.items()}
+        return {
+            name: {
+                'count': len(durations),
+                'p50_ms': round(self.percentile(durations, 0.5) * 1000, 1),
+                'p95_ms': round(self.percentile(durations, 0.95) * 1000, 1),
+                'max_ms': round(durations[-1] * 1000, 1),
+            }
+            for name, durations in sorted(samples.items())
+        }
+
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+
+def get_stats():
+    global _stats
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                _stats = StageStats(settings.TRACING['SAMPLES'])
+    return _stats
+
+
+
+@receiver(setting_changed)
+def reset_stats(setting, **kwargs):
+    global _stats
+    if setting == 'TRACING':
+        _stats = None
+
+
+
+# ==================================【ミドルウェア】=======================================
+# リクエストごとに計測し、Server-Timing ヘッダーを付ける
+# TRACING['PROFILE_RATE'] の割合のリクエストは cProfile で計測して PROFILE_DIR に保存する
+# (cProfile はリクエストのスレッドだけを計測する。並列で呼び出したAPIは Server-Timing の api.* で見る)
+# ASGIの async のビューの前では async で動く(イベントループでは他のリクエストも動くので、cProfile は使わない)
+class TracingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Django の MiddlewareMixin と同じく、async で呼ばれる場合はコルーチン関数として扱わせる
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        config = settings.TRACING
+        with trace('request', method=request.method, path=request.path) as current_trace:
+            if random.random() < config['PROFILE_RATE']:
+                response = self.profile(request, current_trace, config['PROFILE_DIR'])
+            else:
+                response = self.get_response(request)
+            current_trace.fields['status'] = response.status_code
+        return self.add_server_timing(response, current_trace)
+
+    async def __acall__(self, request):
+        with trace('request', method=request.method, path=request.path) as current_trace:
+            response = await self.get_response(request)
+            current_trace.fields['status'] = response.status_code
+        return self.add_server_timing(response, current_trace)
+
+    def add_server_timing(self, response, current_trace):
+        if settings.TRACING['SERVER_TIMING']:
+            response['Server-Timing'] = current_trace.server_timing()
+        return response
+
+    def profile(self, request, current_trace, directory):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.get_response, request)
+        finally:
+            directory = Path(directory)
+            directory.mkdir(parents=True, exist_ok=True)
+            # 例：20240101-120000-POST-related-<trace_id>.prof
+            path = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'index'
+            filename = '%s-%s-%s-%s.prof' % (time.strftime('%Y%m%d-%H%M%S'), request.method, path, current_trace.id)
+            profiler.dump_stats(str(directory / filename))
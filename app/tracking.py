@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from .concurrency import fan_out
+from .models import ChannelCheckpoint
+from . import growth, store, youtube
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+
+# ==================================【チャンネルの巡回】=======================================
+# 巡回するチャンネル(自分のチャンネル + ライバル)
+def tracked_channel_ids():
+    config = settings.YOUTUBE_TRACKING
+    return youtube.unique_ids(
+        channelid for channelid in [config['MY_CHANNEL_ID'], *config['RIVAL_CHANNEL_IDS']] if channelid
+    )
+
+
+
+# チャンネルデータとアップロード動画の再生リストを取得し、巡回状況を作成する
+def prepare_checkpoints(channel_ids):
+    checkpoints = {
+        checkpoint.channel_id: checkpoint
+        for checkpoint in ChannelCheckpoint.objects.filter(channel_id__in=channel_ids)
+    }
+    missing = [channelid for channelid in channel_ids if not getattr(checkpoints.get(channelid), 'uploads_playlist_id', '')]
+    channels = youtube.fetch_channels(missing, part='snippet,contentDetails')
+    store.save_channels(channels.values())
+
+    for channelid, item in channels.items():
+        checkpoint = checkpoints.get(channelid) or ChannelCheckpoint(channel_id=channelid)
+        checkpoint.uploads_playlist_id = item['contentDetails']['relatedPlaylists']['uploads']
+        checkpoint.save()
+        checkpoints[channelid] = checkpoint
+
+    for channelid in channel_ids:
+        if channelid not in checkpoints:
+            logger.warning('channel %s was not found', channelid)
+    return [checkpoints[channelid] for channelid in channel_ids if channelid in checkpoints]
+
+
+
+# playlistItems().list の1件を [動画ID, チャンネルID, チャンネル名, 動画タイトル, 動画公開日] にする
+# 非公開、削除された動画(公開日時がない)は None
+def parse_playlist_item(item):
+    published_at = item['contentDetails'].get('videoPublishedAt')
+    if not published_at:
+        return None
+    return [
+        item['contentDetails']['videoId'], # 動画ID
+        item['snippet']['channelId'], # チャンネルID
+        item['snippet'].get('channelTitle', ''), # チャンネル名
+        item['snippet']['title'], # 動画タイトル
+        published_at[:10], # 動画公開日
+    ]
+
+
+
+# 1チャンネル分の新しいアップロード動画を読み込む(1ページ1ユニット)
+# 前回の巡回で見つけた一番新しい動画まで(初回は max_videos 件まで)読み込み、ページごとに巡回状況を保存する
+def crawl_channel(checkpoint, max_videos):
+    first_crawl = not checkpoint.latest_video_id
+    page_token = checkpoint.page_token or None
+    while True:
+        result = youtube.call(
+            'playlistItems',
+            part='snippet,contentDetails',
+            playlistId=checkpoint.uploads_playlist_id,
+            maxResults=youtube.MAX_RESULTS_PER_PAGE,
+            pageToken=page_token,
+        )
+
+        # 前回見つけた一番新しい動画より新しいものだけ
+        reached = False
+        videos = []
+        for item in result.get('items', []):
+            if item['contentDetails']['videoId'] == checkpoint.latest_video_id:
+                reached = True
+                break
+            video = parse_playlist_item(item)
+            if video is not None:
+                videos.append(video)
+        store.save_videos(videos)
+
+        if videos and not checkpoint.pending_video_id:
+            checkpoint.pending_video_id = videos[0][0]
+        checkpoint.pending_count += len(videos)
+        page_token = result.get('nextPageToken')
+        checkpoint.page_token = page_token or ''
+
+        limited = first_crawl and checkpoint.pending_count >= max_videos
+        if reached or limited or not page_token:
+            # 巡回が終わった
+            if first_crawl:
+                checkpoint.covered_since = videos[-1][4] if limited and page_token and videos else None
+            checkpoint.latest_video_id = checkpoint.pending_video_id or checkpoint.latest_video_id
+            checkpoint.pending_video_id = ''
+            checkpoint.page_token = ''
+            checkpoint.pending_count = 0
+            checkpoint.crawled_at = timezone.now()
+            checkpoint.save()
+            return
+        checkpoint.save()
+
+
+
+# 1チャンネル分を巡回し、保存済みの動画(新しい順に max_videos 件)の統計データを取り直す
+# 失敗したチャンネルは次の巡回で途中から再開する(他のチャンネルは続ける)
+def track_channel(checkpoint, max_videos, max_age):
+    try:
+        crawl_channel(checkpoint, max_videos)
+        video_ids = list(
+            checkpoint.channel.videos.order_by('-published_at').values_list('pk', flat=True)[:max_videos]
+        )
+        return len(store.refresh_statistics(max_age, video_ids))
+    except Exception:
+        logger.exception('tracking channel %s failed', checkpoint.channel_id)
+        return 0
+    finally:
+        # 並列で実行した場合は、そのスレッドのDB接続を閉じる
+        if threading.current_thread() is not threading.main_thread():
+            close_old_connections()
+
+
+
+# チャンネルを並列(最大 concurrency)で巡回し、取得した統計データの件数を返す
+def track_channels(channel_ids, max_videos=None, max_age=None, concurrency=None):
+    config = settings.YOUTUBE_TRACKING
+    if max_videos is None:
+        max_videos = config['MAX_VIDEOS']
+    if max_age is None:
+        max_age = settings.YOUTUBE_STATISTICS_MAX_AGE
+
+    checkpoints = prepare_checkpoints(channel_ids)
+    counts = fan_out(lambda checkpoint: track_channel(checkpoint, max_videos, max_age), checkpoints, concurrency)
+    # 統計データが増えたので、再生回数の推移を計算し直しておく
+    growth.refresh_growth()
+    return sum(counts)
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+import httplib2
+import os
+import requests
+import threading
+
+
+
+# ==================================【HTTP通信(googleapiclient の http)】=======================================
+# httplib2.Http の代わりに googleapiclient に渡す、requests を使った http
+# 接続プールを持つ HTTPAdapter はワーカープロセスごとに1つ作ってスレッド間で共有し、
+# requests.Session(スレッドセーフではない)はスレッドごとに作って同じ HTTPAdapter を使う
+# (WSGIのスレッド、ASGIの sync_to_async のスレッド、fan_out のスレッドのどこから使っても同じ接続を再利用する)
+class SessionHttp:
+    def __init__(self, adapter, timeout):
+        self.adapter = adapter
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self._local.session = session
+        return self._local.session
+
+    # httplib2.Http.request と同じ引数、戻り値((httplib2.Response, bytes))
+    # googleapiclient は accept-encoding: gzip を付けるので、展開は requests に任せる
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        response = self.session().request(
+            method, uri, data=body, headers=headers,
+            timeout=self.timeout, allow_redirects=redirections > 0,
+        )
+        info = {key.lower(): value for key, value in response.headers.items()}
+        # 展開済みなので、httplib2 と同じく元の content-encoding は -content-encoding に移す
+        if 'content-encoding' in info:
+            info['-content-encoding'] = info.pop('content-encoding')
+        info['content-length'] = str(len(response.content))
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+    def close(self):
+        self.adapter.close()
+
+
+
+# プロセス内で共有する http(最初に使う時に作成。fork した子プロセスでは作り直す)
+_http = None
+_http_pid = None
+_http_lock = threading.Lock()
+
+
+
+def create_http():
+    config = settings.YOUTUBE_HTTP
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['POOL_SIZE'])
+    return SessionHttp(adapter, (config['CONNECT_TIMEOUT'], config['READ_TIMEOUT']))
+
+
+
+def get_http():
+    global _http, _http_pid
+    pid = os.getpid()
+    if _http is None or _http_pid != pid:
+        with _http_lock:
+            if _http is None or _http_pid != pid:
+                _http, _http_pid = create_http(), pid
+    return _http
+
+
+
+# 設定が変わったら作り直す
+@receiver(setting_changed)
+def reset_http(setting, **kwargs):
+    global _http
+    if setting == 'YOUTUBE_HTTP':
+        _http = None
@@ -1,8 +1,27 @@
+from django.conf import settings
 from django.urls import path
 from app import views
 
 
+# ASGIで動かす場合は、キーワード動画検索と関連動画検索を async のビューにする(settings.ASYNC_VIEWS)
+if settings.ASYNC_VIEWS:
+    index_view, related_view = views.AsyncIndexView, views.AsyncRelatedView
+else:
+    index_view, related_view = views.IndexView, views.RelatedView
+
+
 urlpatterns = [
-    path('', views.IndexView.as_view(), name='index'),
-    path('related/', views.RelatedView.as_view(), name='related'),
+    path('', index_view.as_view(), name='index'),
+    path('export/', views.KeywordExportView.as_view(), name='keyword_export'),
+    path('batch/', views.BatchView.as_view(), name='batch'),
+    path('results/<str:result_id>/', views.ResultSetView.as_view(), name='results'),
+    path('related/', related_view.as_view(), name='related'),
+    path('related/export/', views.RelatedExportView.as_view(), name='related_export'),
+    path('related/jobs/<uuid:pk>/', views.RelatedJobView.as_view(), name='related_job'),
+    path('related/jobs/<uuid:pk>/status/', views.RelatedJobStatusView.as_view(), name='related_job_status'),
+    path('related/jobs/<uuid:pk>/retry/', views.RelatedJobRetryView.as_view(), name='related_job_retry'),
+    path('growth/', views.GrowthView.as_view(), name='growth'),
+    path('overlap/', views.OverlapView.as_view(), name='overlap'),
+    path('quota/', views.QuotaView.as_view(), name='quota'),
+    path('timings/', views.TimingView.as_view(), name='timings'),
 ]
@@ -1,302 +1,1027 @@
+from asgiref.sync import sync_to_async
 from django.views.generic import View
-from django.shortcuts import render, redirect
-from apiclient.discovery import build
-from datetime import datetime, timedelta, date
 from django.conf import settings
-from .forms import KeywordForm, RelatedForm
-import pandas as pd
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.paginator import Paginator
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.urls import reverse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, date
+from .forms import BatchKeywordForm, KeywordForm, RelatedForm, ResultFilterForm
+from .concurrency import fan_out, fan_out_flat, submit
+from .models import AnalysisJob
+from .rows import BatchKeywordRow, KeywordRow, RelatedRow
+from .quota import QUOTA_COST, QuotaExceeded
+from .table import UNAVAILABLE, CategoryColumn, IntColumn, ResultTable, date_column, statistics_columns, string_column
+from . import aio, export, growth, jobs, overlap, quota, results, singleflight, store, tracing, youtube
+from urllib.parse import urlencode
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+
 
+logger = logging.getLogger(__name__)
 
+# 一部のデータを取得できなかった時のメッセージ(検索結果、関連動画検索のジョブ)
+PARTIAL_MESSAGE = '一部のデータを取得できませんでした(再生回数などは「%s」)。もう一度検索すると、取得できなかった部分だけ取り直します' % UNAVAILABLE
+PARTIAL_JOB_MESSAGE = '一部のデータを取得できませんでした(再生回数などは「%s」)。「取り直す」で、取得できなかった部分だけ取り直します' % UNAVAILABLE
 
-# 環境変数の読み込み
-YOUTUBE_API = build('youtube', 'v3', developerKey=settings.YOUTUBE_API_KEY)
+# 保存した検索結果の期限が切れた時のメッセージ
+RESULT_EXPIRED_MESSAGE = '検索結果の保存期間が過ぎました。もう一度検索してください'
 
 
 
 # ==================================【キーワード動画検索】=======================================
-# キーワード動画検索
-def search_video(keyword, items_count, order, search_start, search_end):
-    # youtube.search
-    result = YOUTUBE_API.search().list(
-        part='snippet',
+# 検索結果の1件を [動画ID, チャンネルID, 動画公開日時, 動画タイトル, チャンネル名] にする
+def parse_search_item(item):
+    published_at = datetime.strptime(item['snippet']['publishedAt'], '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
+    return [
+        item['id']['videoId'], # 動画ID
+        item['snippet']['channelId'], # チャンネルID
+        published_at, # 動画公開日時
+        item['snippet']['title'], # 動画タイトル
+        item['snippet']['channelTitle'], # チャンネル名
+    ]
+
+
+
+# キーワード動画検索の search().list のパラメータ
+def keyword_search_params(keyword, order, search_start, search_end):
+    return {
+        'part': 'snippet',
         # 検索したい文字列を指定
-        q=keyword,
-        # 1回の試行における最大の取得数
-        maxResults=items_count,
+        'q': keyword,
         # 順番
-        order=order,
+        'order': order,
         # 検索開始日
-        publishedAfter=search_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'publishedAfter': search_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
         # 検索終了日
-        publishedBefore=search_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'publishedBefore': search_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
         # 動画タイプ
-        type='video',
+        'type': 'video',
         # 地域コード
-        regionCode='JP',
-    ).execute()
+        'regionCode': 'JP',
+    }
+
 
 
+# 再生回数で絞り込まない場合は items_count 件だけ読み込む
+# 絞り込む場合は条件を満たさない動画の分も、YOUTUBE_SEARCH_MAX_RESULTS 件まで読み込む(items_count 件集まったら止める)
+# どちらも YOUTUBE_SEARCH_MAX_RESULTS 件を超えては読み込まない
+def keyword_search_limit(items_count, viewcount):
+    limit = settings.YOUTUBE_SEARCH_MAX_RESULTS if viewcount > 0 else items_count
+    return min(limit, settings.YOUTUBE_SEARCH_MAX_RESULTS)
+
+
+
+# キーワード動画検索
+# 再生回数が viewcount 以上の動画が items_count 件集まるまで、検索結果を1ページ(最大50件)ずつ読み込む
+# (読み込むのは YOUTUBE_SEARCH_MAX_RESULTS 件まで)
+# 読み込んだページの統計データの取得と、次のページの検索は並行して行う
+# 戻り値：(検索データのリスト, 統計データのリスト)
+@tracing.traced
+def search_video(keyword, items_count, viewcount, order, search_start, search_end):
+    pages = youtube.iter_search_pages(
+        keyword_search_limit(items_count, viewcount),
+        **keyword_search_params(keyword, order, search_start, search_end)
+    )
 
-    # 検索データを取得
     search_list = []
-    for item in result['items']:
-        published_at = datetime.strptime(item['snippet']['publishedAt'], '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
-        search_list.append([
-            item['id']['videoId'], # 動画ID
-            item['snippet']['channelId'], # チャンネルID
-            published_at, # 動画公開日時
-            item['snippet']['title'], # 動画タイトル
-            item['snippet']['channelTitle'], # チャンネル名
-        ])
-    return search_list
+    statistics = {}
+    seen = set()
+    passed = 0
+
+    # 1ページ分の統計データを受け取り、条件を満たす動画を数える(items_count 件に達したら残りは捨てる)
+    def collect(page, future):
+        nonlocal passed
+        statistics.update(fetched_statistics(future.result()))
+        for item in page:
+            if passed >= items_count:
+                break
+            # 前のページと重複した動画は数えない
+            if item[0] in seen:
+                continue
+            seen.add(item[0])
+            search_list.append(item)
+            if item[0] in statistics and statistics[item[0]][0] >= viewcount:
+                passed += 1
+
+    # 統計データの取得に失敗した動画は、統計データなし(UNAVAILABLE)の行にする
+    with youtube.collect_failures() as failures, ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        while passed < items_count:
+            # 統計データ待ちのページで items_count 件に達する可能性がある場合は、先に結果を待つ
+            # (次のページの検索が無駄にならないように)
+            if pending is not None and passed + len(pending[0]) >= items_count:
+                collect(*pending)
+                pending = None
+                continue
+
+            items = next(pages, None)
+            if pending is not None:
+                collect(*pending)
+                pending = None
+            if items is None:
+                break
+
+            # 検索データを取得して保存
+            page = [parse_search_item(item) for item in items]
+            store.save_videos(
+                [videoid, channelid, channeltitle, title, published_at]
+                for videoid, channelid, published_at, title, channeltitle in page
+            )
+
+            # 保存済みの統計データが新しい動画はDBから、それ以外はAPIから取得(次のページの検索と並行)
+            statistics.update(stored_statistics(item[0] for item in page))
+            future = submit(executor, youtube.fetch_videos, [
+                item[0] for item in page if item[0] not in statistics
+            ])
+            pending = (page, future)
+
+        if pending is not None:
+            collect(*pending)
+    pages.close()
+
+    videoid_list = {item[0]: item[1] for item in search_list}
+    return search_list, make_count_list(videoid_list, statistics, failures['videos'])
 
 
 
 # チャンネルデータ取得(プロフィール画像取得)
+@tracing.traced
 def get_channel(videoid_list):
+    # 保存済みのプロフィール画像が新しいチャンネルはDBから取得
+    thumbnails = store.channel_thumbnails(videoid_list.values())
+
+    # それ以外は、チャンネルIDの重複を除いてから50件ずつ取得
+    channels = youtube.fetch_channels([
+        channelid for channelid in videoid_list.values() if channelid not in thumbnails
+    ])
+    store.save_channels(channels.values())
+    return make_channel_list(videoid_list, thumbnails, channels)
+
+
+
+# 保存済みのプロフィール画像とAPIで取得したチャンネルデータを [動画ID, プロフィール画像] のリストにする
+def make_channel_list(videoid_list, thumbnails, channels):
+    for channelid, item in channels.items():
+        thumbnails[channelid] = item['snippet']['thumbnails']['default']['url']
+
     channel_list = []
     for videoid, channelid in videoid_list.items():
-        # youtube.channels
-        result = YOUTUBE_API.channels().list(
-            part='snippet',
-            id=channelid,
-        ).execute()
-
-        for item in result['items']:
+        if channelid in thumbnails:
             channel_list.append([
                 videoid, # 動画ID
-                item['snippet']['thumbnails']['default']['url'], # プロフィール画像
+                thumbnails[channelid], # プロフィール画像
             ])
     return channel_list
 
 
 
-# 動画データ取得
-def get_video(videoid_list):
+# 保存済みの統計データのうち新しいもの {動画ID: (再生回数, 高評価数, お気に入り数, コメント数)}
+def stored_statistics(videoids):
+    return {
+        videoid: (snapshot.view_count, snapshot.like_count, snapshot.favorite_count, snapshot.comment_count)
+        for videoid, snapshot in store.latest_statistics(videoids).items()
+    }
+
+
+
+# APIで取得した統計データ(youtube.fetch_videos の結果)を保存し、{動画ID: (再生回数, 高評価数, お気に入り数, コメント数)} にする
+def fetched_statistics(videos):
+    store.save_statistics(videos)
+    return {
+        videoid: store.parse_statistics(item['statistics'])
+        for videoid, item in videos.items()
+    }
+
+
+
+# 統計データを [動画ID, 再生回数, 高評価数, お気に入り数, コメント数] のリストにする(数値のまま)
+# 高評価数、お気に入り数、コメント数が公開されてない場合は None
+# failed：統計データの取得に失敗した動画ID(削除された動画とは違い、全て None の行にする)
+def make_count_list(videoid_list, statistics, failed=()):
     count_list = []
-    for videoid, channelid in videoid_list.items():
-        # youtube.videos
-        result = YOUTUBE_API.videos().list(
-            part='statistics',
-            maxResults=50,
-            id=videoid
-        ).execute()
-
-        for item in result['items']:
-            try:
-                likeCount = item['statistics']['likeCount']
-                favoriteCount = item['statistics']['favoriteCount']
-                commentCount = item['statistics']['commentCount']
-            except KeyError: # 高評価数、お気に入り数、コメント数が公開されてない場合
-                likeCount = '-'
-                favoriteCount = '-'
-                commentCount = '-'
-
-            count_list.append([
-                item['id'], # 動画ID
-                item['statistics']['viewCount'], # 視聴回数
-                likeCount, # 高評価数
-                favoriteCount, # お気に入り数
-                commentCount, # コメント数
-            ])
+    for videoid in videoid_list:
+        if videoid in statistics:
+            count_list.append([videoid, *statistics[videoid]])
+        elif videoid in failed:
+            count_list.append([videoid, None, None, None, None])
     return count_list
 
 
 
-# 動画データをデータフレーム化する
+# 動画データ取得
+@tracing.traced
+def get_video(videoid_list):
+    # 保存済みの統計データが新しい動画はDBから取得
+    statistics = stored_statistics(videoid_list)
+
+    # それ以外は、動画IDを50件ずつまとめて取得
+    with youtube.collect_failures() as failures:
+        statistics.update(fetched_statistics(youtube.fetch_videos([
+            videoid for videoid in videoid_list if videoid not in statistics
+        ])))
+
+    return make_count_list(videoid_list, statistics, failures['videos'])
+
+
+
+# 動画データを結合して表(行データは KeywordRow)にする
+@tracing.traced
 def make_df(search_list, channel_list, count_list, viewcount):
-    # データフレームの作成
-    youtube_data = pd.DataFrame(search_list, columns=[
-        'videoid',
-        'channelId',
-        'publishtime',
-        'title',
-        'channeltitle'
-    ])
+    # 動画IDをキーにした辞書を作成(重複した動画は最初のものを使う)
+    search_data = {}
+    for item in search_list:
+        search_data.setdefault(item[0], item)
+    profile_images = dict(channel_list)
 
-    # 重複の削除 subsetで重複を判定する列を指定,inplace=Trueでデータフレームを新しくするかを指定
-    youtube_data.drop_duplicates(subset='videoid', inplace=True)
+    # 統計データの順番で結合
+    count_list = [item for item in count_list if item[0] in search_data]
+    search_list = [search_data[item[0]] for item in count_list]
+    youtube_data = ResultTable(KeywordRow, {
+        'video_id': string_column(item[0] for item in count_list),
+        'channel_id': CategoryColumn.from_values([item[1] for item in search_list]),
+        'publishtime': date_column(item[2] for item in search_list),
+        'title': string_column(item[3] for item in search_list),
+        'channeltitle': CategoryColumn.from_values([item[4] for item in search_list]),
+        'profileImg': CategoryColumn.from_values([profile_images.get(item[0]) for item in count_list]),
+        **statistics_columns(count_list),
+    })
 
-    # 埋め込み動画のURL
-    youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
+    # 再生回数が条件を満たす行だけを抽出(統計データを取得できなかった動画は、再生回数で絞り込まずに残す)
+    views = youtube_data.columns['viewcount']
+    return youtube_data.filter(views.mask | (views.values >= viewcount))
 
-    # データフレームの作成
-    df_channel = pd.DataFrame(channel_list, columns=[
-        'videoid',
-        'profileImg'
-    ])
-    df_viewcount = pd.DataFrame(count_list, columns=[
-        'videoid',
-        'viewcount',
-        'likeCount',
-        'favoriteCount',
-        'commentCount'
-    ])
 
-    # 2つのデータフレームのマージ
-    youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
-    youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
 
-    # viewcountの列のデータを条件検索のためにint型にする(元データも変更)
-    youtube_data['viewcount'] = youtube_data['viewcount'].astype(int)
+# search() の結果と、一部のデータを取得できなかったかどうか (結果, True/False)
+def collect_partial(search):
+    with youtube.collect_failures() as failures:
+        result = search()
+    return result, bool(failures)
 
-    # データフレームの条件を満たす行だけを抽出
-    youtube_data = youtube_data.query('viewcount>=' + str(viewcount))
 
-    youtube_data = youtube_data[[
-        'publishtime',
-        'title',
-        'channeltitle',
-        'url',
-        'profileImg',
-        'viewcount',
-        'likeCount',
-        'favoriteCount',
-        'commentCount',
-    ]]
 
-    youtube_data['viewcount'] = youtube_data['viewcount'].astype(str)
+async def collect_partial_async(search):
+    with youtube.collect_failures() as failures:
+        result = await search()
+    return result, bool(failures)
+
+
+
+# 全てのデータを取得できた結果(一部を取得できなかった結果は、他のワーカーやキャッシュで使い回さない)
+def is_complete(result):
+    return not result[1]
+
+
+
+# キーワード動画検索の全体(検索 → チャンネルデータ → 行データ)
+# 同じ検索条件の検索が実行中なら、その結果を待って使う(result_key：make_search_key の検索条件のキー)
+# 戻り値：(行データのリスト, 一部のデータを取得できなかったかどうか)
+def keyword_search(result_key, keyword, items_count, viewcount, order, search_start, search_end):
+    def search():
+        # 途中でクォータが切れないように、足りない場合は最初から実行しない
+        quota.ensure_available(estimate_keyword_units(keyword, items_count, viewcount, order, search_start, search_end))
+
+        # 動画検索(統計データも取得する)
+        search_list, count_list = search_video(keyword, items_count, viewcount, order, search_start, search_end)
+
+        # 動画IDリスト作成
+        videoid_list = {}
+        for item in search_list:
+            # key：動画ID
+            # value：チャンネルID
+            videoid_list[item[0]] = item[1]
+
+        # チャンネルデータ取得
+        channel_list = get_channel(videoid_list)
+
+        # 動画データを行データにする
+        return make_df(search_list, channel_list, count_list, viewcount)
+
+    return singleflight.run(result_key, lambda: collect_partial(search), share=is_complete)
+
+
+
+# キーワード動画検索で使うクォータの見積もり(最大。キャッシュ済みのページは数えない)
+def estimate_keyword_units(keyword, items_count, viewcount, order, search_start, search_end):
+    items, pages = youtube.cached_search_pages(
+        keyword_search_limit(items_count, viewcount),
+        **keyword_search_params(keyword, order, search_start, search_end)
+    )
+    return QUOTA_COST['search'] * pages
+
+
+
+# ==================================【キーワード一括検索】=======================================
+# 複数のキーワードの動画検索
+# キーワードごとの次のページの検索は並列で行い、統計データは全キーワードの新しい動画IDをまとめて1回で取得する
+# (複数のキーワードでヒットした動画の統計データは1回だけ取得する)
+# 戻り値：({キーワード: 検索データのリスト}, 統計データのリスト)
+@tracing.traced
+def search_keywords(keywords, items_count, viewcount, order, search_start, search_end):
+    pages = {
+        keyword: youtube.iter_search_pages(
+            keyword_search_limit(items_count, viewcount),
+            **keyword_search_params(keyword, order, search_start, search_end)
+        )
+        for keyword in keywords
+    }
+    search_lists = {keyword: [] for keyword in keywords}
+    seen = {keyword: set() for keyword in keywords}
+    passed = dict.fromkeys(keywords, 0)
+    statistics = {}
+
+    with youtube.collect_failures() as failures:
+        try:
+            active = list(keywords)
+            while active:
+                # 条件を満たす動画が足りないキーワードだけ、次のページを並列で検索
+                results = fan_out(lambda keyword: next(pages[keyword], None), active)
+                round_pages = [
+                    (keyword, [parse_search_item(item) for item in items])
+                    for keyword, items in zip(active, results)
+                    if items
+                ]
+
+                # 検索データを保存し、まだ統計データのない動画だけまとめて取得
+                store.save_videos(
+                    [videoid, channelid, channeltitle, title, published_at]
+                    for keyword, page in round_pages
+                    for videoid, channelid, published_at, title, channeltitle in page
+                )
+                videoids = youtube.unique_ids(item[0] for keyword, page in round_pages for item in page)
+                statistics.update(stored_statistics(videoid for videoid in videoids if videoid not in statistics))
+                statistics.update(fetched_statistics(youtube.fetch_videos([
+                    videoid for videoid in videoids if videoid not in statistics
+                ])))
+
+                # キーワードごとに条件を満たす動画を数える(items_count 件に達したら残りは捨てる)
+                active = []
+                for keyword, page in round_pages:
+                    for item in page:
+                        if passed[keyword] >= items_count:
+                            break
+                        # 前のページと重複した動画は数えない
+                        if item[0] in seen[keyword]:
+                            continue
+                        seen[keyword].add(item[0])
+                        search_lists[keyword].append(item)
+                        if item[0] in statistics and statistics[item[0]][0] >= viewcount:
+                            passed[keyword] += 1
+                    if passed[keyword] < items_count:
+                        active.append(keyword)
+        finally:
+            for keyword_pages in pages.values():
+                keyword_pages.close()
+
+    videoid_list = {item[0]: item[1] for search_list in search_lists.values() for item in search_list}
+    return search_lists, make_count_list(videoid_list, statistics, failures['videos'])
+
+
+
+# キーワードごとの動画データを結合し、キーワードの列を付けてつなげた表(行データは BatchKeywordRow)にする
+def make_batch_df(search_lists, channel_list, count_list, viewcount):
+    counts = {item[0]: item for item in count_list}
+    tables = []
+    for keyword, search_list in search_lists.items():
+        # キーワードごとの検索結果の順番にする
+        keyword_count_list = [
+            counts[videoid] for videoid in dict.fromkeys(item[0] for item in search_list) if videoid in counts
+        ]
+        table = make_df(search_list, channel_list, keyword_count_list, viewcount)
+        tables.append(table.assign(keyword=CategoryColumn.repeat(keyword, len(table))))
+    return ResultTable.concat(BatchKeywordRow, tables)
+
+
+
+# キーワード一括検索の全体(同じ検索条件の検索が実行中なら、その結果を待って使う)
+# 戻り値：(行データのリスト, 一部のデータを取得できなかったかどうか)
+def batch_search(result_key, keywords, items_count, viewcount, order, search_start, search_end):
+    def search():
+        # 途中でクォータが切れないように、足りない場合は最初から実行しない
+        quota.ensure_available(estimate_batch_units(keywords, items_count, viewcount, order, search_start, search_end))
+
+        # キーワードごとの動画検索(統計データはまとめて取得する)
+        search_lists, count_list = search_keywords(keywords, items_count, viewcount, order, search_start, search_end)
+
+        # チャンネルデータ取得(全キーワード分をまとめて取得する)
+        videoid_list = {}
+        for search_list in search_lists.values():
+            for item in search_list:
+                videoid_list[item[0]] = item[1]
+        channel_list = get_channel(videoid_list)
+
+        # 動画データを行データにする
+        return make_batch_df(search_lists, channel_list, count_list, viewcount)
+
+    return singleflight.run(result_key, lambda: collect_partial(search), share=is_complete)
+
+
+
+# キーワード一括検索で使うクォータの見積もり(最大。キャッシュ済みのページは数えない)
+def estimate_batch_units(keywords, items_count, viewcount, order, search_start, search_end):
+    return sum(
+        estimate_keyword_units(keyword, items_count, viewcount, order, search_start, search_end)
+        for keyword in keywords
+    )
 
-    return youtube_data
 
 
 # ==================================【関連動画検索】=======================================
+# ライバル動画検索の search().list のパラメータ
+def rival_search_params(channelid, rival_order, rival_search_start, rival_search_end):
+    return {
+        'part': 'snippet',
+        # ライバルのチャンネルIDを指定
+        'channelId': channelid,
+        # 順番
+        'order': rival_order,
+        # 検索開始日
+        'publishedAfter': rival_search_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        # 検索終了日
+        'publishedBefore': rival_search_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        # 動画タイプ
+        'type': 'video',
+        # 地域コード
+        'regionCode': 'JP',
+    }
+
+
+
+# 検索結果の1件を [動画ID, チャンネルID, チャンネル名, 動画タイトル, 動画公開日時] にする
+def parse_rivalvideo_item(item):
+    videoid, channelid, published_at, title, channeltitle = parse_search_item(item)
+    return [
+        videoid, # 動画ID
+        channelid, # チャンネルID
+        channeltitle, # チャンネル名
+        title, # 動画タイトル
+        published_at, # 動画公開日時
+    ]
+
+
+
+# 1チャンネル分のライバル動画を1ページ(最大50件)ずつ返すジェネレーター
+def iter_rivalvideo_pages(channelid, rival_items_count, rival_order, rival_search_start, rival_search_end):
+    pages = youtube.iter_search_pages(
+        rival_items_count,
+        **rival_search_params(channelid, rival_order, rival_search_start, rival_search_end)
+    )
+
+    for items in pages:
+        yield [parse_rivalvideo_item(item) for item in items]
+
+
+
 # ライバル動画検索
+@tracing.traced
 def search_rivalvideo(channelid_list, rival_items_count, rival_order, rival_search_start, rival_search_end):
-    # ライバルのチャンネルを検索した動画を入れるリスト
-    rivalvideo_list = []
-
-    for channelid in channelid_list:
-        # youtube.search
-        result = YOUTUBE_API.search().list(
-            part='snippet',
-            # ライバルのチャンネルIDを指定
-            channelId=channelid,
-            # 1回の試行における最大の取得数
-            maxResults=rival_items_count,
-            # 順番
-            order=rival_order,
-            # 検索開始日
-            publishedAfter=rival_search_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            # 検索終了日
-            publishedBefore=rival_search_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
-            # 動画タイプ
-            type='video',
-            # 地域コード
-            regionCode='JP',
-        ).execute()
-
-        for item in result['items']:
-            published_at = datetime.strptime(item['snippet']['publishedAt'], '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
-            rivalvideo_list.append([
-                item['id']['videoId'], # 動画ID
-                item['snippet']['channelId'], # チャンネルID
-                item['snippet']['channelTitle'], # チャンネル名
-                item['snippet']['title'], # 動画タイトル
-                published_at, # 動画公開日時
-            ])
+    # track_channels で巡回済みのチャンネルは、APIを呼び出さずに保存済みのデータを使う(DBはこのスレッドで読む)
+    tracked = {
+        channelid: store.tracked_videos(channelid, rival_order, rival_search_start, rival_search_end, rival_items_count)
+        for channelid in channelid_list
+    }
 
-    return rivalvideo_list
+    # 1チャンネル分の検索(50件を超える場合はページをたどる)
+    def search(channelid):
+        if tracked[channelid] is not None:
+            return tracked[channelid]
+        rivalvideo_list = []
+        for page in iter_rivalvideo_pages(channelid, rival_items_count, rival_order, rival_search_start, rival_search_end):
+            rivalvideo_list.extend(page)
+        return rivalvideo_list
+
+    # チャンネルごとに並列で検索し、チャンネルの順番通りに連結する
+    return fan_out_flat(search, channelid_list)
 
 
 
 # 関連動画検索
+# 同じライバル動画は1回だけ検索し、関連動画の一覧は動画IDごとにキャッシュしたものを使う(youtube.fetch_related)
+@tracing.traced
 def search_relatedvideo(rivalvideo_list, my_channel_id, related_items_count):
-    related_list = []
+    rivalvideos = {}
     for rivalvideo in rivalvideo_list:
-        result = YOUTUBE_API.search().list(
-            part='snippet',
-            # ライバルの動画IDを指定
-            relatedToVideoId=rivalvideo[0],
-            # 1回の試行における最大の取得数
-            maxResults=related_items_count,
-            # 動画タイプ
-            type='video',
-            # 地域コード
-            regionCode='JP',
-        ).execute()
-
-        for item in result['items']:
-            if item.get('snippet', {}).get('channelId') == my_channel_id:
-                published_at = datetime.strptime(item['snippet']['publishedAt'], '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
-                related_list.append([
-                    result['items'].index(item) + 1,
-                    item['id']['videoId'], # 動画ID
-                    item['snippet']['channelId'], # チャンネルID
-                    item['snippet']['channelTitle'], # チャンネル名
-                    item['snippet']['title'], # 動画タイトル
-                    published_at, # 動画公開日時
-                    rivalvideo[0], # ライバル動画ID
-                    rivalvideo[1], # ライバルチャンネルID
-                    rivalvideo[2], # ライバルチャンネル名
-                    rivalvideo[3], # ライバル動画タイトル
-                    rivalvideo[4], # ライバル動画公開日時
-                ])
+        rivalvideos.setdefault(rivalvideo[0], rivalvideo)
+    related = youtube.fetch_related(rivalvideos, related_items_count)
+    # 自分のチャンネル以外の関連動画も、重なりの集計(overlap)のために保存しておく
+    store.save_related(related)
+    return rank_related(rivalvideos, related, my_channel_id)
+
+
+
+# ライバル動画の順番通りに、関連動画の一覧から自分のチャンネルの動画を順位と一緒に取り出す
+# rivalvideos：{ライバル動画ID: ライバル動画}、related：{ライバル動画ID: 関連動画の一覧}
+def rank_related(rivalvideos, related, my_channel_id):
+    related_list = []
+    for rivalvideoid, rivalvideo in rivalvideos.items():
+        for ranking, (videoid, channelid, channeltitle, title, published_at) in enumerate(related[rivalvideoid], 1):
+            if channelid != my_channel_id:
+                continue
+            related_list.append([
+                ranking,
+                videoid, # 動画ID
+                channelid, # チャンネルID
+                channeltitle, # チャンネル名
+                title, # 動画タイトル
+                datetime.strptime(published_at, '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d'), # 動画公開日時
+                rivalvideo[0], # ライバル動画ID
+                rivalvideo[1], # ライバルチャンネルID
+                rivalvideo[2], # ライバルチャンネル名
+                rivalvideo[3], # ライバル動画タイトル
+                rivalvideo[4], # ライバル動画公開日時
+            ])
     return related_list
 
 
 
-# 動画データをデータフレーム化する
+# 動画データを結合して表(行データは RelatedRow)にする
+# related_list の1件：[ランキング, 動画ID, チャンネルID, チャンネル名, 動画タイトル, 動画公開日,
+#                      ライバル動画ID, ライバルチャンネルID, ライバルチャンネル名, ライバル動画タイトル, ライバル動画公開日]
+@tracing.traced
 def make_related_df(related_list, channel_list, count_list):
-    # データフレームの作成
-    youtube_data = pd.DataFrame(related_list, columns=[
-        'ranking', # ランキング
-        'videoid', # 動画ID
-        'channelid', # チャンネルID
-        'channeltitle', # チャンネル名
-        'title', # 動画タイトル
-        'publishtime', # 動画公開日
-        'rivalvideoid', # ライバル動画ID
-        'rivalchannelid', # ライバルチャンネルID
-        'rivalchanneltitle', # ライバルチャンネル名
-        'rivaltitle', # ライバル動画タイトル
-        'rivalpublishtime', # ライバル動画公開日時
-    ])
+    # 動画IDをキーにした辞書を作成(重複した動画は最初のものを使う)
+    related_data = {}
+    for item in related_list:
+        related_data.setdefault(item[1], item)
+    profile_images = dict(channel_list)
+
+    # 統計データの順番で結合
+    count_list = [item for item in count_list if item[0] in related_data]
+    related_list = [related_data[item[0]] for item in count_list]
+    return ResultTable(RelatedRow, {
+        'ranking': IntColumn.from_values([item[0] for item in related_list]),
+        'video_id': string_column(item[1] for item in related_list),
+        'channel_id': CategoryColumn.from_values([item[2] for item in related_list]),
+        'channeltitle': CategoryColumn.from_values([item[3] for item in related_list]),
+        'title': string_column(item[4] for item in related_list),
+        'publishtime': date_column(item[5] for item in related_list),
+        'profileImg': CategoryColumn.from_values([profile_images.get(item[1]) for item in related_list]),
+        # ライバル動画は複数の関連動画で同じなので、番号にする
+        'rivalvideo_id': CategoryColumn.from_values([item[6] for item in related_list]),
+        'rivalchannel_id': CategoryColumn.from_values([item[7] for item in related_list]),
+        'rivalchanneltitle': CategoryColumn.from_values([item[8] for item in related_list]),
+        'rivaltitle': CategoryColumn.from_values([item[9] for item in related_list]),
+        'rivalpublishtime': date_column(item[10] for item in related_list),
+        **statistics_columns(count_list),
+    })
+
+
+
+# ==================================【表示結果のキャッシュ】=======================================
+# 検索条件からキャッシュキーを作成
+def make_search_key(*params):
+    return hashlib.sha1(
+        json.dumps(params, default=str, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+
+
+# 保存済みの検索結果の表
+# 保存期間が過ぎた、または一部のデータを取得できなかった結果は None(検索し直す)
+def load_result(result_key):
+    result = results.load(result_key)
+    if result is None or result['partial']:
+        return None
+    return result['table']
+
+
+
+# ==================================【検索結果の並べ替え・絞り込み・ページ分け】=======================================
+# 検索結果の表を ResultFilterForm の条件で絞り込んで並べ替える(表の配列の計算だけで、APIは呼び出さない)
+def filter_results(youtube_data, form):
+    data = form.cleaned_data if form.is_valid() else {}
+    youtube_data = youtube_data.between('viewcount', low=data.get('min_viewcount'))
+    youtube_data = youtube_data.between('likeCount', low=data.get('min_likes'))
+    youtube_data = youtube_data.between('commentCount', low=data.get('min_comments'))
+    youtube_data = youtube_data.between('publishtime', low=data.get('published_after'), high=data.get('published_before'))
+    if data.get('sort'):
+        youtube_data = youtube_data.sort(data['sort'].lstrip('-'), descending=data['sort'].startswith('-'))
+    return youtube_data
 
-    # 重複の削除 subsetで重複を判定する列を指定,inplace=Trueでデータフレームを新しくするかを指定
-    youtube_data.drop_duplicates(subset='videoid', inplace=True)
 
-    # 動画のURL
-    youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
-    youtube_data['rivalurl'] = 'https://www.youtube.com/embed/' + youtube_data['rivalvideoid']
 
-    # データフレームの作成
-    df_channel = pd.DataFrame(channel_list, columns=[
-        'videoid',
-        'profileImg'
-    ])
-    df_viewcount = pd.DataFrame(count_list, columns=[
-        'videoid',
-        'viewcount',
-        'likeCount',
-        'favoriteCount',
-        'commentCount'
+# 検索結果のページに渡す値
+# youtube_data：検索結果の表全体、results_url：並べ替え、ページ分けのリンク先
+# page(表示する1ページ分。object_list は表)は request.GET の条件で絞り込んで並べ替えた表から作る
+# results、page はテンプレートで使う時に計算する(表示部分の {% cache %} がキャッシュ済みなら計算しない)
+def result_context(request, result_key, youtube_data, partial, results_url):
+    form = ResultFilterForm(request.GET)
+    context = {
+        'youtube_data': youtube_data,
+        'filter_form': form,
+        'results_url': results_url,
+        # ページのリンクに付ける並べ替え、絞り込みのパラメータ
+        'page_query': urlencode([(name, value) for name, value in request.GET.items() if name != 'page']),
+        'result_key': result_key,
+        'query': request.GET.urlencode(),
+        # 一部のデータを取得できなかった表示結果はキャッシュしない(次の検索で取り直す)
+        'fragment_timeout': 0 if partial else settings.RESULT_FRAGMENT_TIMEOUT,
+        # pyarrow、pandas と openpyxl が入っていない環境では、Parquet、Excel のエクスポートのボタンを出さない
+        'parquet_available': export.is_available('parquet'),
+        'xlsx_available': export.is_available('xlsx'),
+    }
+    context['results'] = SimpleLazyObject(lambda: filter_results(youtube_data, form))
+    context['page'] = SimpleLazyObject(
+        lambda: Paginator(context['results'], settings.RESULT_SETS['PAGE_SIZE']).get_page(request.GET.get('page'))
+    )
+    return context
+
+
+
+# キーワード一括検索の結果のページに渡す値(絞り込んだ検索結果のキーワードごとの集計を付ける)
+def batch_result_context(request, result_key, youtube_data, partial, context):
+    context = dict(context, **result_context(request, result_key, youtube_data, partial, reverse('results', args=[result_key])))
+    # キーワードごとの [(キーワード, 動画数, 再生回数の合計)]
+    context['keyword_totals'] = SimpleLazyObject(lambda: context['results'].sum_by('keyword', 'viewcount'))
+    return context
+
+
+
+# ==================================【関連動画検索のジョブ】=======================================
+# ライバル動画を検索
+def related_rival_stage(params, results):
+    rivalvideo_list = search_rivalvideo(
+        params['rival_channel_id'],
+        params['rival_items_count'],
+        params['rival_order'],
+        date.fromisoformat(params['rival_search_start']),
+        date.fromisoformat(params['rival_search_end']),
+    )
+    store.save_videos(rivalvideo_list)
+    return rivalvideo_list
+
+
+
+# 関連動画を検索
+def related_search_stage(params, results):
+    related_list = search_relatedvideo(results['rivalvideo_list'], params['my_channel_id'], params['related_items_count'])
+    store.save_videos(item[1:6] for item in related_list)
+    return related_list
+
+
+
+# 動画IDリスト作成
+def related_videoid_list(results):
+    videoid_list = {}
+    for item in results['related_list']:
+        # key：動画ID
+        # value：チャンネルID
+        videoid_list[item[1]] = item[2]
+    return videoid_list
+
+
+
+# チャンネルデータ取得
+def related_channel_stage(params, results):
+    return get_channel(related_videoid_list(results))
+
+
+
+# 動画データ取得
+def related_video_stage(params, results):
+    return get_video(related_videoid_list(results))
+
+
+
+# 関連動画検索で使うクォータの見積もり(最大)
+# track_channels で巡回済みのチャンネルの動画、キャッシュ済みの検索結果と関連動画の一覧は数えない
+def estimate_related_units(params):
+    rival_search_start = date.fromisoformat(params['rival_search_start'])
+    rival_search_end = date.fromisoformat(params['rival_search_end'])
+    searches = 0
+    rivalvideo_ids = []
+    for channelid in params['rival_channel_id']:
+        rivalvideo_list = store.tracked_videos(
+            channelid, params['rival_order'], rival_search_start, rival_search_end, params['rival_items_count']
+        )
+        if rivalvideo_list is None:
+            items, pages = youtube.cached_search_pages(
+                params['rival_items_count'],
+                **rival_search_params(channelid, params['rival_order'], rival_search_start, rival_search_end)
+            )
+            rivalvideo_list = [parse_rivalvideo_item(item) for item in items]
+            # ライバル動画の検索 + まだ分からないライバル動画の関連動画の検索(1件につき1回)
+            if pages:
+                searches += pages + params['rival_items_count'] - len(items)
+        rivalvideo_ids.extend(rivalvideo[0] for rivalvideo in rivalvideo_list)
+
+    # 分かっているライバル動画の関連動画の検索(キャッシュ済みの動画は検索しない)
+    related, missing = youtube.cached_related(rivalvideo_ids, params['related_items_count'])
+    return QUOTA_COST['search'] * (searches + len(missing))
+
+
+
+# 関連動画検索のフォームからジョブのパラメータを作成
+def related_params(form):
+    # 重複したチャンネルIDは1回だけ検索する
+    rival_channel_id = youtube.unique_ids(
+        channelid.strip() for channelid in form.cleaned_data['rival_channel_id'].split(',') if channelid.strip()
+    )
+    return {
+        'my_channel_id': form.cleaned_data['my_channel_id'],
+        'rival_channel_id': rival_channel_id,
+        'rival_items_count': form.cleaned_data['rival_items_count'],
+        'rival_order': form.cleaned_data['rival_order'],
+        'rival_search_start': form.cleaned_data['rival_search_start'].isoformat(),
+        'rival_search_end': form.cleaned_data['rival_search_end'].isoformat(),
+        'related_items_count': form.cleaned_data['related_items_count'],
+    }
+
+
+
+# 関連動画検索の段階(段階名, 表示名, 関数)
+RELATED_STAGES = [
+    ('rivalvideo_list', 'ライバル動画を検索', related_rival_stage),
+    ('related_list', '関連動画を検索', related_search_stage),
+    ('channel_list', 'チャンネルデータを取得', related_channel_stage),
+    ('count_list', '動画データを取得', related_video_stage),
+]
+
+
+
+# ==================================【async(ASGI)の検索】=======================================
+# 上の検索と同じ結果を返す async 版(APIの呼び出しは aio、DBの読み書きは sync_to_async)
+# ページの検索、チャンネルデータ、統計データの取得は asyncio.gather とタスクで同時に行う
+
+# search_video の async 版(統計データの取得と次のページの検索を同時に行う)
+@tracing.traced
+async def search_video_async(keyword, items_count, viewcount, order, search_start, search_end):
+    pages = aio.iter_search_pages(
+        keyword_search_limit(items_count, viewcount),
+        **keyword_search_params(keyword, order, search_start, search_end)
+    )
+
+    search_list = []
+    statistics = {}
+    seen = set()
+    passed = 0
+
+    # 1ページ分の統計データを受け取り、条件を満たす動画を数える(items_count 件に達したら残りは捨てる)
+    async def collect(page, task):
+        nonlocal passed
+        statistics.update(await sync_to_async(fetched_statistics)(await task))
+        for item in page:
+            if passed >= items_count:
+                break
+            # 前のページと重複した動画は数えない
+            if item[0] in seen:
+                continue
+            seen.add(item[0])
+            search_list.append(item)
+            if item[0] in statistics and statistics[item[0]][0] >= viewcount:
+                passed += 1
+
+    # 検索データを保存し、保存済みの統計データが新しい動画はDBから取得
+    def save_page(page):
+        store.save_videos(
+            [videoid, channelid, channeltitle, title, published_at]
+            for videoid, channelid, published_at, title, channeltitle in page
+        )
+        return stored_statistics(item[0] for item in page)
+
+    with youtube.collect_failures() as failures:
+        pending = None
+        try:
+            while passed < items_count:
+                # 統計データ待ちのページで items_count 件に達する可能性がある場合は、先に結果を待つ
+                if pending is not None and passed + len(pending[0]) >= items_count:
+                    await collect(*pending)
+                    pending = None
+                    continue
+
+                items = await aio.next_page(pages)
+                if pending is not None:
+                    await collect(*pending)
+                    pending = None
+                if items is None:
+                    break
+
+                page = [parse_search_item(item) for item in items]
+                statistics.update(await sync_to_async(save_page)(page))
+                task = asyncio.ensure_future(aio.fetch_videos([
+                    item[0] for item in page if item[0] not in statistics
+                ]))
+                pending = (page, task)
+
+            if pending is not None:
+                await collect(*pending)
+        finally:
+            await pages.aclose()
+
+    videoid_list = {item[0]: item[1] for item in search_list}
+    return search_list, make_count_list(videoid_list, statistics, failures['videos'])
+
+
+
+# keyword_search の async 版
+async def keyword_search_async(result_key, keyword, items_count, viewcount, order, search_start, search_end):
+    async def search():
+        await sync_to_async(lambda: quota.ensure_available(
+            estimate_keyword_units(keyword, items_count, viewcount, order, search_start, search_end)
+        ))()
+        search_list, count_list = await search_video_async(keyword, items_count, viewcount, order, search_start, search_end)
+        videoid_list = {item[0]: item[1] for item in search_list}
+        channel_list = await get_channel_async(videoid_list)
+        return make_df(search_list, channel_list, count_list, viewcount)
+
+    return await singleflight.run_async(result_key, lambda: collect_partial_async(search), share=is_complete)
+
+
+
+# get_channel の async 版
+@tracing.traced
+async def get_channel_async(videoid_list):
+    thumbnails = await sync_to_async(store.channel_thumbnails)(list(videoid_list.values()))
+    channels = await aio.fetch_channels([
+        channelid for channelid in videoid_list.values() if channelid not in thumbnails
     ])
+    await sync_to_async(store.save_channels)(list(channels.values()))
+    return make_channel_list(videoid_list, thumbnails, channels)
 
-    # 2つのデータフレームのマージ
-    youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
-    youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
-
-    # データフレーム抽出
-    youtube_data = youtube_data[[
-        'ranking', # ランキング
-        'url', # 動画URL
-        'profileImg', # プロフィール画像
-        'title', # 動画タイトル
-        'channeltitle', # チャンネル名
-        'viewcount', # 再生回数
-        'publishtime', # 動画公開日
-        'likeCount', # 高評価数
-        'favoriteCount', # お気に入り数
-        'commentCount', # コメント数
-        'rivalurl',# ライバル動画URL
-        'rivaltitle', # ライバル動画タイトル
-        'rivalchanneltitle', # ライバルチャンネル名
-        'rivalpublishtime', # ライバル動画公開日
-    ]]
 
-    return youtube_data
 
+# get_video の async 版
+@tracing.traced
+async def get_video_async(videoid_list):
+    statistics = await sync_to_async(stored_statistics)(list(videoid_list))
+    with youtube.collect_failures() as failures:
+        videos = await aio.fetch_videos([videoid for videoid in videoid_list if videoid not in statistics])
+    statistics.update(await sync_to_async(fetched_statistics)(videos))
+    return make_count_list(videoid_list, statistics, failures['videos'])
+
+
+
+# search_rivalvideo の async 版(チャンネルごとの検索を asyncio.gather で同時に行う)
+@tracing.traced
+async def search_rivalvideo_async(channelid_list, rival_items_count, rival_order, rival_search_start, rival_search_end):
+    tracked = await sync_to_async(lambda: {
+        channelid: store.tracked_videos(channelid, rival_order, rival_search_start, rival_search_end, rival_items_count)
+        for channelid in channelid_list
+    })()
+
+    async def search(channelid):
+        if tracked[channelid] is not None:
+            return tracked[channelid]
+        rivalvideo_list = []
+        async for items in aio.iter_search_pages(
+            rival_items_count,
+            **rival_search_params(channelid, rival_order, rival_search_start, rival_search_end)
+        ):
+            rivalvideo_list.extend(parse_rivalvideo_item(item) for item in items)
+        return rivalvideo_list
+
+    results = await asyncio.gather(*[search(channelid) for channelid in channelid_list])
+    return [rivalvideo for rivalvideo_list in results for rivalvideo in rivalvideo_list]
+
+
+
+# search_relatedvideo の async 版
+@tracing.traced
+async def search_relatedvideo_async(rivalvideo_list, my_channel_id, related_items_count):
+    rivalvideos = {}
+    for rivalvideo in rivalvideo_list:
+        rivalvideos.setdefault(rivalvideo[0], rivalvideo)
+    related = await aio.fetch_related(rivalvideos, related_items_count)
+    await sync_to_async(store.save_related)(related)
+    return rank_related(rivalvideos, related, my_channel_id)
+
+
+
+# 関連動画検索のジョブの段階(RELATED_STAGES と同じ段階名、同じ結果)
+async def related_rival_stage_async(params, results):
+    rivalvideo_list = await search_rivalvideo_async(
+        params['rival_channel_id'],
+        params['rival_items_count'],
+        params['rival_order'],
+        date.fromisoformat(params['rival_search_start']),
+        date.fromisoformat(params['rival_search_end']),
+    )
+    await sync_to_async(store.save_videos)(rivalvideo_list)
+    return rivalvideo_list
+
+
+
+async def related_search_stage_async(params, results):
+    related_list = await search_relatedvideo_async(results['rivalvideo_list'], params['my_channel_id'], params['related_items_count'])
+    await sync_to_async(store.save_videos)([item[1:6] for item in related_list])
+    return related_list
+
+
+
+async def related_channel_stage_async(params, results):
+    return await get_channel_async(related_videoid_list(results))
+
+
+
+async def related_video_stage_async(params, results):
+    return await get_video_async(related_videoid_list(results))
+
+
+
+ASYNC_RELATED_STAGES = [
+    ('rivalvideo_list', 'ライバル動画を検索', related_rival_stage_async),
+    ('related_list', '関連動画を検索', related_search_stage_async),
+    ('channel_list', 'チャンネルデータを取得', related_channel_stage_async),
+    ('count_list', '動画データを取得', related_video_stage_async),
+]
+
+
+
+# ==================================【エクスポート】=======================================
+# キーワード動画検索の行データ(KeywordRow)を1ページ(最大50件)ずつ返すジェネレーター
+def iter_keyword_rows(keyword, items_count, viewcount, order, search_start, search_end):
+    pages = youtube.iter_search_pages(
+        keyword_search_limit(items_count, viewcount),
+        **keyword_search_params(keyword, order, search_start, search_end)
+    )
+    seen = set()
+    remaining = items_count
+    try:
+        for items in pages:
+            # 前のページと重複した動画は除く
+            page = [item for item in map(parse_search_item, items) if item[0] not in seen]
+            store.save_videos(
+                [videoid, channelid, channeltitle, title, published_at]
+                for videoid, channelid, published_at, title, channeltitle in page
+            )
+            videoid_list = {item[0]: item[1] for item in page}
+            seen.update(videoid_list)
+
+            rows = make_df(page, get_channel(videoid_list), get_video(videoid_list), viewcount)[:remaining]
+            remaining -= len(rows)
+            yield rows
+            if remaining <= 0:
+                break
+    finally:
+        pages.close()
+
+
+
+# 関連動画検索の行データ(RelatedRow)をライバル動画1ページ分ずつ返すジェネレーター
+# params：ジョブと同じパラメータ(related_params)
+def iter_related_rows(params):
+    seen = set()
+    for channelid in params['rival_channel_id']:
+        rival_search = (
+            channelid,
+            params['rival_items_count'],
+            params['rival_order'],
+            date.fromisoformat(params['rival_search_start']),
+            date.fromisoformat(params['rival_search_end']),
+        )
+        # track_channels で巡回済みのチャンネルは、APIを呼び出さずに保存済みのデータを使う
+        tracked = store.tracked_videos(channelid, *rival_search[2:], rival_search[1])
+        if tracked is not None:
+            pages = youtube.chunked(tracked, youtube.MAX_RESULTS_PER_PAGE)
+        else:
+            pages = iter_rivalvideo_pages(*rival_search)
+        for rivalvideo_list in pages:
+            store.save_videos(rivalvideo_list)
+            # 前のページと重複した動画は除く
+            related_list = [
+                item for item in search_relatedvideo(rivalvideo_list, params['my_channel_id'], params['related_items_count'])
+                if item[1] not in seen
+            ]
+            store.save_videos(item[1:6] for item in related_list)
+            videoid_list = {item[1]: item[2] for item in related_list}
+            seen.update(videoid_list)
+
+            yield make_related_df(related_list, get_channel(videoid_list), get_video(videoid_list))
+
+
+
+# 全ページをレスポンスを返す前に読み込んでおく(クォータ切れなどを先に見つける)
+# ASGIではレスポンスの中身をイベントループで読み出すので、API呼び出しとDBへの保存はここで済ませ、
+# レスポンスでは書き出しだけを行う
+# 途中でクォータが切れた場合は、そこまでの行で終わる
+def fetch_rows(pages):
+    rows = list(next(pages, []))
+    try:
+        for page in pages:
+            rows.extend(page)
+    except QuotaExceeded as e:
+        logger.warning('export stopped: %s', e)
+    finally:
+        pages.close()
+    return rows
+
+
+
+# エクスポートのリンク用のクエリ文字列(フォームの項目だけ)
+def export_query(params):
+    return urlencode({
+        name: ','.join(value) if isinstance(value, list) else value
+        for name, value in params.items()
+    })
 
 
 
@@ -335,31 +1060,82 @@ class IndexView(View):
             search_start = form.cleaned_data['search_start']
             search_end = form.cleaned_data['search_end']
 
-            # 動画検索
-            search_list = search_video(keyword, items_count, order, search_start, search_end)
+            # 同じ検索条件の検索結果が保存済みなら、検索しない(一部のデータを取得できなかった結果は取り直す)
+            # (表示部分がキャッシュ済みなら、テンプレートはその表示結果を使う)
+            result_key = make_search_key('keyword', keyword, items_count, viewcount, order, search_start, search_end)
+            context = {'keyword': keyword, 'export_query': export_query(form.cleaned_data)}
+            try:
+                youtube_data, partial = load_result(result_key), False
+                if youtube_data is None:
+                    youtube_data, partial = keyword_search(result_key, keyword, items_count, viewcount, order, search_start, search_end)
+                    results.save(result_key, 'keyword', youtube_data, context, partial)
+            except QuotaExceeded as e:
+                # クォータが足りず、キャッシュもない
+                messages.error(request, str(e))
+                return redirect('index')
+
+            if partial:
+                messages.warning(request, PARTIAL_MESSAGE)
+            return render(request, 'app/keyword.html', dict(
+                context, **result_context(request, result_key, youtube_data, partial, reverse('results', args=[result_key]))
+            ))
+        else:
+            return redirect('index')
 
-            # 動画IDリスト作成
-            videoid_list = {}
-            for item in search_list:
-                # key：動画ID
-                # value：チャンネルID
-                videoid_list[item[0]] = item[1]
 
-            # チャンネルデータ取得
-            channel_list = get_channel(videoid_list)
 
-            # 動画データ取得
-            count_list = get_video(videoid_list)
+# ==================================【キーワード一括検索】=======================================
+class BatchView(View):
+    def get(self, request, *args, **kwargs):
+        # 検索フォーム
+        form = BatchKeywordForm(
+            request.POST or None,
+            # フォームに初期値を設定
+            initial={
+                'items_count': 12, # 検索数(キーワードごと)
+                'viewcount': 1000, # 再生回数
+                'order': 'viewCount', # 並び順
+                'search_start': datetime.today() - timedelta(days=30), # 1ヶ月前
+                'search_end': datetime.today(), # 本日
+            }
+        )
 
-            # 動画データをデータフレーム化する
-            youtube_data = make_df(search_list, channel_list, count_list, viewcount)
+        return render(request, 'app/batch.html', {
+            'form': form
+        })
 
-            return render(request, 'app/keyword.html', {
-                'youtube_data': youtube_data,
-                'keyword': keyword
-            })
+    def post(self, request, *args, **kwargs):
+        # キーワード一括検索
+        form = BatchKeywordForm(request.POST or None)
+
+        # フォームのバリデーション
+        if form.is_valid():
+            # フォームからデータを取得
+            keywords = form.cleaned_data['keywords']
+            items_count = form.cleaned_data['items_count']
+            viewcount = form.cleaned_data['viewcount']
+            order = form.cleaned_data['order']
+            search_start = form.cleaned_data['search_start']
+            search_end = form.cleaned_data['search_end']
+
+            # 同じ検索条件の検索結果が保存済みなら、検索しない
+            result_key = make_search_key('batch', keywords, items_count, viewcount, order, search_start, search_end)
+            try:
+                youtube_data, partial = load_result(result_key), False
+                if youtube_data is None:
+                    youtube_data, partial = batch_search(result_key, keywords, items_count, viewcount, order, search_start, search_end)
+                    results.save(result_key, 'batch', youtube_data, {'keywords': keywords}, partial)
+            except QuotaExceeded as e:
+                messages.error(request, str(e))
+                return redirect('batch')
+
+            if partial:
+                messages.warning(request, PARTIAL_MESSAGE)
+            return render(request, 'app/batch_results.html', batch_result_context(
+                request, result_key, youtube_data, partial, {'keywords': keywords},
+            ))
         else:
-            return redirect('index')
+            return redirect('batch')
 
 
 
@@ -390,42 +1166,311 @@ class RelatedView(View):
         # フォームのバリデーション
         if form.is_valid():
             # フォームからデータを取得
-            my_channel_id = form.cleaned_data['my_channel_id']
-            rival_channel_id = form.cleaned_data['rival_channel_id']
-            rival_channel_id = rival_channel_id.split(',')
-            rival_items_count = form.cleaned_data['rival_items_count']
-            rival_order = form.cleaned_data['rival_order']
-            rival_search_start = form.cleaned_data['rival_search_start']
-            rival_search_end = form.cleaned_data['rival_search_end']
-            related_items_count = form.cleaned_data['related_items_count']
-
-            # ライバル動画を検索
-            rivalvideo_list = search_rivalvideo(rival_channel_id, rival_items_count, rival_order, rival_search_start, rival_search_end)
-
-            # 関連動画を検索
-            related_list = search_relatedvideo(rivalvideo_list, my_channel_id, related_items_count)
-
-            # 動画IDリスト作成
-            videoid_list = {}
-            for item in related_list:
-                # key：動画ID
-                # value：チャンネルID
-                videoid_list[item[1]] = item[2]
-
-            # チャンネルデータ取得
-            channel_list = get_channel(videoid_list)
-
-            # 動画データ取得
-            count_list = get_video(videoid_list)
-
-            # 動画データをデータフレーム化する
-            youtube_data = make_related_df(related_list, channel_list, count_list)
-
-            return render(request, 'app/related.html', {
-                'youtube_data': youtube_data
-            })
+            params = related_params(form)
+
+            # 途中でクォータが切れないように、足りない場合は最初から実行しない
+            try:
+                quota.ensure_available(estimate_related_units(params))
+            except QuotaExceeded as e:
+                messages.error(request, str(e))
+                return redirect('related')
+
+            # 関連動画検索はバックグラウンドで実行し、進捗ページに移動する
+            job = AnalysisJob.objects.create(kind='related', params=params)
+            jobs.submit(job, RELATED_STAGES)
+
+            return redirect('related_job', pk=job.pk)
         else:
             return redirect('related')
 
 
 
+# 関連動画検索の進捗・結果
+class RelatedJobView(View):
+    def get(self, request, pk, *args, **kwargs):
+        job = jobs.fail_if_stale(get_object_or_404(AnalysisJob, pk=pk, kind='related'))
+
+        # 終わっていなければ進捗ページ
+        if job.status != AnalysisJob.DONE:
+            return render(request, 'app/related_job.html', {
+                'job': job,
+                'stages': [label for stage, label, func in RELATED_STAGES],
+            })
+
+        # 完了したジョブの結果は変わらないので、表示結果がキャッシュ済みなら結合しない
+        # (表はテンプレートで使う時に作るので、表示部分の {% cache %} がキャッシュ済みなら作らない)
+        # (一部のデータを取得できなかった結果は、やり直すと変わるのでキャッシュしない)
+        # (関連動画検索の結果はジョブに保存してあるので、並べ替え、ページ分けもこのページで行う)
+        partial = jobs.is_partial(job)
+        youtube_data = SimpleLazyObject(
+            lambda: make_related_df(job.results['related_list'], job.results['channel_list'], job.results['count_list'])
+        )
+
+        if partial:
+            messages.warning(request, PARTIAL_JOB_MESSAGE)
+        return render(request, 'app/related.html', dict({
+            'job': job,
+            'partial': partial,
+            'export_query': export_query(job.params),
+        }, **result_context(request, str(job.pk), youtube_data, partial, reverse('related_job', args=[job.pk]))))
+
+
+
+# 関連動画検索の進捗(related_job.html からポーリングする)
+class RelatedJobStatusView(View):
+    def get(self, request, pk, *args, **kwargs):
+        job = jobs.fail_if_stale(get_object_or_404(AnalysisJob, pk=pk, kind='related'))
+        labels = {stage: label for stage, label, func in RELATED_STAGES}
+
+        return JsonResponse({
+            'status': job.status,
+            'stage': job.stage,
+            'stage_label': labels.get(job.stage, ''),
+            'progress': job.progress,
+            'finished': job.finished,
+            'error': job.error,
+        })
+
+
+
+# 失敗した関連動画検索をやり直す(完了した段階の結果はそのまま使う)
+# 一部のデータを取得できなかった関連動画検索は、その段階から取り直す
+class RelatedJobRetryView(View):
+    def post(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(AnalysisJob, pk=pk, kind='related')
+        if job.status == AnalysisJob.FAILED or (job.status == AnalysisJob.DONE and jobs.is_partial(job)):
+            jobs.discard_partial_stages(job, RELATED_STAGES)
+            job.status = AnalysisJob.QUEUED
+            job.save(update_fields=['status', 'results', 'updated_at'])
+            jobs.submit(job, RELATED_STAGES)
+
+        return redirect('related_job', pk=job.pk)
+
+
+
+# ==================================【保存した検索結果】=======================================
+# キーワード動画検索、キーワード一括検索の結果の並べ替え・絞り込み・ページ分け(APIは呼び出さない)
+class ResultSetView(View):
+    def get(self, request, result_id, *args, **kwargs):
+        result = results.load(result_id)
+        if result is None:
+            messages.error(request, RESULT_EXPIRED_MESSAGE)
+            return redirect('index')
+
+        partial = result['partial']
+        if partial:
+            messages.warning(request, PARTIAL_MESSAGE)
+        if result['kind'] == 'batch':
+            return render(request, 'app/batch_results.html', batch_result_context(
+                request, result_id, result['table'], partial, result['context'],
+            ))
+        return render(request, 'app/keyword.html', dict(
+            result['context'], **result_context(request, result_id, result['table'], partial, reverse('results', args=[result_id]))
+        ))
+
+
+
+# ==================================【async(ASGI)のビュー】=======================================
+# async のビュー(Django 3.1 の View.as_view() は同期の関数を返すので、コルーチン関数で包む)
+# get などの同期のハンドラーはそのまま使える
+class AsyncView(View):
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        functools.update_wrapper(async_view, view)
+        return async_view
+
+
+
+# キーワード動画検索(IndexView と同じ表示)
+class AsyncIndexView(AsyncView, IndexView):
+    async def post(self, request, *args, **kwargs):
+        form = KeywordForm(request.POST or None)
+        if not form.is_valid():
+            return redirect('index')
+
+        keyword = form.cleaned_data['keyword']
+        items_count = form.cleaned_data['items_count']
+        viewcount = form.cleaned_data['viewcount']
+        order = form.cleaned_data['order']
+        search_start = form.cleaned_data['search_start']
+        search_end = form.cleaned_data['search_end']
+
+        # 同じ検索条件の検索結果が保存済みなら、検索しない
+        result_key = make_search_key('keyword', keyword, items_count, viewcount, order, search_start, search_end)
+        context = {'keyword': keyword, 'export_query': export_query(form.cleaned_data)}
+        try:
+            youtube_data, partial = await sync_to_async(load_result)(result_key), False
+            if youtube_data is None:
+                youtube_data, partial = await keyword_search_async(result_key, keyword, items_count, viewcount, order, search_start, search_end)
+                await sync_to_async(results.save)(result_key, 'keyword', youtube_data, context, partial)
+        except QuotaExceeded as e:
+            messages.error(request, str(e))
+            return redirect('index')
+
+        if partial:
+            messages.warning(request, PARTIAL_MESSAGE)
+        # テンプレートの {% cache %} とメッセージ(セッション)の読み込みがあるので、描画はスレッドで行う
+        return await sync_to_async(render)(request, 'app/keyword.html', dict(
+            context, **result_context(request, result_key, youtube_data, partial, reverse('results', args=[result_key]))
+        ))
+
+
+
+# 関連動画検索(RelatedView と同じ進捗・結果ページに移動する)
+# ジョブは ANALYSIS_JOB_BACKEND に従って実行し('thread' ならイベントループのタスク)、終わるのを待たずに移動する
+class AsyncRelatedView(AsyncView, RelatedView):
+    async def post(self, request, *args, **kwargs):
+        form = RelatedForm(request.POST or None)
+        if not form.is_valid():
+            return redirect('related')
+        params = related_params(form)
+
+        # 途中でクォータが切れないように、足りない場合は最初から実行しない
+        try:
+            await sync_to_async(lambda: quota.ensure_available(estimate_related_units(params)))()
+        except QuotaExceeded as e:
+            messages.error(request, str(e))
+            return redirect('related')
+
+        job = await sync_to_async(AnalysisJob.objects.create)(kind='related', params=params)
+        await jobs.submit_async(job, ASYNC_RELATED_STAGES)
+
+        return redirect('related_job', pk=job.pk)
+
+
+
+# ==================================【エクスポート】=======================================
+# 検索結果をCSV、NDJSON、Parquet、Excelでダウンロードする(?format=csv|ndjson|parquet|xlsx と検索フォームの項目)
+# 全ページを取得してから、書き出した分ずつ少しずつ返す
+class ExportView(View):
+    form_class = None
+    row_type = None
+    filename = ''
+    redirect_to = ''
+
+    def get(self, request, *args, **kwargs):
+        form = self.form_class(request.GET or None)
+        export_format = request.GET.get('format', 'csv')
+        if not form.is_valid() or export_format not in export.FORMATS:
+            return redirect(self.redirect_to)
+        if not export.is_available(export_format):
+            messages.error(request, '%s形式で出力するには %s をインストールしてください' % (
+                export_format, '、'.join(export.REQUIRED_PACKAGES[export_format])))
+            return redirect(self.redirect_to)
+
+        try:
+            rows = fetch_rows(self.iter_pages(form))
+        except QuotaExceeded as e:
+            messages.error(request, str(e))
+            return redirect(self.redirect_to)
+
+        return export.streaming_response(rows, self.row_type, export_format, self.filename)
+
+
+
+# キーワード動画検索のエクスポート
+class KeywordExportView(ExportView):
+    form_class = KeywordForm
+    row_type = KeywordRow
+    filename = 'youtube-keyword'
+    redirect_to = 'index'
+
+    def iter_pages(self, form):
+        params = (
+            form.cleaned_data['keyword'],
+            form.cleaned_data['items_count'],
+            form.cleaned_data['viewcount'],
+            form.cleaned_data['order'],
+            form.cleaned_data['search_start'],
+            form.cleaned_data['search_end'],
+        )
+        # 途中でクォータが切れないように、足りない場合は最初から実行しない
+        quota.ensure_available(estimate_keyword_units(*params))
+        return iter_keyword_rows(*params)
+
+
+
+# 関連動画検索のエクスポート
+class RelatedExportView(ExportView):
+    form_class = RelatedForm
+    row_type = RelatedRow
+    filename = 'youtube-related'
+    redirect_to = 'related'
+
+    def iter_pages(self, form):
+        params = related_params(form)
+        # 途中でクォータが切れないように、足りない場合は最初から実行しない
+        quota.ensure_available(estimate_related_units(params))
+        return iter_related_rows(params)
+
+
+
+# ==================================【再生回数の推移】=======================================
+# 保存済みの統計データから計算した動画ごと・チャンネルごとの伸び(1日ごとにキャッシュ)
+class GrowthView(View):
+    # 表示する動画の数
+    max_videos = 100
+
+    def get(self, request, *args, **kwargs):
+        video_rows, channel_rows = growth.get_growth()
+        channel_id = request.GET.get('channel', '')
+        if channel_id:
+            video_rows = [row for row in video_rows if row.channel_id == channel_id]
+
+        return render(request, 'app/growth.html', {
+            'video_rows': video_rows[:self.max_videos],
+            'channel_rows': channel_rows,
+            'channel_id': channel_id,
+            'window_days': settings.GROWTH_ANALYTICS['WINDOW_DAYS'],
+        })
+
+
+
+# ==================================【関連動画の重なり】=======================================
+# 自分の動画がどのライバルの動画の関連動画に出ているか(保存済みの関連動画の一覧から集計。APIは呼び出さない)
+class OverlapView(View):
+    def get(self, request, *args, **kwargs):
+        channel_id = request.GET.get('channel', '').strip()
+        rival_rows, competitor_rows, video_rows = overlap.get_overlap(channel_id) if channel_id else ([], [], [])
+
+        return render(request, 'app/overlap.html', {
+            'channel_id': channel_id,
+            'rival_rows': rival_rows,
+            'competitor_rows': competitor_rows,
+            'video_rows': video_rows,
+        })
+
+
+
+# ==================================【APIの使用量】=======================================
+# 今日のクォータの使用量とキャッシュのヒット数(スタッフのみ)
+@method_decorator(staff_member_required, name='dispatch')
+class QuotaView(View):
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({
+            'day': quota.quota_day().isoformat(),
+            'budget': settings.YOUTUBE_QUOTA['DAILY_BUDGET'],
+            'used': quota.used_units(),
+            'remaining': quota.remaining_units(),
+            'endpoints': quota.usage(),
+            'cache': youtube.get_response_cache().stats(),
+        })
+
+
+
+# ==================================【処理時間】=======================================
+# 段階ごとの処理時間の集計(このプロセスの直近 TRACING['SAMPLES'] 回の p50、p95、スタッフのみ)
+@method_decorator(staff_member_required, name='dispatch')
+class TimingView(View):
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({
+            'stages': tracing.get_stats().summary(),
+        })
@@ -0,0 +1,356 @@
+from apiclient.discovery import build_from_document
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from googleapiclient.errors import HttpError
+from pathlib import Path
+from typing import NamedTuple
+from .cache import get_response_cache
+from .concurrency import fan_out
+from .quota import QUOTA_COST, QuotaExceeded
+from . import quota, tracing, transport
+import logging
+import math
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+
+# 同梱しているディスカバリードキュメント(起動時にネットワークから取得しない)
+DISCOVERY_DOCUMENT = Path(__file__).resolve().parent / 'discovery' / 'youtube.v3.json'
+
+# videos().list / channels().list の id に指定できる最大件数
+MAX_IDS_PER_REQUEST = 50
+
+# search().list の1ページの最大件数
+MAX_RESULTS_PER_PAGE = 50
+
+# やり直しても成功しないエラー(リクエストの誤り、動画が見つからない)
+PERMANENT_ERROR_STATUSES = (400, 404)
+
+# (エンドポイント, part) ごとに、レスポンスに含める項目(fields パラメータ)
+# 説明文や全サイズのサムネイルなどを受け取らないように、行データを作る関数が読む項目だけにする
+# (parse_search_item、fetch_related、store.save_channels、store.parse_statistics、tracking.parse_playlist_item など。
+# 読む項目を増やす時はここにも追加する。testing.FakeYouTube も fields の項目だけを返す)
+FIELDS = {
+    ('search', 'snippet'): 'nextPageToken,items(id/videoId,snippet(publishedAt,channelId,title,channelTitle))',
+    ('videos', 'statistics'): 'items(id,statistics(viewCount,likeCount,favoriteCount,commentCount))',
+    ('channels', 'snippet'): 'items(id,snippet(title,thumbnails/default/url))',
+    ('channels', 'snippet,contentDetails'): 'items(id,snippet(title,thumbnails/default/url),contentDetails/relatedPlaylists/uploads)',
+    ('playlistItems', 'snippet,contentDetails'): 'nextPageToken,items(snippet(channelId,channelTitle,title),contentDetails(videoId,videoPublishedAt))',
+}
+
+# 実行中の collect_failures() の記録先(入れ子の場合は外側から順に)
+_failures = ContextVar('youtube_failures', default=())
+
+# プロセス内で共有するクライアント(最初に使う時に作成)
+_client = None
+_client_lock = threading.Lock()
+
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # APIキーで認証するので、http を渡してデフォルト認証情報の探索を省く
+                # (実際の通信は call() で transport の http を渡す)
+                _client = build_from_document(
+                    DISCOVERY_DOCUMENT.read_text(encoding='utf-8'),
+                    developerKey=settings.YOUTUBE_API_KEY,
+                    http=transport.get_http(),
+                )
+    return _client
+
+
+
+# APIキーが変わったら作り直す
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    global _client
+    if setting == 'YOUTUBE_API_KEY':
+        _client = None
+
+
+
+# テスト、ベンチマーク用にクライアントを差し替える(testing.FakeYouTube など)
+@contextmanager
+def use_client(client):
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    try:
+        yield client
+    finally:
+        with _client_lock:
+            _client = previous
+
+
+
+# fields を指定していなければ、FIELDS の項目だけにする
+def with_fields(endpoint, params):
+    fields = FIELDS.get((endpoint, params.get('part')))
+    if fields is None or 'fields' in params:
+        return params
+    return dict(params, fields=fields)
+
+
+
+# call_response() の結果
+# fetched_at：レスポンスをAPIから取得した日時(time.time()。キャッシュから返した場合は、キャッシュした時)
+# fresh：今回APIから取得した(キャッシュや期限切れのキャッシュから返したものではない)
+class Response(NamedTuple):
+    result: dict
+    fetched_at: float
+    fresh: bool
+
+
+
+# YouTube Data APIの呼び出し(endpoint：'search', 'videos', 'channels')
+# 同じパラメータの呼び出しはキャッシュから返す(APIを呼び出した時間は api.<endpoint> として計測)
+# クォータが足りない時は期限切れのキャッシュで代用し、それもなければ QuotaExceeded
+# use_cache=False：レスポンスキャッシュを使わない(呼び出し元が加工した結果をキャッシュする場合)
+def call_response(endpoint, use_cache=True, **params):
+    params = with_fields(endpoint, params)
+    cache = get_response_cache()
+    entry = cache.get_entry(endpoint, params) if use_cache else None
+    if entry is not None:
+        return Response(*entry, fresh=False)
+
+    request = getattr(get_client(), endpoint)().list(**params)
+    try:
+        with tracing.span('api.' + endpoint):
+            result = quota.execute(endpoint, lambda: request.execute(http=transport.get_http()))
+    except QuotaExceeded:
+        entry = cache.get_stale(endpoint, params) if use_cache else None
+        if entry is None:
+            raise
+        return Response(*entry, fresh=False)
+
+    if use_cache:
+        cache.set(endpoint, params, result, QUOTA_COST.get(endpoint, 1))
+    return Response(result, time.time(), fresh=True)
+
+
+
+# call_response() のレスポンスだけ
+def call(endpoint, use_cache=True, **params):
+    return call_response(endpoint, use_cache, **params).result
+
+
+
+# ==================================【一部の取得の失敗】=======================================
+# 動画、チャンネルのチャンク(50件)や関連動画の1件の取得に失敗しても、全体は止めずにそのIDを記録する
+# (やり直しても失敗した場合。クォータ切れは QuotaExceeded のまま)
+# with collect_failures() as failures: の中で失敗したIDが {endpoint: {ID, ...}} に入る
+@contextmanager
+def collect_failures():
+    failures = defaultdict(set)
+    token = _failures.set(_failures.get() + (failures,))
+    try:
+        yield failures
+    finally:
+        _failures.reset(token)
+
+
+
+def record_failure(endpoint, ids, error):
+    logger.warning('YouTube API %s failed for %d ids: %s', endpoint, len(ids), error)
+    for failures in _failures.get():
+        failures[endpoint].update(ids)
+
+
+
+# func() が失敗したら記録して default を返す
+def capture_failure(endpoint, ids, func, default):
+    try:
+        return func()
+    except (HttpError, OSError) as e:
+        record_failure(endpoint, ids, e)
+        return default
+
+
+
+# search().list の結果を nextPageToken をたどって1ページずつ返すジェネレーター(合計 limit 件まで)
+def iter_search_pages(limit, page_size=MAX_RESULTS_PER_PAGE, **params):
+    page_token = None
+    remaining = limit
+    while remaining > 0:
+        page_params = dict(params, maxResults=min(remaining, page_size, MAX_RESULTS_PER_PAGE))
+        if page_token:
+            page_params['pageToken'] = page_token
+        result = call('search', **page_params)
+
+        items = result.get('items', [])[:remaining]
+        remaining -= len(items)
+        yield items
+
+        page_token = result.get('nextPageToken')
+        if not page_token or not items:
+            break
+
+
+
+# iter_search_pages と同じ検索の、キャッシュ済みのページの項目と、まだAPIで検索する必要のあるページ数(最大)
+# (クォータの見積もり用。APIは呼び出さない)
+def cached_search_pages(limit, page_size=MAX_RESULTS_PER_PAGE, **params):
+    cache = get_response_cache()
+    page_token = None
+    items = []
+    while len(items) < limit:
+        page_params = dict(params, maxResults=min(limit - len(items), page_size, MAX_RESULTS_PER_PAGE))
+        if page_token:
+            page_params['pageToken'] = page_token
+        result = cache.get('search', with_fields('search', page_params))
+        if result is None:
+            return items, math.ceil((limit - len(items)) / min(page_size, MAX_RESULTS_PER_PAGE))
+
+        page = result.get('items', [])[:limit - len(items)]
+        items.extend(page)
+
+        page_token = result.get('nextPageToken')
+        if not page_token or not page:
+            break
+    return items, 0
+
+
+
+# リストを size 件ずつに分割する
+def chunked(items, size=MAX_IDS_PER_REQUEST):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+
+# 重複を除いたIDのリスト(順番は最初に出現した順)
+def unique_ids(ids):
+    return list(dict.fromkeys(ids))
+
+
+
+# fetch_by_ids の結果 {ID: item}
+# fetched_at：今回APIから取得した項目の取得日時 {ID: time.time()}(キャッシュから返した項目は含まない)
+class FetchedItems(dict):
+    def __init__(self):
+        super().__init__()
+        self.fetched_at = {}
+
+    def add(self, response):
+        for item in response.result.get('items', []):
+            self[item['id']] = item
+            if response.fresh:
+                self.fetched_at[item['id']] = response.fetched_at
+
+
+
+# IDを50件ずつまとめて(チャンクごとに並列で)取得し、{ID: item} の辞書(FetchedItems)で返す
+# 取得に失敗したチャンクのIDは record_failure() で記録し、結果には含めない
+def fetch_by_ids(endpoint, ids, part):
+    def fetch(chunk):
+        return capture_failure(endpoint, chunk, lambda: call_response(
+            endpoint,
+            part=part,
+            id=','.join(chunk),
+        ), None)
+
+    items = FetchedItems()
+    for response in fan_out(fetch, chunked(unique_ids(ids))):
+        if response is not None:
+            items.add(response)
+    return items
+
+
+
+# 動画の統計データをまとめて取得
+def fetch_videos(video_ids):
+    return fetch_by_ids('videos', video_ids, part='statistics')
+
+
+
+# チャンネルデータをまとめて取得(アップロード再生リストは part='snippet,contentDetails')
+def fetch_channels(channel_ids, part='snippet'):
+    return fetch_by_ids('channels', channel_ids, part=part)
+
+
+
+# 関連動画の検索結果を {元の動画ID: [[動画ID, チャンネルID, チャンネル名, 動画タイトル, 公開日時], ...]} で返す(順位順)
+# 元の動画IDごとにキャッシュ(YOUTUBE_CACHE['TTL']['related'])し、前回以下の件数ならAPIを呼び出さない
+# 検索に失敗した動画は関連動画なし(record_failure() で 'related' として記録する)
+# 元の動画が削除された、IDが不正など、やり直しても失敗するエラーの動画は記録しない(search_related_or_skip)
+def fetch_related(video_ids, max_results):
+    related, missing = cached_related(video_ids, max_results)
+    related.update(zip(missing, fan_out(
+        lambda videoid: capture_failure('related', [videoid], lambda: search_related_or_skip(videoid, max_results), []),
+        missing
+    )))
+    return related
+
+
+
+# キャッシュ済みの関連動画 {元の動画ID: [...]} と、APIで検索する必要のある元の動画IDのリスト
+def cached_related(video_ids, max_results):
+    cache = get_response_cache()
+    related = {}
+    missing = []
+    for videoid in unique_ids(video_ids):
+        entry = cache.get('related', {'relatedToVideoId': videoid})
+        if entry is not None and entry['max_results'] >= max_results:
+            related[videoid] = entry['items'][:max_results]
+        else:
+            missing.append(videoid)
+    return related, missing
+
+
+
+# search_related で、やり直しても失敗するエラー(400、404)の場合は理由をログに出して関連動画なしにする
+# (一部のデータを取得できなかったことにすると、やり直すたびに同じ動画で失敗して、ずっと一部のままになる)
+# 関連動画なしもキャッシュし、有効期限まではAPIを呼び出さない
+def search_related_or_skip(videoid, max_results):
+    try:
+        return search_related(videoid, max_results)
+    except HttpError as e:
+        if e.resp.status not in PERMANENT_ERROR_STATUSES:
+            raise
+        logger.warning('YouTube API related search for %s dropped (%s %s)', videoid, e.resp.status, quota.error_reason(e))
+        get_response_cache().set('related', {'relatedToVideoId': videoid}, {'max_results': max_results, 'items': []}, QUOTA_COST['search'])
+        return []
+
+
+
+# 1本の動画の関連動画を検索してキャッシュする
+# (検索結果のレスポンスはキャッシュせず、関連動画の一覧だけを 'related' としてキャッシュする)
+def search_related(videoid, max_results):
+    result = call(
+        'search',
+        use_cache=False,
+        part='snippet',
+        # 元の動画IDを指定
+        relatedToVideoId=videoid,
+        # 1回の試行における最大の取得数
+        maxResults=max_results,
+        # 動画タイプ
+        type='video',
+        # 地域コード
+        regionCode='JP',
+    )
+    items = []
+    for item in result.get('items', []):
+        # 削除された動画などは snippet がない(順位は数える)
+        snippet = item.get('snippet', {})
+        items.append([
+            item['id'].get('videoId'),
+            snippet.get('channelId'),
+            snippet.get('channelTitle'),
+            snippet.get('title'),
+            snippet.get('publishedAt'),
+        ])
+    get_response_cache().set('related', {'relatedToVideoId': videoid}, {'max_results': max_results, 'items': items}, QUOTA_COST['search'])
+    return items
@@ -0,0 +1,213 @@
+# make_df / make_related_df の新旧比較ベンチマーク
+# 旧：pandasのデータフレームを3つ作ってマージする方法
+# 新：動画IDをキーにした辞書で結合する方法
+#
+# 使い方：python benchmarks/bench_make_df.py [件数 ...]
+import os
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+import django
+
+django.setup()
+
+from app.views import make_df, make_related_df
+import pandas as pd
+
+
+
+# ==================================【旧実装(pandas)】=======================================
+# 動画データをデータフレーム化する
+def make_df_pandas(search_list, channel_list, count_list, viewcount):
+    # データフレームの作成
+    youtube_data = pd.DataFrame(search_list, columns=[
+        'videoid',
+        'channelId',
+        'publishtime',
+        'title',
+        'channeltitle'
+    ])
+
+    # 重複の削除 subsetで重複を判定する列を指定,inplace=Trueでデータフレームを新しくするかを指定
+    youtube_data.drop_duplicates(subset='videoid', inplace=True)
+
+    # 埋め込み動画のURL
+    youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
+
+    # データフレームの作成
+    df_channel = pd.DataFrame(channel_list, columns=[
+        'videoid',
+        'profileImg'
+    ])
+    df_viewcount = pd.DataFrame(count_list, columns=[
+        'videoid',
+        'viewcount',
+        'likeCount',
+        'favoriteCount',
+        'commentCount'
+    ])
+
+    # 2つのデータフレームのマージ
+    youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
+    youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
+
+    # viewcountの列のデータを条件検索のためにint型にする(元データも変更)
+    youtube_data['viewcount'] = youtube_data['viewcount'].astype(int)
+
+    # データフレームの条件を満たす行だけを抽出
+    youtube_data = youtube_data.query('viewcount>=' + str(viewcount))
+
+    youtube_data = youtube_data[[
+        'publishtime',
+        'title',
+        'channeltitle',
+        'url',
+        'profileImg',
+        'viewcount',
+        'likeCount',
+        'favoriteCount',
+        'commentCount',
+    ]]
+
+    youtube_data['viewcount'] = youtube_data['viewcount'].astype(str)
+
+    return youtube_data
+
+
+
+# 動画データをデータフレーム化する
+def make_related_df_pandas(related_list, channel_list, count_list):
+    # データフレームの作成
+    youtube_data = pd.DataFrame(related_list, columns=[
+        'ranking', # ランキング
+        'videoid', # 動画ID
+        'channelid', # チャンネルID
+        'channeltitle', # チャンネル名
+        'title', # 動画タイトル
+        'publishtime', # 動画公開日
+        'rivalvideoid', # ライバル動画ID
+        'rivalchannelid', # ライバルチャンネルID
+        'rivalchanneltitle', # ライバルチャンネル名
+        'rivaltitle', # ライバル動画タイトル
+        'rivalpublishtime', # ライバル動画公開日時
+    ])
+
+    # 重複の削除 subsetで重複を判定する列を指定,inplace=Trueでデータフレームを新しくするかを指定
+    youtube_data.drop_duplicates(subset='videoid', inplace=True)
+
+    # 動画のURL
+    youtube_data['url'] = 'https://www.youtube.com/embed/' + youtube_data['videoid']
+    youtube_data['rivalurl'] = 'https://www.youtube.com/embed/' + youtube_data['rivalvideoid']
+
+    # データフレームの作成
+    df_channel = pd.DataFrame(channel_list, columns=[
+        'videoid',
+        'profileImg'
+    ])
+    df_viewcount = pd.DataFrame(count_list, columns=[
+        'videoid',
+        'viewcount',
+        'likeCount',
+        'favoriteCount',
+        'commentCount'
+    ])
+
+    # 2つのデータフレームのマージ
+    youtube_data = pd.merge(df_channel, youtube_data, on='videoid', how='left')
+    youtube_data = pd.merge(df_viewcount, youtube_data, on='videoid', how='left')
+
+    # データフレーム抽出
+    youtube_data = youtube_data[[
+        'ranking', # ランキング
+        'url', # 動画URL
+        'profileImg', # プロフィール画像
+        'title', # 動画タイトル
+        'channeltitle', # チャンネル名
+        'viewcount', # 再生回数
+        'publishtime', # 動画公開日
+        'likeCount', # 高評価数
+        'favoriteCount', # お気に入り数
+        'commentCount', # コメント数
+        'rivalurl',# ライバル動画URL
+        'rivaltitle', # ライバル動画タイトル
+        'rivalchanneltitle', # ライバルチャンネル名
+        'rivalpublishtime', # ライバル動画公開日
+    ]]
+
+    return youtube_data
+
+
+
+# ==================================【テストデータ】=======================================
+# 検索結果、チャンネルデータ、統計データを作成(1割は重複、1割は統計非公開)
+def make_keyword_data(size):
+    search_list = []
+    for i in range(size):
+        videoid = 'video%d' % (i - 1 if i % 10 == 9 else i)
+        search_list.append([videoid, 'channel%d' % (i % 20), '2023-01-01', 'title%d' % i, 'channeltitle%d' % (i % 20)])
+    videoid_list = {item[0]: item[1] for item in search_list}
+    channel_list = [[videoid, 'https://example.com/%s.jpg' % channelid] for videoid, channelid in videoid_list.items()]
+    count_list = []
+    for i, videoid in enumerate(videoid_list):
+        if i % 10 == 5:
+            count_list.append([videoid, str(i * 100), '-', '-', '-'])
+        else:
+            count_list.append([videoid, str(i * 100), str(i), '0', str(i // 2)])
+    return search_list, channel_list, count_list
+
+
+def make_related_data(size):
+    search_list, channel_list, count_list = make_keyword_data(size)
+    related_list = [
+        [i % 5 + 1, videoid, channelid, channeltitle, title, publishtime,
+         'rival%d' % i, 'rivalchannel', 'rivalchanneltitle', 'rivaltitle', '2023-01-01']
+        for i, (videoid, channelid, publishtime, title, channeltitle) in enumerate(search_list)
+    ]
+    return related_list, channel_list, count_list
+
+
+
+# データフレームを辞書のリストにする(新実装の行データと比較する)
+def records(df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print('  %-24s %9.3f ms' % (label, seconds * 1000))
+    return seconds
+
+
+
+def main(sizes):
+    # pandasの読み込み時間(新実装では表示に使わない)
+    seconds = float(subprocess.check_output([
+        sys.executable, '-c', 'import time; t = time.perf_counter(); import pandas; print(time.perf_counter() - t)',
+    ]))
+    print('import pandas: %.1f ms' % (seconds * 1000))
+
+    for size in sizes:
+        number = max(1, 2000 // size)
+        print('%d rows' % size)
+
+        keyword_data = make_keyword_data(size)
+        assert records(make_df_pandas(*keyword_data, 1000)) == [row._asdict() for row in make_df(*keyword_data, 1000)]
+        old = bench('make_df (pandas)', lambda: make_df_pandas(*keyword_data, 1000), number)
+        new = bench('make_df (dict)', lambda: make_df(*keyword_data, 1000), number)
+        print('  %-24s %9.1f x' % ('speedup', old / new))
+
+        related_data = make_related_data(size)
+        assert records(make_related_df_pandas(*related_data)) == [row._asdict() for row in make_related_df(*related_data)]
+        old = bench('make_related_df (pandas)', lambda: make_related_df_pandas(*related_data), number)
+        new = bench('make_related_df (dict)', lambda: make_related_df(*related_data), number)
+        print('  %-24s %9.1f x' % ('speedup', old / new))
+
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [50, 200, 1000])
@@ -0,0 +1,170 @@
+# キーワード検索、関連動画検索の処理全体のベンチマーク(APIキー不要)
+# YouTube APIの代わりに app.testing.FakeYouTube を使い、1回の呼び出しに latency 秒かかるものとする
+# 初回(キャッシュなし)と2回目(APIレスポンスのキャッシュあり)の時間、API呼び出し回数、クォータ、メモリを表示する
+#
+# 使い方：python benchmarks/bench_pipelines.py [--latency 秒] [--record ファイル] [--replay ファイル] [件数 ...]
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+from app.cache import get_response_cache
+from app.models import AnalysisJob
+from app.quota import QUOTA_COST
+from app.testing import FakeYouTube, RecordingClient
+from app import youtube
+
+
+LOCMEM = 'django.core.cache.backends.locmem.LocMemCache'
+
+BENCH_SETTINGS = {
+    'CACHES': {
+        'default': {'BACKEND': LOCMEM, 'LOCATION': 'bench-default'},
+        'template_fragments': {'BACKEND': LOCMEM, 'LOCATION': 'bench-template-fragments'},
+        'youtube': {'BACKEND': LOCMEM, 'LOCATION': 'bench-youtube', 'OPTIONS': {'MAX_ENTRIES': 10 ** 6}},
+        'quota': {'BACKEND': LOCMEM, 'LOCATION': 'bench-quota'},
+    },
+    # APIレスポンスのキャッシュもプロセス内にする(ファイルの読み書きを計測に含めない)
+    'YOUTUBE_CACHE': dict(settings.YOUTUBE_CACHE, BACKEND='locmem', MAX_ENTRIES=10 ** 6),
+    'ANALYSIS_JOB_BACKEND': 'inline',
+    'ALLOWED_HOSTS': ['testserver'],
+    # ベンチマークではクォータ、レート制限で止めない
+    'YOUTUBE_QUOTA': dict(settings.YOUTUBE_QUOTA, DAILY_BUDGET=10 ** 9, RATE=10 ** 6, BURST=10 ** 6),
+}
+
+
+
+# ==================================【検索条件】=======================================
+def keyword_form(size):
+    return {
+        'keyword': 'benchmark',
+        'items_count': size,
+        'viewcount': 0,
+        'order': 'viewCount',
+        'search_start': '2023-01-01',
+        'search_end': '2023-02-01',
+    }
+
+
+
+# ライバル5チャンネル × size/5 本の関連動画を size 件ずつ
+def related_form(size):
+    return {
+        'my_channel_id': 'UCmychannel',
+        'rival_channel_id': ','.join('UCrival%d' % i for i in range(5)),
+        'rival_items_count': max(1, size // 5),
+        'rival_order': 'viewCount',
+        'rival_search_start': '2023-01-01',
+        'rival_search_end': '2023-02-01',
+        'related_items_count': size,
+    }
+
+
+
+def post_keyword(client, size):
+    response = client.post('/', keyword_form(size))
+    assert response.status_code == 200, response.status_code
+    return response
+
+
+
+def post_related(client, size):
+    response = client.post('/related/', related_form(size))
+    assert response.status_code == 302, response.status_code
+    response = client.get(response['Location'])
+    assert response.status_code == 200, response.status_code
+    return response
+
+
+
+# ==================================【計測】=======================================
+# 1回分の時間、API呼び出し回数、クォータ、メモリの最大使用量
+# tracemalloc を使うと遅くなるので、時間だけを見る場合は --no-memory
+def measure(label, fake, func, memory=True):
+    # 表示のキャッシュは毎回消す(APIレスポンスのキャッシュは残す)
+    caches['template_fragments'].clear()
+    fake.reset()
+
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - started
+    peak = 0
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    units = sum(QUOTA_COST.get(endpoint, 1) * count for endpoint, count in fake.calls.items())
+    calls = ' '.join('%s=%d' % (endpoint, fake.calls[endpoint]) for endpoint in sorted(fake.calls)) or '-'
+    print('  %-16s %9.1f ms %8d units %8.1f MiB  %s' % (label, seconds * 1000, units, peak / 2 ** 20, calls))
+
+
+
+def reset_state():
+    for alias in settings.CACHES:
+        caches[alias].clear()
+    get_response_cache().clear()
+    AnalysisJob.objects.all().delete()
+
+
+
+def main(args):
+    client = Client()
+    for size in args.sizes:
+        print('%d rows (latency %.0f ms)' % (size, args.latency * 1000))
+        fake = FakeYouTube.load(args.replay, latency=args.latency) if args.replay else \
+            FakeYouTube(latency=args.latency, total_results=max(500, size * 2), related_results=size)
+
+        with youtube.use_client(fake):
+            reset_state()
+            measure('keyword (cold)', fake, lambda: post_keyword(client, size), args.memory)
+            measure('keyword (warm)', fake, lambda: post_keyword(client, size), args.memory)
+            reset_state()
+            measure('related (cold)', fake, lambda: post_related(client, size), args.memory)
+            measure('related (warm)', fake, lambda: post_related(client, size), args.memory)
+
+
+
+# 本物のAPIを呼び出してレスポンスを記録する(--replay で再生する)
+def record(args):
+    recorder = RecordingClient(youtube.get_client())
+    client = Client()
+    with youtube.use_client(recorder):
+        reset_state()
+        for size in args.sizes:
+            post_keyword(client, size)
+            post_related(client, size)
+    recorder.save(args.record)
+    print('recorded %d responses to %s' % (len(recorder.records), args.record))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', nargs='*', type=int, default=[10, 50, 200])
+    parser.add_argument('--latency', type=float, default=0.05, help='1回のAPI呼び出しにかかる秒数')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='メモリを計測しない')
+    parser.add_argument('--record', help='本物のAPIのレスポンスを記録するファイル')
+    parser.add_argument('--replay', help='記録したレスポンスのファイル')
+    args = parser.parse_args()
+
+    with override_settings(**BENCH_SETTINGS):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            record(args) if args.record else main(args)
+        finally:
+            teardown_databases(old_config, verbosity=0)
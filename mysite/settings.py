@@ -38,10 +38,11 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'widget_tweaks',
-    'app'
+    'app.apps.AppConfig'
 ]
 
 MIDDLEWARE = [
+    'app.tracing.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +84,39 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 検索結果の表示部分({% cache %})
+    'template_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'template_fragments',
+    },
+    # YouTube APIのレスポンスなど(ワーカー間で共有、再起動後も残る)
+    'youtube': {
+        'BACKEND': 'app.cache.LockedFileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'youtube',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # クォータの使用量(YOUTUBE_QUOTA['CACHE'])
+    # incr で記録するので、ワーカー間で不可分な BACKEND にする(app.checks)
+    # 1日20件ほどなので、期限切れを消せば MAX_ENTRIES に届かず、記録中のものは消えない
+    'quota': {
+        'BACKEND': 'app.cache.LockedFileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'quota',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -125,8 +159,141 @@ STATIC_URL = '/static/'
 # 環境変数を登録(YOUTUBE_API_KEYの設定)
 import environ
 import os
+import sys
 
 env = environ.Env()
 env.read_env(os.path.join(BASE_DIR, '.env'))
 
-YOUTUBE_API_KEY = env('YOUTUBE_API_KEY')
+# 未設定でも読み込めるようにしておき、app.checks で確認する(テストでは FakeYouTube を使うので不要)
+YOUTUBE_API_KEY = env('YOUTUBE_API_KEY', default='')
+
+# manage.py test で実行中かどうか
+TESTING = sys.argv[1:2] == ['test']
+
+# YouTube APIを並列で呼び出す最大数
+YOUTUBE_MAX_CONCURRENCY = env.int('YOUTUBE_MAX_CONCURRENCY', default=8)
+
+# キーワード動画検索、関連動画検索を async のビューにする(ASGIで動かす場合。asgi.py)
+# APIの呼び出しはスレッドで、同時に YOUTUBE_MAX_CONCURRENCY 件まで(リクエストごとではなくイベントループごと)
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# YouTube APIのHTTP通信(requests の接続プールをワーカープロセスごとに1つ持ち、接続を再利用する)
+# POOL_SIZE：同時に使う接続の数、CONNECT_TIMEOUT / READ_TIMEOUT：接続 / 応答を待つ秒数
+YOUTUBE_HTTP = {
+    'POOL_SIZE': env.int('YOUTUBE_HTTP_POOL_SIZE', default=YOUTUBE_MAX_CONCURRENCY * 2),
+    'CONNECT_TIMEOUT': env.float('YOUTUBE_HTTP_CONNECT_TIMEOUT', default=5.0),
+    'READ_TIMEOUT': env.float('YOUTUBE_HTTP_READ_TIMEOUT', default=30.0),
+}
+
+# YouTube APIのレスポンスキャッシュ
+# BACKEND：'file'(LOCATION のディレクトリ、MAX_ENTRIES件まで)、'locmem'(プロセス内のLRU、MAX_ENTRIES件まで)
+# または 'django'(CACHES の ALIAS を使う)
+# 'file' はワーカー間で共有し再起動後も残り、あふれた時は再取得のクォータが安いエントリ(videos、channels)から捨てる
+# ('locmem' はワーカーごとで再起動すると消える。'django' はあふれた時に捨てるエントリが CACHES のバックエンド次第)
+# TTL：エンドポイントごとの有効期限(秒)。0 または未指定のエンドポイントはキャッシュしない
+# STALE：有効期限が切れた後も残しておく秒数(クォータが足りない時に代わりに使う)
+YOUTUBE_CACHE = {
+    'BACKEND': env('YOUTUBE_CACHE_BACKEND', default='file'),
+    'LOCATION': BASE_DIR / 'cache' / 'responses',
+    'ALIAS': 'youtube',
+    'MAX_ENTRIES': 10000,
+    'STALE': 60 * 60 * 24 * 7,
+    'TTL': {
+        'search': 60 * 60, # 検索結果：1時間
+        'videos': 60 * 10, # 再生回数などの統計：10分
+        'channels': 60 * 60 * 24 * 3, # プロフィール画像：3日
+        'related': 60 * 60 * 24, # 動画ごとの関連動画の一覧：1日
+    },
+}
+
+# 保存済みのデータを再利用する期間(秒)
+# 統計データ(再生回数など)。レスポンスキャッシュの有効期限と同じにする
+# (統計データはAPIから取得した時だけ保存するので、これより長い有効期限のキャッシュから返すと、その間は保存されない)
+YOUTUBE_STATISTICS_MAX_AGE = env.int('YOUTUBE_STATISTICS_MAX_AGE', default=YOUTUBE_CACHE['TTL']['videos'])
+# チャンネルのプロフィール画像
+YOUTUBE_CHANNEL_MAX_AGE = env.int('YOUTUBE_CHANNEL_MAX_AGE', default=60 * 60 * 24 * 3)
+
+# 関連動画検索などの分析ジョブの実行方法
+# 'thread'：Webプロセス内のスレッドで実行、'db'：manage.py run_jobs のワーカーで実行、'inline'：リクエスト内で実行
+ANALYSIS_JOB_BACKEND = env('ANALYSIS_JOB_BACKEND', default='thread')
+# 'thread' の場合に同時に実行するジョブの数
+ANALYSIS_JOB_WORKERS = env.int('ANALYSIS_JOB_WORKERS', default=2)
+# この秒数以上進まない(実行中、'db' 以外では待機中のまま)ジョブは、止まったものとして失敗にする
+ANALYSIS_JOB_TIMEOUT = env.int('ANALYSIS_JOB_TIMEOUT', default=60 * 30)
+
+# 検索結果の表示部分をキャッシュする期間(秒)
+RESULT_FRAGMENT_TIMEOUT = env.int('RESULT_FRAGMENT_TIMEOUT', default=60 * 10)
+
+# 検索結果の保存(/results/<結果ID>/ で、APIを呼び出さずに並べ替え、絞り込み、ページ分けをする)
+# CACHE：保存するキャッシュ(ワーカー間で共有するもの)、TIMEOUT：保存する秒数、PAGE_SIZE：1ページの件数
+RESULT_SETS = {
+    'CACHE': 'youtube',
+    'TIMEOUT': 60 * 60 * 24,
+    'PAGE_SIZE': 24,
+}
+
+# キーワード動画検索で読み込む検索結果の最大件数(50件ごとに search().list を1回呼び出す)
+YOUTUBE_SEARCH_MAX_RESULTS = env.int('YOUTUBE_SEARCH_MAX_RESULTS', default=250)
+
+# 同じ検索条件の検索が同時に実行された時は、1回だけ実行して結果を共有する(ワーカー間はDBのロックで)
+# CACHE：結果を置くキャッシュ(ワーカー間で共有するもの)
+# LOCK_TIMEOUT：他のワーカーの検索を待つ最大秒数(ロックの期限)、RESULT_TIMEOUT：結果を残しておく秒数、POLL_INTERVAL：結果を確認する間隔(秒)
+SINGLE_FLIGHT = {
+    'CACHE': 'youtube',
+    'LOCK_TIMEOUT': 120,
+    'RESULT_TIMEOUT': 60,
+    'POLL_INTERVAL': 0.2,
+}
+
+# YouTube APIのクォータとレート制限
+# DAILY_BUDGET：1日に使うクォータ(ユニット)、RESERVE：使わずに残しておく分
+# RATE / BURST：1秒あたりの呼び出し数 / まとめて呼び出せる数(プロセスごと)
+# MAX_RETRIES / BACKOFF：レート制限のエラーをやり直す回数 / 最初の待ち時間(秒、1回ごとに2倍)
+# CACHE：使用量を記録するキャッシュ(ワーカー間で共有し、incr が不可分なもの。app.checks で確認する。APIレスポンスとは別にする)
+YOUTUBE_QUOTA = {
+    'DAILY_BUDGET': env.int('YOUTUBE_DAILY_QUOTA', default=10000),
+    'RESERVE': 200,
+    'RATE': 10,
+    'BURST': 20,
+    'MAX_RETRIES': 3,
+    'BACKOFF': 1.0,
+    'CACHE': 'quota',
+}
+
+# manage.py track_channels で巡回するチャンネル(環境変数はコンマ区切り)
+# INTERVAL：巡回の間隔(秒)、MAX_VIDEOS：1チャンネルあたりの動画数(初回に読み込む数、統計データを取り直す数)
+# MAX_AGE：この秒数以内に巡回したチャンネルは、ライバル動画検索でAPIの代わりに保存済みのデータを使う
+YOUTUBE_TRACKING = {
+    'MY_CHANNEL_ID': env('YOUTUBE_MY_CHANNEL_ID', default=''),
+    'RIVAL_CHANNEL_IDS': env.list('YOUTUBE_RIVAL_CHANNEL_IDS', default=[]),
+    'INTERVAL': env.int('YOUTUBE_TRACKING_INTERVAL', default=60 * 60 * 6),
+    'MAX_VIDEOS': 200,
+    'MAX_AGE': 60 * 60 * 24,
+}
+
+# 再生回数の推移の分析(/growth/)
+# WINDOW_DAYS：分析に使う統計データの日数、CACHE：1日ごとの計算結果を保存するキャッシュ
+GROWTH_ANALYTICS = {
+    'WINDOW_DAYS': 30,
+    'CACHE': 'youtube',
+}
+
+# 関連動画の重なりの集計(/overlap/)
+# CACHE：集計結果を保存するキャッシュ、TIMEOUT：保存する秒数(関連動画の一覧が増えたら集計し直す)
+# TOP_CHANNELS：自分の動画と一緒に出るチャンネルの表示数
+RELATED_OVERLAP = {
+    'CACHE': 'youtube',
+    'TIMEOUT': 60 * 60 * 24,
+    'TOP_CHANNELS': 20,
+}
+
+# リクエスト、ジョブの段階ごとの処理時間の計測(ログは logger 'app.tracing' に INFO で出力)
+# SERVER_TIMING：レスポンスに Server-Timing ヘッダーを付ける
+# PROFILE_RATE / PROFILE_DIR：cProfile で計測するリクエストの割合(0〜1) / 結果(.prof)の保存先
+# SAMPLES：集計(/timings/ の p50、p95)に使う直近の計測数(段階ごと、プロセスごと)
+TRACING = {
+    'SERVER_TIMING': env.bool('TRACING_SERVER_TIMING', default=True),
+    'PROFILE_RATE': env.float('TRACING_PROFILE_RATE', default=0.0),
+    'PROFILE_DIR': BASE_DIR / 'profiles',
+    'SAMPLES': 1000,
+}